@@ -1,7 +1,7 @@
 import torch
 
 from itertools import repeat
-#import numpy as np
+import numpy as np
    
 """
 THE FOLLOWING CODE IS SOURCED FROM THE NETWORKX LIBRARY, WHICH IS LICENSED UNDER THE 3-CLAUSE BSD LICENSE.
@@ -33,7 +33,7 @@ def matching_dict_to_set(matching):
     return edges
 
 
-def max_weight_matching_matrix(G: torch.Tensor):
+def max_weight_matching_matrix(G: torch.Tensor, unpaired: torch.Tensor = None):
     """Compute a maximum-weighted matching of G.
 
     A matching is a subset of edges in which no node occurs more than once.
@@ -43,6 +43,7 @@ def max_weight_matching_matrix(G: torch.Tensor):
 
     Parameters
     - G : Graph in the form of a pytorch tensor
+    - unpaired (torch.Tensor): Optional weight of leaving each node unmatched. Unmatched nodes with positive weight are returned as (i, i).
 
     Returns
     - matching (set): A maximal matching of the graph.
@@ -51,6 +52,10 @@ def max_weight_matching_matrix(G: torch.Tensor):
     -----
     This function takes time O(number_of_nodes ** 3).
 
+    Weights for unmatched nodes are handled without adding nodes to the graph. 
+    Leaving node i unmatched adds unpaired[i] to the weight, which is the same as adding unpaired[i] for all nodes and subtracting it from every edge at i.
+    The maximum weight matching is therefore found on the reduced edge weights G[i, j] - unpaired[i] - unpaired[j], where edges with no positive weight can be left out.
+
     This method is based on the "blossom" method for finding augmenting
     paths and the "primal-dual" method for finding a matching of maximum
     weight, both methods invented by Jack Edmonds [1]_.
@@ -81,7 +86,12 @@ def max_weight_matching_matrix(G: torch.Tensor):
                     yield t
 
     n = G.shape[0]
-    neighbors = {i:{j:G[i, j] for j in range(n) if G[i,j] != 0} for i in range(n)}
+    if unpaired is not None:
+        G = torch.clamp(G.double() - unpaired.double()[:, None] - unpaired.double()[None, :], min=0)
+        G.fill_diagonal_(0)
+    # Work on python floats. Tensor scalars are updated in place by -= and += which makes the dual variables share values
+    W = G.tolist()
+    neighbors = {i:{j:W[i][j] for j in range(n) if W[i][j] != 0} for i in range(n)}
     # Get a list of vertices.
     gnodes = list(range(n))
     
@@ -89,7 +99,7 @@ def max_weight_matching_matrix(G: torch.Tensor):
         return set()  # don't bother with empty graphs
 
     # Find the maximum edge weight.
-    maxweight = torch.max(G)
+    maxweight = max(0, max(map(max, W)))
 
     mate = {}
     label = {}
@@ -105,7 +115,7 @@ def max_weight_matching_matrix(G: torch.Tensor):
 
     def slack(v, w):
         """Return 2 * slack of edge (v, w) (does not work inside blossoms)."""
-        return dualvar[v] + dualvar[w] - 2 * G[v, w]
+        return dualvar[v] + dualvar[w] - 2 * W[v][w]
 
     def assignLabel(w, t, v):
         """Assign label t to the top-level blossom containing vertex w, coming through an edge from vertex v."""
@@ -637,4 +647,106 @@ def max_weight_matching_matrix(G: torch.Tensor):
             if blossomparent[b] is None and label.get(b) == 1 and blossomdual[b] == 0:
                 expandBlossom(b, True)
 
-    return matching_dict_to_set(mate)
\ No newline at end of file
+    matching = matching_dict_to_set(mate)
+
+    if unpaired is not None:
+        matching.update((v, v) for v in gnodes if v not in mate and unpaired[v] > 0)
+
+    return matching
+
+
+"""
+THE FOLLOWING CODE IS NOT PART OF NETWORKX.
+GREEDY APPROXIMATION OF THE MAXIMUM WEIGHT MATCHING, USED WHEN THE EXACT BLOSSOM ALGORITHM IS TOO SLOW.
+"""
+
+def greedy_matching_matrix(G: torch.Tensor, unpaired: torch.Tensor = None, local_search: bool = False, max_rounds: int = 10) -> set:
+    """Compute an approximate maximum-weighted matching of G.
+
+    The edges are visited in order of decreasing weight and added to the matching if none of the end points are matched yet.
+    This gives a matching with at least half the weight of the maximum weight matching.
+    Optionally the matching is improved by local swaps, which are repeated as long as they increase the weight, for at most max_rounds rounds:
+    - an edge is added if its weight is larger than the weight of the (at most two) matched edges it replaces
+    - a matched edge (u, v) is replaced by two edges (u, a) and (v, b) to unmatched nodes a and b
+
+    Parameters
+    - G : Graph in the form of a pytorch tensor. Only the upper triangle is used.
+    - unpaired (torch.Tensor): Optional weight of leaving each node unmatched. Unmatched nodes with positive weight are returned as (i, i).
+    - local_search (bool): If True, the greedy matching is improved with local swaps.
+    - max_rounds (int): The maximum number of rounds of local swaps.
+
+    Returns
+    - matching (set): A matching of the graph.
+
+    Notes
+    -----
+    This function takes time O(E log E) without local swaps, where E is the number of edges with positive weight.
+    Every round of local swaps takes time O(V ** 2) and strictly increases the weight of the matching, so with local swaps the time is O(E log E + max_rounds * V ** 2).
+    """
+    W = G.detach().cpu().numpy()
+    n = W.shape[0]
+
+    if n == 0:
+        return set()
+
+    diagonal = unpaired.detach().cpu().numpy() if unpaired is not None else np.zeros(n, dtype=W.dtype)
+
+    rows, cols = np.nonzero(np.triu(W, k=1) > 0)
+    weights = W[rows, cols]
+
+    mate = np.full(n, -1)
+
+    # Visit edges by decreasing weight and keep the ones with two free end points
+    for k in np.argsort(-weights, kind='stable'):
+        i, j = rows[k], cols[k]
+        if mate[i] < 0 and mate[j] < 0 and weights[k] > diagonal[i] + diagonal[j]:
+            mate[i], mate[j] = j, i
+
+    for _ in range(max_rounds if local_search else 0):
+        # Weight each node currently contributes to the matching
+        matched = mate >= 0
+        nodes = np.arange(n)
+        node_weight = np.where(matched, W[nodes, np.where(matched, mate, nodes)], diagonal)
+
+        # Swap in one edge, replacing the (at most two) matched edges touching it
+        gain = weights - node_weight[rows] - node_weight[cols]
+        swaps = [(gain[k], [(rows[k], cols[k])]) for k in np.nonzero(gain > 1e-12)[0]]
+
+        # Swap out one matched edge (u, v) and match both u and v to free nodes
+        if n > 2:
+            arm = np.where((W > 0) & ~matched[None, :], W - diagonal[None, :], -np.inf)
+            np.fill_diagonal(arm, -np.inf)
+            best = np.argpartition(-arm, 1, axis=1)[:, :2]
+            best = np.take_along_axis(best, np.argsort(-np.take_along_axis(arm, best, axis=1), axis=1), axis=1)
+
+            for u in np.nonzero(matched & (nodes < mate))[0]:
+                v = mate[u]
+                options = [(arm[u, a] + arm[v, b] - W[u, v], a, b) for a, b in ((best[u, 0], best[v, 0]), (best[u, 0], best[v, 1]), (best[u, 1], best[v, 0])) if a != b]
+                g, a, b = max(options, default=(-np.inf, None, None))
+                if g > 1e-12:
+                    swaps.append((g, [(u, a), (v, b)]))
+
+        if not swaps:
+            break
+
+        # Apply the swaps with the largest gain that do not touch nodes already changed in this round
+        touched = np.zeros(n, dtype=bool)
+        for g, edges in sorted(swaps, key=lambda x: x[0], reverse=True):
+            ends = [x for edge in edges for x in edge]
+            involved = ends + [mate[x] for x in ends if mate[x] >= 0]
+            if touched[involved].any():
+                continue
+            touched[involved] = True
+            for x in ends:
+                if mate[x] >= 0:
+                    mate[mate[x]] = -1
+                    mate[x] = -1
+            for i, j in edges:
+                mate[i], mate[j] = j, i
+
+    matching = {(i, int(mate[i])) for i in range(n) if i < mate[i]}
+
+    if unpaired is not None:
+        matching.update((i, i) for i in range(n) if mate[i] < 0 and diagonal[i] > 0)
+
+    return matching
@@ -1,42 +1,54 @@
 import torch, pickle, os, sys
 
-import networkx as nx
 import numpy as np
 
+#The script is run from the root of this repository, where the matching engine is found
+sys.path.append(os.getcwd())
+from blossom import max_weight_matching_matrix
+
 from torch.utils.data import Dataset, DataLoader
 
 from collections import namedtuple
 
 
+bases = ['A', 'U', 'G', 'C']
+
+#Index of each character in bases, where other characters have index 0
+BASE_INDEX = np.zeros(256, dtype=np.int64)
+BASE_INDEX[[ord(base) for base in bases]] = np.arange(len(bases))
+
+#Pairing types of the channels of the input matrix: AU, UA, UG, GU, GC, CG
+PAIR_TYPES = torch.tensor([1, 4, 6, 9, 11, 14])
+
+
 ### FUNCTIONS BELOW ARE COPIED FROM CNNFOLD REPOSITORY ###
 
 def keep_topk(mat, k=3):
+    #Scatter the k largest values of each row into an empty matrix in one step
     v, idx = torch.topk(mat, k, dim=-1)
-    n = idx.size(-2)
-    new_mat = torch.zeros_like(mat)
-    for i in range(idx.size(0)):
-        for j in range(k):
-            new_mat[i, 0, range(n), idx[i, 0, :, j]] = mat[i, 0, range(n), idx[i, 0, :, j]]
+    new_mat = torch.zeros_like(mat).scatter_(-1, idx, v)
     return new_mat.float()
 
 
 def blossom(mat):
+    """
+    Maximum weight matching of the matrix, where leaving a base unpaired scores its value on the diagonal.
+    CNNfold finds the matching with NetworkX in a 2N x 2N graph where each base is linked to its copy with twice the diagonal. 
+    The same matching is found on the N bases with the matching engine of this repository, which only visits the nonzero entries of the matrix.
+    As when NetworkX makes the graph from the matrix, the weight of a pair is the entry below the diagonal, unless it is 0.
+    """
     A = mat.clone()
-    n = A.size(-1)
-    mask = torch.eye(n) * 2
-    big_a = torch.zeros((2*n, 2*n))
-    big_a[:n, :n] = A
-    big_a[n:, n:] = A
-    big_a[:n, n:] = A*mask
-    big_a[n:, :n] = A*mask
-    G = nx.convert_matrix.from_numpy_array(np.array(big_a.cpu().data))
-    pairings = nx.matching.max_weight_matching(G)
+    lower = torch.tril(A, -1)
+    upper = torch.triu(A, 1)
+    lower, upper = lower + lower.T, upper + upper.T
+    weights = torch.where(lower != 0, lower, upper)
+
+    pairings = max_weight_matching_matrix(weights, unpaired=torch.clamp(torch.diagonal(A), min=0))
+    pairings = torch.tensor(list(pairings), dtype=torch.long).reshape(-1, 2)
+
     y_out = torch.zeros_like(A)
-    for (i, j) in pairings:
-        if i>n and j>n:
-            continue
-        y_out[i%n, j%n] = 1
-        y_out[j%n, i%n] = 1
+    y_out[pairings[:, 0], pairings[:, 1]] = 1
+    y_out[pairings[:, 1], pairings[:, 0]] = 1
     return y_out
 
 def binarize(y_hat, threshold=0, use_blossom=False):
@@ -67,52 +79,26 @@ def create_matrix(sequence, onehot=True, min_dist=3):
         = 8 modes (channels)
     """
     n = len(sequence)
-    invalid = []
-    seq = []
-    for i, s in enumerate(sequence):
-        if s not in bases:
-            invalid.append(i)
-            seq.append(0)
-        else:
-            seq.append(bases.index(s))
-
-    seq = torch.tensor(seq)
-    if onehot:
-        mat = torch.zeros((17, n, n))
-    else:
-        mat = torch.zeros((1, n, n))
-
+    #Bases that are not in bases are treated as the first base
+    seq = torch.from_numpy(BASE_INDEX[np.frombuffer(sequence.encode(), dtype=np.uint8)])
 
     q2 = seq.repeat(n, 1)
-    q1 = q2.transpose(1, 0)    
-    t = torch.stack(((torch.abs(q1-q2)==1).long(), torch.eye(n).long()))
-    mask = torch.max(t, 0)[0]
-    flat_mat = ((q1*4+q2+1) * mask)
-    
-    for i in range(1, min_dist+1):
-        flat_mat[range(n-i), range(i, n)] = 0
-        flat_mat[range(i, n), range(n-i)] = 0
-    
-#     flat_mat[invalid] = 0
-#     flat_mat[:, invalid] = 0
-    flat_mat = flat_mat.unsqueeze(0)
-    
+    q1 = q2.transpose(1, 0)
+    index = torch.arange(n)
+    distance = torch.abs(index[:, None] - index[None, :])
+
+    #Pairing types are 4*q1 + q2, and only the ones where the bases differ by one in the order of bases are allowed, for bases more than min_dist apart
+    pairing = (torch.abs(q1-q2) == 1) & (distance > min_dist)
+    types = q1*4 + q2
+
     if onehot:
-        idx2 = torch.arange(n).repeat(n, 1)
-        idx1 = idx2.transpose(1, 0).reshape(-1)
-        idx2 = idx2.reshape(-1)
-        mat[flat_mat.reshape(-1), idx1, idx2] = 1
-#         mat[q2.reshape(-1), idx1, idx2] = 1
-#         mat[4+q1.reshape(-1), idx1, idx2] = 1
-        mat = mat[1:]
-        mat8 = mat[[1, 4, 6, 9, 11, 14]]
-        # mat8 = mat[[1, 6, 11]]
-        # mat8 = mat8 + mat8.transpose(-1, -2)
-
-        mat8 = torch.cat((mat8, torch.sum(mat[[0, 5, 10, 15]], 0).unsqueeze(0)), 0)
+        mat8 = (types.unsqueeze(0) == PAIR_TYPES[:, None, None]) & pairing.unsqueeze(0)
+        mat8 = torch.cat((mat8.float(), torch.eye(n).unsqueeze(0)), 0)
         mat8 = torch.cat((mat8, 1-torch.sum(mat8, 0).unsqueeze(0)), 0)
         return mat8
-    return flat_mat
+    
+    flat_mat = (types+1) * (pairing | (distance == 0))
+    return flat_mat.unsqueeze(0)
 
 
 ######
@@ -193,7 +179,6 @@ if __name__ == '__main__':
         data_path = 'data/archiveii.pkl'
 
 
-    bases = ['A', 'U', 'G', 'C']
     topk_k = 5
     threshold = .0
     RNA = namedtuple('RNA', 'input output length family name sequence')
@@ -1,9 +1,11 @@
-import pickle, subprocess, time, datetime, os, tempfile, torch, sys
-
-from tqdm import tqdm
+import pickle, datetime, sys
 
 from collections import namedtuple
 
+from runner import ExecutableTool, run_tool
+
+TIMEOUT = 60*60 #Maximum time in seconds for one sequence
+
 def format_time(seconds: float) -> str:
     """
     Format a time duration in seconds to hh:mm:ss format.
@@ -19,47 +21,29 @@ def format_time(seconds: float) -> str:
     minutes, seconds = divmod(remainder, 60)
     return '{:02d}:{:02d}:{:02d}'.format(hours, minutes, seconds)
 
-def contrafold(file: str) -> str:
+def parse_contrafold(output: str) -> list:
     """
-    Calls the CONTRAfold executable to predict the secondary structure of an RNA sequence.
+    Reads the structure from the output of CONTRAfold and converts it to a list of base pairs.
 
     Parameters:
-    - file (str): The path to the file containing the RNA sequence.
+    - output (str): The output of CONTRAfold, where the fourth word is the predicted secondary structure in dot-bracket notation.
 
     Returns:
-    - str: The predicted secondary structure in dot-bracket notation.
-    """ 
-    command = ['../contrafold/src/contrafold', 'predict', file]
-
-    try:
-        p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        p.wait()
-        output, error = p.communicate()
-
-        if p.returncode == 0: #Check that command succeeded
-            result = output.decode().split() 
-            return result[3]
-        else:
-            error_msg = error.decode() if error else 'Unknown error'
-            raise Exception(f'CONTRAfold execution failed: {error_msg}')
-    
-    except Exception as e:
-        raise Exception(f'An error occured: {e}')
+    - list: A list of integers representing the pairing state of each base.
+    """
+    return dot_bracket_to_basepair(output.split()[3])
 
-    
 
-def dot_bracket_to_matrix(db: str) -> torch.Tensor: 
+def dot_bracket_to_basepair(db: str) -> list: 
     """
-    Takes a pseudoknot-free dot-bracket notation and converts it to a matrix representation.
+    Takes a pseudoknot-free dot-bracket notation and converts it to a list of base pairs.
 
     Parameters:
     - db (str): The dot-bracket notation.
 
     Returns:
-    - torch.Tensor: The matrix representation of the dot-bracket notation.
+    - list: A list of integers representing the pairing state of each base.
     """
-    matrix = torch.zeros(len(db), len(db))
-    
     stack1 = []
 
     bp = [i for i in range(len(db))]
@@ -71,11 +55,8 @@ def dot_bracket_to_matrix(db: str) -> torch.Tensor:
             j = stack1.pop()
             bp[i] = j
             bp[j] = i
-    
-    for i, j in enumerate(bp):
-        matrix[i, j] = 1
         
-    return matrix   
+    return bp
 
 
 
@@ -96,33 +77,13 @@ if __name__ == '__main__':
     RNA = namedtuple('RNA', 'input output length family name sequence')
     files = pickle.load(open(data_path, 'rb'))
 
-    os.makedirs(output_dir, exist_ok=True)
-
-    total_time = 0
+    #CONTRAfold reads the sequence from a file, so it is written to a temporary file for each sequence
+    tool = ExecutableTool('contrafold', ['../contrafold/src/contrafold', 'predict', '{file}'], parse_contrafold)
     
     print('--- Starting predicting ---')
 
-    progress_bar = tqdm(total=len(files), unit='sequence', file=sys.stdout)
-    for file in files:
-        name = os.path.basename(file)
-        #Make temporary file for sequence, since CONTRAfold requires a file
-        with tempfile.NamedTemporaryFile(mode='w', delete=False) as temp_file:
-            sequence = pickle.load(open(file, 'rb')).sequence
-            temp_file.write(sequence)
-        
-        #Predict structure, save it and measure time
-        try: 
-            start_time = time.time() 
-            structure = contrafold(temp_file.name)
-            structure = dot_bracket_to_matrix(structure)
-            pickle.dump(structure, open(f'{output_dir}/{name}', 'wb'))
-            total_time += (time.time() - start_time)
-        
-        finally:
-            #Remove temporary file
-            os.unlink(temp_file.name) 
-        progress_bar.update(1)
-    
-    progress_bar.close()
+    #Run one sequence at a time without the cache, so the times are not measured under contention or read from an earlier run
+    results = run_tool(tool, files, output_dir, processes=1, timeout=TIMEOUT, cache_dir=None)
+    total_time = sum(result.time for result in results if result.error is None)
 
     print(f'Prediction done in {format_time(total_time)}. Average time per sequence: {total_time/len(files)}')
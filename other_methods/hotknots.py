@@ -1,13 +1,17 @@
 #!/usr/bin/env python3
-import os, sys, pickle, time, tqdm, datetime, torch
+import os, sys, pickle, datetime
 import multiprocessing as mp
 from collections import namedtuple
 from signal import signal, SIGPIPE, SIG_DFL
 signal(SIGPIPE,SIG_DFL) 
 
+from runner import FunctionTool, run_tool
+
 sys.path.pop(0)
 from hotknots import hotknots as hk
 
+MODEL = 'DP' #Defines the parameters used for the prediction
+
 def format_time(seconds: float) -> str:
     """
     Format a time duration in seconds to hh:mm:ss format.
@@ -61,47 +65,19 @@ def dot_bracket_to_basepair(db: str) -> list:
 			bp[j] = i
 	return bp
 
-def make_matrix_from_basepairs(pairs: list) -> torch.Tensor:
-	"""
-    Takes a list of which base each position in the sequence is paired with. If a base is unpaired pairs[i] = i.
-    From the list a 2D matrix is made, with each cell coresponding to a base pair encoded as 1 and unpaired bases encoded as 1 at the diagonal
-
-    Parameters:
-    - pairs (list): A list of integers representing the pairing state of each base.
-
-    Returns:
-    - torch.Tensor: A 2D tensor with shape (len(pairs), len(pairs)).
-    """
-
-	N = len(pairs)
-	matrix = torch.zeros(N, N, dtype=torch.float32)
-
-	for i, p in enumerate(pairs):
-		matrix[i, p] = 1
-
-	return matrix
-
-def process_file(i: int) -> float:
+def predict_hotknots(sequence: str) -> list:
 	"""
-	Takes a index to a file list and predicts the secondary structure of the sequence in the file using hotknots.
-	The result is saved in the steps/hotknots folder.
+	Predicts the secondary structure of a sequence using hotknots. Unknown bases (N) are replaced by A.
+	hotknots must be initialized in the process before it is called.
 
 	Parameters:
-	- i (int): Index to the file list.
+	- sequence (str): The RNA sequence.
 
 	Returns:
-	- float: The time it took to predict the secondary structure.
-	""" 
-	start_time = time.time()
-	name = os.path.join('steps', 'hotknots', os.path.basename(files[i]))
-	sequence = pickle.load(open(files[i], 'rb')).sequence
-	sequence = sequence.replace('N', 'A')
-	seq, mfe = hk.fold(sequence, model)
-	structure = make_matrix_from_basepairs(dot_bracket_to_basepair(seq))
-	pickle.dump(structure, open(name, 'wb'))
-	result = time.time() - start_time
-	process_bar.update(1)
-	return result
+	- list: A list of integers representing the pairing state of each base.
+	"""
+	seq, mfe = hk.fold(sequence.replace('N', 'A'), MODEL)
+	return dot_bracket_to_basepair(seq)
             
 
 if __name__ == '__main__':
@@ -113,23 +89,13 @@ if __name__ == '__main__':
 	files = pickle.load(open('data/test.pkl', 'rb'))
 	indices = pickle.load(open('data/test_under_600.pkl', 'rb'))
 
-	model = 'DP' #Defines the parameters used for the prediction
-
-	hk.initialize(model, os.path.join(params,"parameters_DP09.txt") , os.path.join(params,"multirnafold.conf"), os.path.join(params,"pkenergy.conf") )
-
-	os.makedirs('steps/hotknots', exist_ok=True)
+	hk.initialize(MODEL, os.path.join(params,"parameters_DP09.txt") , os.path.join(params,"multirnafold.conf"), os.path.join(params,"pkenergy.conf") )
 
 	print(f"Start predicting with hotknots for {len(indices)} sequences")
 
-	process_bar = tqdm.tqdm(total=len(indices), unit='seq', file=sys.stdout)
-	
-	#Process all files using multiprocessing
-	with mp.Pool(mp.cpu_count()) as pool:
-		times = pool.map(process_file, indices)
-
-	process_bar.close()
+	#The workers are forked after hotknots is initialized, so they can use it
+	tool = FunctionTool('hotknots', predict_hotknots, version=f'{MODEL}09')
+	results = run_tool(tool, [files[i] for i in indices], os.path.join('steps', 'hotknots'), processes=mp.cpu_count())
 	
-	total_time = sum(times)
+	total_time = sum(result.time for result in results if result.error is None)
 	print(f"Finished in {format_time(total_time)}. Average time per sequence: {total_time/len(indices):.5f}")
-
-
@@ -1,6 +1,7 @@
-import pickle, os, time, subprocess, datetime, torch, sys
+import pickle, os, time, datetime, sys
+import numpy as np
 from collections import namedtuple
-from tqdm import tqdm
+from runner import FunctionTool, run_tool
 import pandas as pd
 import matplotlib.pyplot as plt
 
@@ -20,54 +21,73 @@ def format_time(seconds: float) -> str:
     return '{:02d}:{:02d}:{:02d}'.format(hours, minutes, seconds)
 
 
-def run_nussinov(sequence: str) -> list:
+def parse_pairs(output: str) -> list:
     """
-    Calls the Nussinov executable to predict the secondary structure of an RNA sequence.
+    Reads the list of which base each position is paired with from the output of the Nussinov executable.
 
     Parameters:
-    - sequence (str): The RNA sequence.
+    - output (str): The output of the executable.
 
     Returns:
-    - list: The predicted secondary structure in dot-bracket notation.
+    - list: A list of integers representing the pairing state of each base.
     """
-    command = ['other_methods/nussinov', sequence]
+    return [int(p) for p in output.split()]
 
-    try:
-        p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        p.wait()
-        output, error = p.communicate()
 
-        if p.returncode == 0: #Check that command succeeded
-            result = output.decode().split()
-            return result
-        else:
-            error_msg = error.decode() if error else 'Unknown error'
-            raise Exception(f'Nussinov execution failed: {error_msg}')
-    
-    except Exception as e:
-        raise Exception(f'An error occured: {e}')
+#Base pairs allowed by the executable, indexed by the position of the bases in 'ACGU'. Other characters (index 4) do not pair
+BASE_INDEX = {'A': 0, 'C': 1, 'G': 2, 'U': 3}
+COMPLEMENTARY = np.zeros((5, 5), dtype=bool)
+for x, y in ['AU', 'UA', 'CG', 'GC', 'GU', 'UG']:
+    COMPLEMENTARY[BASE_INDEX[x], BASE_INDEX[y]] = True
 
 
-def make_matrix_from_basepairs(pairs: list) -> torch.Tensor:
-	"""
-    Takes a list of all which base each position in the sequence is paired with. If a base is unpaired pairs[i] = i.
-    From the list a 2D matrix is made, with each cell coresponding to a base pair encoded as 1 and unpaired bases encoded as 1 at the diagonal
+def nussinov(sequence: str) -> list:
+    """
+    Predicts the secondary structure of an RNA sequence with Nussinov's algorithm in the same way as the Nussinov executable, without starting a process.
+    Each basepair scores one and hairpin loops have at least 3 unpaired bases. The table is filled one diagonal at a time with NumPy,
+    and the structure is found by backtracking with an explicit stack, trying the options in the same order as the executable so the same structure is found.
 
     Parameters:
-    - pairs (list): A list of integers representing the pairing state of each base.
+    - sequence (str): The RNA sequence.
 
     Returns:
-    - torch.Tensor: A 2D tensor with shape (len(pairs), len(pairs)).
+    - list: The index of the paired base of each base, or the index of the base itself if it is unpaired.
     """
+    n = len(sequence)
+    codes = np.array([BASE_INDEX.get(base, 4) for base in sequence], dtype=np.int64)
+    dp = np.zeros((n, n), dtype=np.int32)
+
+    for l in range(4, n):
+        i = np.arange(n-l)
+        j = i+l
+
+        score = np.maximum(dp[i+1, j], dp[i, j-1])
+        score = np.where(COMPLEMENTARY[codes[i], codes[j]], np.maximum(score, dp[i+1, j-1]+1), score)
 
-	N = len(pairs)
-     
-	matrix = torch.zeros((N,N), dtype=torch.float32)
+        #The bifurcation of the executable adds dp[k+1][k], which is always 0, so it is never above dp[i][j-1] and is left out
+        dp[i, j] = score
 
-	for i, p in enumerate(pairs):
-		matrix[i, int(p)] = 1 
+    pairs = list(range(n))
+    stack = [(0, n-1)]
+
+    while stack:
+        i, j = stack.pop()
+
+        if j-i < 4:
+            continue
+
+        if dp[i, j] == dp[i+1, j]:
+            stack.append((i+1, j))
+        elif dp[i, j] == dp[i, j-1]:
+            stack.append((i, j-1))
+        else:
+            #dp[i][j] has no bifurcation, so if neither end is skipped i and j are paired
+            assert COMPLEMENTARY[codes[i], codes[j]] and dp[i, j] == dp[i+1, j-1]+1
+            pairs[i], pairs[j] = j, i
+            stack.append((i+1, j-1))
+
+    return pairs
 
-	return matrix
 
 def plot_time(time, lengths):
     """
@@ -110,36 +130,27 @@ def main() -> None:
     print('-- Predicting --')
 
     times = [[] for _ in range(len(test))]
-    lengths = []
 
     if data_set == 'RNAStrAlign':
         repeats = 3
     else:
         repeats = 1
 
-    progress_bar = tqdm(total=len(test)*repeats, unit='sequence')
-
     start_time = time.time()
 
     #Predict for all sequences in test set 3 times and save the time it took
+    #The sequences are run one at a time without the cache, so the times are not measured under contention or read from an earlier run
+    tool = FunctionTool('nussinov', nussinov)
     for _ in range(repeats):
-        lengths = []
-        for i in range(len(test)): 
-            sequence = pickle.load(open(test[i], 'rb')).sequence
-            name = os.path.join(output_path, os.path.basename(test[i])) 
-            start = time.time()
-            output = make_matrix_from_basepairs(run_nussinov(sequence))
-            times[i].append(time.time()-start)
-            pickle.dump(output, open(name, 'wb'))
-            lengths.append(len(sequence))
-            progress_bar.update(1)
+        results = run_tool(tool, test, output_path, processes=1, cache_dir=None)
+        for i, result in enumerate(results):
+            times[i].append(result.time)
+    lengths = [result.length for result in results]
     
     #Calculate average time for each sequence
     times = [sum(t)/len(t) for t in times]
     
-    progress_bar.close()
-    
-    total_time = (time.time()-start_time)/3
+    total_time = (time.time()-start_time)/repeats
 
     print('-- Predictions done --')
 
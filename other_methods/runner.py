@@ -0,0 +1,258 @@
+import os, sys, time, pickle, hashlib, inspect, signal, subprocess, tempfile, torch
+import multiprocessing as mp
+
+from collections import namedtuple
+from contextlib import contextmanager
+from tqdm import tqdm
+
+CACHE_DIR = 'steps/cache'
+
+#Outcome of predicting the structure of one file. time is the time of the prediction, also when the structure is read from the cache, and error is None if it succeeded
+Result = namedtuple('Result', 'file length time cached error')
+
+
+def make_matrix_from_basepairs(pairs: list) -> torch.Tensor:
+    """
+    Takes a list of which base each position in the sequence is paired with. If a base is unpaired pairs[i] = i.
+    From the list a 2D matrix is made, with each cell coresponding to a base pair encoded as 1 and unpaired bases encoded as 1 at the diagonal
+
+    Parameters:
+    - pairs (list): A list of integers representing the pairing state of each base.
+
+    Returns:
+    - torch.Tensor: A 2D tensor with shape (len(pairs), len(pairs)).
+    """
+    N = len(pairs)
+    matrix = torch.zeros((N, N), dtype=torch.float32)
+    matrix[torch.arange(N), torch.tensor(pairs, dtype=torch.long).reshape(N)] = 1
+
+    return matrix
+
+
+def file_hash(path: str) -> str:
+    """
+    Returns a short hash of the content of a file, which is used as the version of executables so the cache is not used after they are rebuilt
+    """
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()[:12]
+
+
+@contextmanager
+def time_limit(seconds: float):
+    """
+    Raises TimeoutError in the block if it runs for more than the given number of seconds. Must be used in the main thread of the process.
+    No limit is used if seconds is None.
+    """
+    if seconds is None:
+        yield
+        return
+
+    def handler(signum, frame):
+        raise TimeoutError(f'Timed out after {seconds} seconds')
+
+    previous = signal.signal(signal.SIGALRM, handler)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+class Tool:
+    """
+    Adapter for a structure prediction method that is run by run_tool.
+    The name and version of the tool are part of the cache key, so results are only reused for the same version of the same tool.
+    """
+    name = None
+    version = None
+
+    def predict(self, sequence: str, timeout: float = None) -> list:
+        """
+        Predicts the structure of a sequence.
+
+        Parameters:
+        - sequence (str): The RNA sequence.
+        - timeout (float): The maximum time in seconds. None allows any time.
+
+        Returns:
+        - list: The index of the paired base of each base, or the index of the base itself if it is unpaired.
+        """
+        raise NotImplementedError
+
+
+class ExecutableTool(Tool):
+    """
+    Tool that runs an executable for each sequence and parses what it writes to stdout.
+    The arguments of the command can contain '{sequence}', which is replaced by the sequence, and '{file}', which is replaced by the path to a temporary file with the sequence.
+    The output is read with subprocess.run, so the executable can not block on a full pipe, and it is killed if it runs for longer than the timeout.
+
+    Parameters:
+    - name (str): The name of the tool.
+    - command (list): The executable followed by its arguments.
+    - parse (callable): Function that takes the output of the executable and returns the pair list.
+    - version (str): The version of the tool. If not given, a hash of the executable is used.
+    """
+    def __init__(self, name: str, command: list, parse: callable, version: str = None) -> None:
+        self.name = name
+        self.command = command
+        self.parse = parse
+        self.version = version or file_hash(command[0])
+
+    def predict(self, sequence: str, timeout: float = None) -> list:
+        temp_file = None
+        if any('{file}' in arg for arg in self.command):
+            with tempfile.NamedTemporaryFile(mode='w', delete=False) as temp_file:
+                temp_file.write(sequence)
+
+        try:
+            command = [arg.replace('{sequence}', sequence).replace('{file}', temp_file.name if temp_file else '') for arg in self.command]
+            p = subprocess.run(command, capture_output=True, timeout=timeout)
+        finally:
+            if temp_file:
+                os.unlink(temp_file.name)
+
+        if p.returncode != 0: #Check that command succeeded
+            error_msg = p.stderr.decode() if p.stderr else 'Unknown error'
+            raise RuntimeError(f'{self.name} execution failed: {error_msg}')
+
+        return self.parse(p.stdout.decode())
+
+
+class FunctionTool(Tool):
+    """
+    Tool that calls a Python function for each sequence in the process of the worker.
+    The timeout is raised with an alarm signal, which Python only handles between bytecodes, so a function that runs in a C extension (e.g. HotKnots or ViennaRNA) is not stopped until the call returns.
+    Such functions should be run without a timeout, or wrapped in an executable and run with ExecutableTool.
+
+    Parameters:
+    - name (str): The name of the tool.
+    - func (callable): Function that takes a sequence and returns the pair list. Must be defined at module level to be sent to the workers.
+    - version (str): The version of the tool. If not given, a hash of the source of the function is used.
+    """
+    def __init__(self, name: str, func: callable, version: str = None) -> None:
+        self.name = name
+        self.func = func
+        self.version = version or hashlib.sha1(inspect.getsource(func).encode()).hexdigest()[:12]
+
+    def predict(self, sequence: str, timeout: float = None) -> list:
+        with time_limit(timeout):
+            return list(self.func(sequence))
+
+
+def cache_path(cache_dir: str, tool: Tool, sequence: str) -> str:
+    """
+    Returns the path of the cached prediction of a sequence, which is found from the tool, its version and a hash of the sequence
+    """
+    return os.path.join(cache_dir, tool.name, tool.version, hashlib.sha1(sequence.encode()).hexdigest() + '.pkl')
+
+
+def predict_with_retries(tool: Tool, sequence: str, timeout: float, retries: int) -> tuple:
+    """
+    Predicts the structure of a sequence and tries again if the tool fails. Timeouts are not retried, since the tool would most likely time out again.
+
+    Parameters:
+    - tool (Tool): The tool to predict with.
+    - sequence (str): The RNA sequence.
+    - timeout (float): The maximum time in seconds of each try.
+    - retries (int): The number of times to try again after a failure.
+
+    Returns:
+    - pairs (list): The pair list, None if all tries failed.
+    - time (float): The time of the successful try.
+    - error (str): The error of the last try, None if it succeeded.
+    """
+    error = None
+    for _ in range(retries+1):
+        try:
+            start = time.time()
+            pairs = tool.predict(sequence, timeout)
+            return pairs, time.time() - start, None
+        except (TimeoutError, subprocess.TimeoutExpired) as e:
+            return None, None, f'Timeout: {e}'
+        except Exception as e:
+            error = f'{type(e).__name__}: {e}'
+
+    return None, None, error
+
+
+#Tool of the worker processes, set by the initializer of the pool
+_worker_tool = None
+
+def _init_worker(tool: Tool) -> None:
+    global _worker_tool
+    _worker_tool = tool
+
+
+def _run_job(job: tuple) -> tuple:
+    """
+    Predicts the structure of the sequence in a file with the tool of the worker and saves it as a matrix in the output folder.
+    The prediction is read from the cache if it is there, and otherwise added to it.
+    """
+    i, file, output_dir, cache_dir, timeout, retries = job
+    sequence = pickle.load(open(file, 'rb')).sequence
+    path = cache_path(cache_dir, _worker_tool, sequence) if cache_dir else None
+
+    cached = path is not None and os.path.exists(path)
+    if cached:
+        pairs, prediction_time = pickle.load(open(path, 'rb'))
+    else:
+        pairs, prediction_time, error = predict_with_retries(_worker_tool, sequence, timeout, retries)
+        if error:
+            return i, Result(file, len(sequence), None, False, error)
+
+        if path:
+            #Write to a temporary file first, so a stopped run does not leave a partial entry in the cache
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), delete=False) as f:
+                pickle.dump((pairs, prediction_time), f)
+            os.replace(f.name, path)
+
+    pickle.dump(make_matrix_from_basepairs(pairs), open(os.path.join(output_dir, os.path.basename(file)), 'wb'))
+
+    return i, Result(file, len(sequence), prediction_time, cached, None)
+
+
+def run_tool(tool: Tool, files: list, output_dir: str, processes: int = None, timeout: float = None, retries: int = 1, cache_dir: str = CACHE_DIR, progress: bool = True) -> list:
+    """
+    Predicts the structures of the sequences in a list of files with a tool and saves them as matrices in the output folder with the same file names.
+    The files are run on a process pool with a timeout for each file, and failed predictions are tried again.
+    Predictions are cached by the tool, its version and the sequence, so a rerun only predicts the sequences that are not done.
+
+    Parameters:
+    - tool (Tool): The tool to predict with.
+    - files (list): The paths to the pickled files with the sequences.
+    - output_dir (str): The folder to save the structures in.
+    - processes (int): The number of worker processes. None uses all CPUs, and 1 runs in this process.
+    - timeout (float): The maximum time in seconds for each prediction. None allows any time. See FunctionTool for when it does not apply.
+    - retries (int): The number of times to try a failed prediction again.
+    - cache_dir (str): The folder of the cache. None does not use the cache, e.g. when timing the tool.
+    - progress (bool): If True, a progress bar is shown.
+
+    Returns:
+    - list: The Result of each file, in the order of the files.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    jobs = [(i, file, output_dir, cache_dir, timeout, retries) for i, file in enumerate(files)]
+    results = [None] * len(files)
+
+    progress_bar = tqdm(total=len(files), unit='sequence', file=sys.stdout, disable=not progress)
+
+    if processes == 1:
+        _init_worker(tool)
+        for i, result in map(_run_job, jobs):
+            results[i] = result
+            progress_bar.update(1)
+    else:
+        with mp.Pool(processes, initializer=_init_worker, initargs=(tool,)) as pool:
+            for i, result in pool.imap_unordered(_run_job, jobs):
+                results[i] = result
+                progress_bar.update(1)
+
+    progress_bar.close()
+
+    failed = [result for result in results if result.error]
+    if failed:
+        print(f'{len(failed)} of {len(files)} predictions with {tool.name} failed, e.g. {failed[0].file}: {failed[0].error}')
+
+    return results
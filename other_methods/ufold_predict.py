@@ -33,6 +33,24 @@ absolute_path = os.path.dirname(os.path.realpath(__file__))
 args = get_args(absolute_path=absolute_path)
 perm = list(product(np.arange(4), np.arange(4)))
 
+BASES = 'AUCG'
+
+#Index of each character in BASES, where characters that are not bases have index 4
+BASE_INDEX = np.full(256, 4, dtype=np.int64)
+for code, base in enumerate(BASES):
+    BASE_INDEX[ord(base)] = BASE_INDEX[ord(base.lower())] = code
+
+#One-hot encoding of each index, where characters that are not bases are -1 in all channels
+ONE_HOT = np.concatenate((np.eye(4), -np.ones((1, 4)))).astype(np.float32)
+
+#Pairing scores used in creatmat, indexed by the codes of the two bases
+PAIRED = np.zeros((5, 5), dtype=np.float32)
+for pair, score in {'AU':2, 'UA':2, 'GC':3, 'CG':3, 'UG':0.8, 'GU':0.8}.items():
+    PAIRED[BASES.index(pair[0]), BASES.index(pair[1])] = score
+
+#Number of steps along the stem used in creatmat. UFold uses 30, but the weight exp(-t^2/2) is 0 in float32 from t = 15, so the later steps do not change the sums
+STEM_STEPS = 15
+
 def format_time(seconds):
     """
     Format a time duration in seconds to hh:mm:ss format.
@@ -55,7 +73,7 @@ def model_eval_all_test(contact_net,test_generator):
 
     batch_n = 0
 
-    for seq_embeddings, seq_lens, seq_ori, seq_name in test_generator:
+    for seq_embeddings, seq_lens, seq_ori, seq_names in test_generator:
         if batch_n%100==0:
             print('Prediction number: ', batch_n)
 
@@ -73,17 +91,17 @@ def model_eval_all_test(contact_net,test_generator):
         u_no_train = postprocess(pred_contacts,
             seq_ori, 0.01, 0.1, 100, 1.6, True,1.5)
         
-        #Make output binary
-
-        map_no_train = (u_no_train > 0.5).float()[:,:seq_lens[0],:seq_lens[0]].squeeze(0).cpu().astype("float32")
-        for i in range(map_no_train.shape[0]):
-            #Check if row is all zeros and add a 1 on the diagonal
-            if torch.all(map_no_train[i] == 0):
-                map_no_train[i,i] = 1
+        #Make output binary and save each sequence in the batch
+        for k, seq_name in enumerate(seq_names):
+            n = int(seq_lens[k])
+            map_no_train = (u_no_train[k] > 0.5).float()[:n, :n].cpu()
 
+            #Add a 1 on the diagonal of rows that are all zeros
+            unpaired = torch.nonzero(map_no_train.sum(dim=1) == 0).squeeze(1)
+            map_no_train[unpaired, unpaired] = 1
 
-        #Save the results to a pickle file
-        pickle.dump(map_no_train, open('results_Ufold/' + seq_name[0], 'wb'))
+            #Save the results to a pickle file
+            pickle.dump(map_no_train, open('results_Ufold/' + seq_name, 'wb'))
     
 def get_cut_len(data_len,set_len):
     l = data_len
@@ -93,19 +111,20 @@ def get_cut_len(data_len,set_len):
         l = (((l - 1) // 16) + 1) * 16
     return l
 
-def creatmat(data, device=None):
+def creatmat(codes, device=None):
+    """
+    Makes the extra input channel of UFold, with the pairing scores of the stems around each basepair.
+    Takes the codes of the bases (index in BASES, 4 for other characters) instead of the one-hot encoding, so the pairing scores are found with one lookup.
+    """
     if device==None:
         device = torch.device('cuda:0') if torch.cuda.is_available() else torch.device('cpu')
 
     with torch.no_grad():
-        data = ''.join(['AUCG'[list(d).index(1)] for d in data])
-        paired = defaultdict(int, {'AU':2, 'UA':2, 'GC':3, 'CG':3, 'UG':0.8, 'GU':0.8})
-
-        mat = torch.tensor([[paired[x+y] for y in data] for x in data]).to(device)
-        n = len(data)
+        mat = torch.from_numpy(PAIRED[codes[:, None], codes[None, :]]).to(device)
+        n = len(codes)
 
         i, j = torch.meshgrid(torch.arange(n).to(device), torch.arange(n).to(device), indexing='ij')
-        t = torch.arange(30).to(device)
+        t = torch.arange(STEM_STEPS).to(device)
         m1 = torch.where((i[:, :, None] - t >= 0) & (j[:, :, None] + t < n), mat[torch.clamp(i[:,:,None]-t, 0, n-1), torch.clamp(j[:,:,None]+t, 0, n-1)], 0)
         m1 *= torch.exp(-0.5*t*t)
 
@@ -115,19 +134,45 @@ def creatmat(data, device=None):
         m1[to0indices] = 0
         m1 = m1.sum(dim=2)
 
-        t = torch.arange(1, 30).to(device)
+        t = torch.arange(1, STEM_STEPS).to(device)
         m2 = torch.where((i[:, :, None] + t < n) & (j[:, :, None] - t >= 0), mat[torch.clamp(i[:,:,None]+t, 0, n-1), torch.clamp(j[:,:,None]-t, 0, n-1)], 0)
         m2 *= torch.exp(-0.5*t*t)
 
         m2_0pad = torch.nn.functional.pad(m2, (0, 1))
         first0 = torch.argmax((m2_0pad==0).to(int), dim=2)
-        to0indices = torch.arange(29).to(device)[None,None,:]>first0[:,:,None]
+        to0indices = torch.arange(STEM_STEPS-1).to(device)[None,None,:]>first0[:,:,None]
         m2[to0indices] = 0
         m2 = m2.sum(dim=2)
         m2[m1==0] = 0
 
         return (m1+m2).to(torch.device('cpu'))
 
+def featurize(sequence, l):
+    """
+    Makes the input of UFold for a sequence, padded to length l.
+    The 16 pair channels are the outer products of all combinations of the one-hot channels, which are found with one einsum, followed by the creatmat channel.
+
+    Parameters:
+    - sequence (str): The RNA sequence.
+    - l (int): The padded length.
+
+    Returns:
+    - np.ndarray: The 17 x l x l input.
+    - np.ndarray: The l x 4 one-hot encoding of the sequence.
+    """
+    codes = BASE_INDEX[np.frombuffer(sequence.encode(), dtype=np.uint8)]
+    n = len(codes)
+
+    one_hot = np.zeros((l, 4), dtype=np.float32)
+    one_hot[:n] = ONE_HOT[codes]
+
+    #Channel 4*i + j is the outer product of one-hot channels i and j, in the same order as perm
+    features = np.zeros((17, l, l), dtype=np.float32)
+    features[:16, :n, :n] = np.einsum('ai,bj->ijab', one_hot[:n], one_hot[:n]).reshape(16, n, n)
+    features[16, :n, :n] = creatmat(codes, torch.device('cpu')).numpy()
+
+    return features, one_hot
+
 class Dataset_FCN(data.Dataset):
   'Characterizes a dataset for PyTorch'
   def __init__(self, file):
@@ -137,46 +182,40 @@ class Dataset_FCN(data.Dataset):
             data = [file.strip() for file in f.readlines()]
         self.files = data
 
+        #The sequences are read once, so the lengths are known when the batches are made
+        self.sequences = [pickle.load(open(file, 'rb')).sequence.replace('N', 'A') for file in self.files]
+        self.lengths = [get_cut_len(len(sequence), 80) for sequence in self.sequences]
+
   def __len__(self):
         'Denotes the total number of samples'
         return len(self.files)
-  
-  def one_hot_600(self,seq_item):
-        RNN_seq = seq_item
-        BASES = 'AUCG'
-        bases = np.array([base for base in BASES])
-        feat = np.concatenate(
-                [[(bases == base.upper()).astype(int)] if str(base).upper() in BASES else np.array([[-1] * len(BASES)]) for base
-                in RNN_seq])
-        one_hot_matrix_600 = np.zeros((600,4))
-        one_hot_matrix_600[:len(seq_item),] = feat
-        return one_hot_matrix_600
 
   def __getitem__(self, index):
         'Generates one sample of data'
-        # Select sample
-        RNA = collections.namedtuple('RNA', 'input output length family name sequence')
-        data = pickle.load(open(self.files[index], 'rb'))
-
-        sequence = data.sequence.replace('N', 'A')
-
-        data_len = len(sequence)
-        data_seq = self.one_hot_600(sequence)
-
-        l = get_cut_len(data_len,80)
-        data_fcn = np.zeros((16, l, l))
-        if l >= 500:
-            seq_adj = np.zeros((l, 4))
-            seq_adj[:data_len] = data_seq[:data_len]
-            data_seq = seq_adj
-        for n, cord in enumerate(perm):
-            i, j = cord
-            data_fcn[n, :data_len, :data_len] = np.matmul(data_seq[:data_len, i].reshape(-1, 1), data_seq[:data_len, j].reshape(1, -1))
-        data_fcn_1 = np.zeros((1,l,l))
-        data_fcn_1[0,:data_len,:data_len] = creatmat(data_seq[:data_len,])
-        data_fcn_2 = np.concatenate((data_fcn,data_fcn_1),axis=0)
-        
-        return data_fcn_2, data_len, data_seq[:l], os.path.basename(self.files[index])
+        sequence = self.sequences[index]
+        data_fcn, data_seq = featurize(sequence, self.lengths[index])
+
+        return data_fcn, len(sequence), data_seq, os.path.basename(self.files[index])
+
+class LengthBucketSampler(data.Sampler):
+  """
+  Batch sampler that only puts sequences with the same padded length in a batch, so the inputs of a batch have the same shape.
+  The batches are made from the longest sequences first.
+  """
+  def __init__(self, lengths, batch_size):
+        self.batch_size = batch_size
+        self.buckets = defaultdict(list)
+        for index, length in enumerate(lengths):
+            self.buckets[length].append(index)
+
+  def __iter__(self):
+        for length in sorted(self.buckets, reverse=True):
+            bucket = self.buckets[length]
+            for start in range(0, len(bucket), self.batch_size):
+                yield bucket[start:start+self.batch_size]
+
+  def __len__(self):
+        return sum((len(bucket) + self.batch_size - 1) // self.batch_size for bucket in self.buckets.values())
 
 def main():
     torch.multiprocessing.set_sharing_strategy('file_system')
@@ -190,7 +229,6 @@ def main():
     config = process_config(config_file)
     
     d = config.u_net_d
-    BATCH_SIZE = config.batch_size_stage_1
     OUT_STEP = config.OUT_STEP
     LOAD_MODEL = config.LOAD_MODEL
     data_type = config.data_type
@@ -204,13 +242,15 @@ def main():
 
     seed_torch()
     
-    params = {'batch_size': BATCH_SIZE,
-              'shuffle': True,
-              'num_workers': 1,
-              'drop_last': True}
-
     test_set = Dataset_FCN('input.txt')
     #test_set = Dataset_FCN(test_data)s
+
+    #The inputs are made by the workers, and each batch only has sequences with the same padded length. 
+    #The model is used in train mode, so the batch normalization uses the statistics of the batch.
+    #The batch size is therefore fixed at 1 and not read from the config, since larger batches would change the predictions
+    params = {'batch_sampler': LengthBucketSampler(test_set.lengths, 1),
+              'num_workers': os.cpu_count()}
+
     test_generator = data.DataLoader(test_set, **params)
     contact_net = FCNNet(img_ch=17)
 
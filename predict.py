@@ -319,40 +319,118 @@ def mask(matrix: torch.Tensor, sequence: str, device: str) -> torch.Tensor:
     
     return matrix
 
+def matching_to_pairs(matching, n: int, device: str) -> torch.Tensor:
+    """
+    Converts a collection of base pairs (i, j) to a pair vector of length n.
+    The pair vector has the index of the base each position is paired with and -1 for unpaired bases.
+
+    Parameters:
+    - matching (iterable): The base pairs.
+    - n (int): The length of the sequence.
+    - device (str): The device to use for the pair vector.
+
+    Returns:
+    - torch.Tensor: The pair vector.
+    """
+    pairs = torch.full((n,), -1, dtype=torch.long, device=device)
+    edges = torch.tensor([(i, j) for i, j in matching if i != j], dtype=torch.long, device=device).reshape(-1, 2)
+
+    pairs[edges[:, 0]] = edges[:, 1]
+    pairs[edges[:, 1]] = edges[:, 0]
+
+    return pairs
+
 def blossom_postprocessing(matrix: torch.Tensor,  device: str) -> torch.Tensor: 
     """
-    Postprocessing function that takes a matrix and returns a matrix.
-    The function uses the blossom algorithm to find the maximum weight matching in the graph representation of the matrix, with copying of the matrix to allow for self-pairing.
+    Postprocessing function that takes a matrix and returns a pair vector.
+    The function uses the blossom algorithm to find the maximum weight matching in the graph representation of the matrix, with the diagonal as the score of self-pairing (leaving a base unpaired).
+    The matching is found on the N bases directly, but gives the same result as copying the matrix to a 2Nx2N graph where each base can pair with its copy.
     The functions used are modified version of NetworkX functions, and are implemented in the blossom.py file.
-    The functions has sequence as input, but does not use it. It is provided to make the function compatible with other postprocessing functions.
 
     Parameters:
     - matrix (torch.Tensor): The matrix to postprocess.
 
     Returns:
-    - torch.Tensor: The postprocessed matrix.
+    - torch.Tensor: The pair vector with the index of the paired base or -1 for unpaired bases.
+    """
+    # Same optimum as copying the matrix and linking each base to its copy with the score on the diagonal
+    # Pairs are found in both copies, so the score of leaving a base unpaired is half the diagonal
+    pairing = blossom.max_weight_matching_matrix(matrix, unpaired=torch.diagonal(matrix)/2)
+
+    return matching_to_pairs(pairing, matrix.shape[0], device)
+
+
+def greedy_postprocessing(matrix: torch.Tensor, device: str) -> torch.Tensor:
+    """
+    Postprocessing function that takes a matrix and returns a pair vector.
+    Approximate alternative to blossom_postprocessing for long sequences or when prediction time is critical.
+    The matching is found greedily by picking the strongest pairings first, without local swaps, so it has at least half the weight of the maximum weight matching and takes O(E log E) time instead of O(V^3).
+    The diagonal is used as the score of leaving a base unpaired. It is halved to give the same objective as the copied matrix in blossom_postprocessing.
+
+    Parameters:
+    - matrix (torch.Tensor): The matrix to postprocess.
+
+    Returns:
+    - torch.Tensor: The pair vector with the index of the paired base or -1 for unpaired bases.
+    """
+    pairing = blossom.greedy_matching_matrix(matrix, unpaired=torch.diagonal(matrix)/2)
+
+    return matching_to_pairs(pairing, matrix.shape[0], device)
+
+# Seconds per unit of work, measured on masked predictions of length 100-600
+# Blossom scales with length times number of candidate pairs, greedy with the number of candidate pairs
+POSTPROCESSING_COST = {'blossom': 3.5e-7, 'sparse blossom': 8e-7, 'greedy': 2e-6}
+
+def sparse_blossom_postprocessing(matrix: torch.Tensor, device: str, k: int = 8) -> torch.Tensor:
+    """
+    Postprocessing function that takes a matrix and returns a pair vector.
+    Same as blossom_postprocessing, but only the k strongest candidate pairs of each base are used, which makes the graph sparse.
+
+    Parameters:
+    - matrix (torch.Tensor): The matrix to postprocess.
+    - k (int): The number of candidate pairs to keep for each base.
+
+    Returns:
+    - torch.Tensor: The pair vector with the index of the paired base or -1 for unpaired bases.
     """
     n = matrix.shape[0]
+    diagonal = torch.diagonal(matrix).clone()
+    
+    off_diagonal = matrix.clone()
+    off_diagonal.fill_diagonal_(0)
+    values, indices = torch.topk(off_diagonal, min(k, n), dim=1)
+
+    sparse = torch.zeros_like(matrix)
+    sparse.scatter_(1, indices, values)
+    sparse = torch.maximum(sparse, sparse.T)
+    sparse[range(n), range(n)] = diagonal
 
-    mask = torch.eye(n, device=device)
+    return blossom_postprocessing(sparse, device)
 
-    A = torch.zeros((2*n, 2*n), device=device)
-    A[:n, :n] = matrix
-    A[n:, n:] = matrix
-    A[:n, n:] = matrix*mask
-    A[n:, :n] = matrix*mask
+def adaptive_postprocessing(matrix: torch.Tensor, device: str, time_budget: float, k: int = 8) -> tuple:
+    """
+    Postprocessing function that chooses the method for each sequence to fit within a time budget.
+    The time of each method is estimated from the length and the number of candidate pairs.
+    The exact blossom matching is used if it is expected to finish within the budget, otherwise it falls back to sparse blossom and then to greedy matching.
 
-    pairing = blossom.max_weight_matching_matrix(A)
+    Parameters:
+    - matrix (torch.Tensor): The matrix to postprocess.
+    - time_budget (float): The time budget in seconds.
+    - k (int): The number of candidate pairs for each base used by the sparse blossom matching.
 
-    y_out = torch.zeros_like(matrix, device=device)
+    Returns:
+    - tuple: The pair vector and the name of the method used.
+    """
+    n = matrix.shape[0]
+    candidates = torch.count_nonzero(torch.triu(matrix, diagonal=1)).item()
 
-    for (i, j) in pairing:
-        if i>n and j>n:
-            continue
-        y_out[i%n, j%n] = 1
-        y_out[j%n, i%n] = 1
+    if POSTPROCESSING_COST['blossom'] * n * candidates <= time_budget:
+        return blossom_postprocessing(matrix, device), 'blossom'
     
-    return y_out
+    if POSTPROCESSING_COST['sparse blossom'] * n * min(candidates, k*n) <= time_budget:
+        return sparse_blossom_postprocessing(matrix, device, k), 'sparse blossom'
+    
+    return greedy_postprocessing(matrix, device), 'greedy'
 
 
 ### HANDLING FILES AND COMMAND LINE INPUT ###
@@ -383,7 +461,7 @@ def pairs_to_db(pairs: list):
     The function uses a stack to keep track of the current level of the bracket structure to handle pseudoknots
 
     Parameters:
-    - pairs (list): The list of pairs to convert.
+    - pairs (list): The list of pairs to convert, with the index of the paired base or -1 for unpaired bases.
 
     Returns:
     - str: The dot-bracket notation.
@@ -425,19 +503,13 @@ def write_ct(outputfile: str, sequence: str, output: torch.Tensor, seq_name: str
    Parameters:
     - outputfile (str): The output file to write to.
     - sequence (str): The sequence that the output was generated from.
-    - output (torch.Tensor): The structure in matrix format.
+    - output (torch.Tensor): The structure as a pair vector.
     - seq_name (str): The name of the sequence.
 
     Returns:
     - None
    """
-   pairs = torch.nonzero(output)
-
-   ct = [[str(i+1), sequence[i], str(i), str(i+2), str(0), str(i+1)] for i in range(len(sequence))]
-   
-   for row, col in pairs:
-       if not row == col:
-        ct[row][4] = str(col.item()+1)
+   ct = [[str(i+1), sequence[i], str(i), str(i+2), str(j+1), str(i+1)] for i, j in enumerate(output.tolist())]
 
    with open(outputfile, 'w') as f:
        f.write(f'{len(sequence)}\tENERGY =\t?\t{seq_name}\n')
@@ -453,19 +525,13 @@ def write_bpseq(outputfile: str, sequence: str, output: torch.Tensor, seq_name:
     Parameters:
     - outputfile (str): The output file to write to.
     - sequence (str): The sequence that the output was generated from.
-    - output (torch.Tensor): The structure in matrix format.
+    - output (torch.Tensor): The structure as a pair vector.
     - seq_name (str): The name of the sequence (not used).
 
     Returns:
     - None
     """
-    pairs = torch.nonzero(output)
-
-    bpseq = [[str(i+1), sequence[i], str(0)] for i in range(len(sequence))]
-    
-    for row, col in pairs:
-        if not row == col:
-            bpseq[row][2] = str(col.item()+1)
+    bpseq = [[str(i+1), sequence[i], str(j+1)] for i, j in enumerate(output.tolist())]
     
     with open(outputfile, 'w') as f:
         f.write(f'Filename: {outputfile}\nOrganism: Unknown\nAccession Number: 000000\nCitation and related information available at?\n')
@@ -479,15 +545,13 @@ def write_dbn(outputfile: str, sequence: str, output: torch.Tensor, seq_name: st
     Parameters:
     - outputfile (str): The output file to write to.
     - sequence (str): The sequence that the output was generated from.
-    - output (torch.Tensor): The structure in matrix format.
+    - output (torch.Tensor): The structure as a pair vector.
     - seq_name (str): The name of the sequence (not used).
 
     Returns:
     - None
     """
-    pairs = torch.nonzero(output)
-
-    dbn = pairs_to_db(pairs)
+    dbn = pairs_to_db(output.tolist())
 
     with open(outputfile, 'w') as f:
         f.write(f">{seq_name}\n{sequence}\n{dbn}\n")
@@ -500,19 +564,13 @@ def write_to_stdout(outputfile: str, sequence: str, output: torch.Tensor, seq_na
     Parameters:
     - outputfile (str): The output file to write to (not used).
     - sequence (str): The sequence that the output was generated from.
-    - output (torch.Tensor): The structure in matrix format.
+    - output (torch.Tensor): The structure as a pair vector.
     - seq_name (str): The name of the sequence.
 
     Returns:
     - None
     """
-    pairs = torch.nonzero(output)
-
-    bpseq = [[str(i+1), sequence[i], str(0)] for i in range(len(sequence))]
-    
-    for row, col in pairs:
-        if not row == col:
-            bpseq[row][2] = str(col.item()+1)
+    bpseq = [[str(i+1), sequence[i], str(j+1)] for i, j in enumerate(output.tolist())]
 
     print(f">{seq_name}\n{sequence}\n")
     print('\n'.join([' '.join(line) for line in bpseq]))
@@ -528,6 +586,8 @@ if __name__ == '__main__':
     argparser.add_argument('-f', '--file', metavar='', type=argparse.FileType('r'), help='Fasta file containing sequence')
     argparser.add_argument('-m', '--multifile', metavar='', type=argparse.FileType('r'), help='Fasta file containing multiple sequences. Output will be written to multiple bpseq files.')
     argparser.add_argument('-o', '--output', metavar='', default=sys.stdout, help='Output file for the secondary structure. Default is stdout. Valid file formats are .dbn, .ct and .bpseq')
+    argparser.add_argument('-p', '--postprocessing', metavar='', default='blossom', choices=['blossom', 'greedy'], help='Post-processing method. "blossom" finds the optimal matching, "greedy" is a faster approximation. Default is blossom')
+    argparser.add_argument('-t', '--time-budget', metavar='', type=float, help='Time budget in seconds for post-processing each sequence. If given, the post-processing method is chosen for each sequence to fit within the budget, falling back from blossom to sparse blossom and greedy matching, and overrides --postprocessing')
 
     args = argparser.parse_args()
 
@@ -549,6 +609,8 @@ if __name__ == '__main__':
         to_outputfile = write_to_stdout
 
 
+    postprocess = {'blossom': blossom_postprocessing, 'greedy': greedy_postprocessing}[args.postprocessing]
+
     #Load model
     device = 'cuda' if torch.cuda.is_available() else 'cpu'
     print('-- Loading model --')
@@ -566,7 +628,11 @@ if __name__ == '__main__':
             input = make_matrix_from_sequence_8(sequence, device=device).to(device)
             output = model(input).squeeze(0).squeeze(0).detach()
             output = mask(output, sequence, device)
-            output = blossom_postprocessing(output, device)
+            if args.time_budget is not None: 
+                output, method = adaptive_postprocessing(output, device, args.time_budget)
+                progress_bar.write(f'{name}: post-processed with {method}')
+            else:
+                output = postprocess(output, device)
             write_bpseq(f'StructUnet_predictions/{name}.bpseq', sequence, output, name)
             progress_bar.update(1)
         progress_bar.close()
@@ -577,7 +643,11 @@ if __name__ == '__main__':
         input = make_matrix_from_sequence_8(sequence, device=device).to(device)
         output = model(input).squeeze(0).squeeze(0).detach()
         output = mask(output, sequence, device)
-        output = blossom_postprocessing(output, device)
+        if args.time_budget is not None: 
+            output, method = adaptive_postprocessing(output, device, args.time_budget)
+            print(f'-- Post-processed with {method} --')
+        else:
+            output = postprocess(output, device)
         total_time = time.time() - start_time
 
         to_outputfile(args.output, sequence, output, name)
@@ -7,10 +7,10 @@ import pandas as pd
 import multiprocessing as mp
 
 
-from utils.model_and_training import evaluate
+from utils.model_and_training import evaluate_pairs
 from utils.plots import plot_timedict
 
-from utils.post_processing import hotknots_postprocessing
+from utils.post_processing import hotknots_postprocessing, matrix_to_pairs
 
 def plot_f1(categories: list, scores: list, mean_times: list, outputfile: str) -> None:
     """
@@ -132,7 +132,7 @@ def process_files(k: int, treshold: float, gap_penalty: float) -> tuple:
         start = time.time()
         pred = hotknots_postprocessing(d[2], d[1], 'cpu', k, gap_penalty=gap_penalty, treshold_prop=treshold)
         times.append(time.time() - start)
-        F1.append(evaluate(pred, d[2]))
+        F1.append(evaluate_pairs(pred, matrix_to_pairs(d[2]))[2])
         progess_bar.update(1)
     
     progess_bar.close()
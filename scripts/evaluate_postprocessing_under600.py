@@ -6,7 +6,7 @@ from tqdm import tqdm
 from collections import namedtuple
 
 from utils import post_processing as post_process
-from utils.model_and_training import evaluate, RNA_Unet
+from utils.model_and_training import evaluate, evaluate_pairs, RNA_Unet
 from utils.plots import violin_plot
 
 from concurrent.futures import ThreadPoolExecutor, as_completed
@@ -15,6 +15,7 @@ def evaluate_output(file: str, treshold: float = 0.5) -> list:
     """
     Evaluate the output of the model using different post-processing methods.
     Runs the evaluation in parallel using a ThreadPoolExecutor.
+    Mfold is not run here, the prediction is returned so Mfold can be run afterwards for all sequences at once.
 
     Args:
     - predicted (torch.Tensor): The predicted output of the model.
@@ -23,6 +24,10 @@ def evaluate_output(file: str, treshold: float = 0.5) -> list:
 
     Returns:
     - results (list): The results of the evaluation.
+    - job (tuple): The masked predicted matrix as a NumPy array and the sequence to run Mfold on.
+    - target_pairs (np.ndarray): The target pair vector.
+
+    The matrix and the pairs are returned as NumPy arrays, since tensors sent between processes keep a file descriptor open for as long as they are kept.
     """
     data = pickle.load(open(file, 'rb'))
     
@@ -34,16 +39,25 @@ def evaluate_output(file: str, treshold: float = 0.5) -> list:
     
     results = list(evaluate((predicted >= treshold).float(), target, device=device)) #Evaluate binary raw output
 
-    precited = post_process.prepare_input(predicted, sequence, device)
+    predicted = post_process.prepare_input(predicted, sequence, device)
 
     results.extend(list(evaluate((predicted >= treshold).float(), target, device=device))) #Evaluate binary masked output
 
-    functions = [post_process.argmax_postprocessing, post_process.blossom_postprocessing, post_process.blossom_weak, post_process.Mfold_param_postprocessing]
+    functions = [post_process.argmax_postprocessing, post_process.blossom_postprocessing, post_process.blossom_weak, post_process.greedy_postprocessing, post_process.nussinov_postprocessing]
+
+    target_pairs = post_process.matrix_to_pairs(target)
 
+    outputs = {}
     for func in functions:
-        results.extend(evaluate(func(predicted, sequence, device), target, device))
+        outputs[func] = func(predicted, sequence, device)
+        results.extend(evaluate_pairs(outputs[func], target_pairs))
     
-    return [data.family, data.length] + results
+    #Relative weight lost by using the greedy matching instead of the exact matching found by blossom
+    exact_weight = post_process.matching_weight(predicted, outputs[post_process.blossom_weak])
+    greedy_weight = post_process.matching_weight(predicted, outputs[post_process.greedy_postprocessing])
+    results.append(1 - greedy_weight/exact_weight if exact_weight > 0 else 0.0)
+    
+    return [data.family, data.length] + results, (predicted.numpy(), sequence), target_pairs.numpy()
 
 
 
@@ -60,11 +74,12 @@ if __name__ == "__main__":
     RNA = namedtuple('RNA', 'input output length family name sequence')
     file_list = pickle.load(open('data/valid_under_600.pkl', 'rb'))
     
-    funcs = ['No post-processing', 'Only mask', 'Argmax', 'Blossom w/ self-loops', 'Blossom', 'Mfold']
+    funcs = ['No post-processing', 'Only mask', 'Argmax', 'Blossom w/ self-loops', 'Blossom', 'Greedy', 'Nussinov MEA', 'Mfold']
     
     # Evaluate the model
-    columns = ['family', 'length'] + [f'{name}_{metric}' for name in funcs for metric in ['precision', 'recall', 'f1']] 
+    columns = ['family', 'length'] + [f'{name}_{metric}' for name in funcs for metric in ['precision', 'recall', 'f1']] + ['Greedy_weight_gap']
     df = pd.DataFrame(index = range(len(file_list)), columns = columns)
+    mfold_columns = [f'Mfold_{metric}' for metric in ['precision', 'recall', 'f1']]
     
     print("--- Evaluating ---")
 
@@ -74,9 +89,12 @@ if __name__ == "__main__":
     shared_counter = multiprocessing.Value('i', 0)
     
     #Run processes
+    mfold_jobs, target_pairs = [], []
     with tqdm(total=len(file_list)) as pbar:
-        for i, result in enumerate(pool.imap_unordered(evaluate_output, file_list)):
-            df.loc[i] = result
+        for i, (result, job, target) in enumerate(pool.imap_unordered(evaluate_output, file_list)):
+            df.loc[i, df.columns.drop(mfold_columns)] = result
+            mfold_jobs.append(job)
+            target_pairs.append(target)
             with shared_counter.get_lock():
                 shared_counter.value += 1
             pbar.update()
@@ -85,6 +103,13 @@ if __name__ == "__main__":
     pool.close()
     pool.join()
 
+    #Mfold is by far the slowest method, so it is run on a pool where each worker keeps its Mfold engine and the longest sequences are started first
+    print("--- Running Mfold ---")
+    with tqdm(total=len(file_list)) as pbar:
+        for i, pairs, _ in post_process.Mfold_param_postprocessing_many(mfold_jobs, processes=num_processes):
+            df.loc[i, mfold_columns] = evaluate_pairs(pairs, torch.from_numpy(target_pairs[i]))
+            pbar.update()
+
     print("--- Evaluation done ---")
     print("--- Saving results ---")
     
@@ -104,6 +129,18 @@ if __name__ == "__main__":
     
     results.to_csv('results/average_scores_postprocess_under600.csv')
 
+    # Compare the greedy approximation to the exact matching
+    gap = df['Greedy_weight_gap'].apply(pd.to_numeric, errors='coerce')
+    f1_delta = df['Greedy_f1'].apply(pd.to_numeric, errors='coerce') - df['Blossom_f1'].apply(pd.to_numeric, errors='coerce')
+    greedy = pd.DataFrame({'weight_gap': [gap.mean(), gap.median(), gap.max()], 
+                           'f1_delta': [f1_delta.mean(), f1_delta.median(), f1_delta.min()]}, index = ['mean', 'median', 'worst'])
+    greedy.to_csv('results/greedy_vs_blossom_under600.csv')
+    print(f"Greedy matching: average weight gap {gap.mean():.4f}, average F1 difference {f1_delta.mean():.4f}")
+
+    # Compare the nested MEA structure to the exact matching, which can have pseudoknots
+    nested_delta = df['Nussinov MEA_f1'].apply(pd.to_numeric, errors='coerce') - df['Blossom_f1'].apply(pd.to_numeric, errors='coerce')
+    print(f"Nussinov MEA: average F1 difference to blossom {nested_delta.mean():.4f}")
+
     print("--- Results saved ---")
 
 
@@ -9,8 +9,8 @@ from tqdm import tqdm
 
 
 
-from utils.model_and_training import RNA_Unet, evaluate
-from utils.post_processing import blossom_weak, prepare_input
+from utils.model_and_training import RNA_Unet, evaluate_pairs
+from utils.post_processing import blossom_weak, prepare_input, matrix_to_pairs, postprocess_many
 
 
 def has_pk(pairings: np.ndarray) -> bool:
@@ -34,21 +34,15 @@ def has_pk(pairings: np.ndarray) -> bool:
 
 def output_to_bpseq(output: torch.Tensor, sequence: str) -> str: 
     """
-    Converts the output of the model to a bpseq file.
+    Converts a structure to a bpseq file.
 
     Parameters:
-    - output (torch.Tensor): The output of the model.
+    - output (torch.Tensor): The structure as a pair vector with -1 for unpaired bases.
 
     Returns:
     - str: The bpseq file.
     """
-    pairs = torch.nonzero(output)
-
-    bpseq = [[str(i+1), sequence[i], str(0)] for i in range(len(sequence))]
-
-    for row, col in pairs: 
-        if not row == col:
-            bpseq[row][2] = str(col.item()+1)
+    bpseq = [[str(i+1), sequence[i], str(j+1)] for i, j in enumerate(output.tolist())]
 
     return '\n'.join([' '.join(line) for line in bpseq])
 
@@ -211,14 +205,19 @@ def predict(examples: dict) -> None:
     """
 
     progress_bar = tqdm(total=len(examples), unit='example', desc='Predicting structures', file=sys.stdout)
+
+    items = list(examples.values())
+
+    def predict_all():
+        for item in items:
+            input = item['input'].unsqueeze(0).to(device)
+            sequence = item['sequence']
+            output = model(input).squeeze(0).squeeze(0).detach()
+            yield prepare_input(output, sequence, device), sequence
     
-    for _, item in examples.items():
-        input = item['input'].unsqueeze(0).to(device)
-        sequence = item['sequence']
-        output = model(input).squeeze(0).squeeze(0).detach()
-        output = prepare_input(output.squeeze(0).squeeze(0).detach(), sequence, device)
-        output = blossom_weak(output, sequence, device)
-        item['predicted'] = output
+    #Post-process on a process pool while the next examples are predicted
+    for index, output, _ in postprocess_many(predict_all(), blossom_weak, ordered=False):
+        items[index]['predicted'] = output
         progress_bar.update(1)
     
     progress_bar.close()
@@ -239,7 +238,7 @@ def save_examples(examples: dict) -> None:
             file.write(output_to_bpseq(example['predicted'], example['sequence']))
         
         with open(f'steps/examples/{family}_true.bpseq', 'w') as file: 
-            file.write(output_to_bpseq(example['output'], example['sequence']))
+            file.write(output_to_bpseq(matrix_to_pairs(example['output']), example['sequence']))
 
 
 
@@ -259,7 +258,7 @@ def record_f1_scores(examples: dict) -> None:
     progress_bar = tqdm(total=len(examples), unit='example', desc='Recording F1 scores', file=sys.stdout)
     
     for family, example in examples.items(): 
-        precision, recall, F1 = evaluate(example['predicted'], example['output'], device=device)
+        precision, recall, F1 = evaluate_pairs(example['predicted'], matrix_to_pairs(example['output']))
         scores.append({'example': family, 'family': example['family'], 'length': len(example['sequence']), 'precision': precision, 'recall': recall, 'F1': F1, 'file': example['name']})
         progress_bar.update(1)
 
@@ -5,7 +5,7 @@ from tqdm import tqdm
 from collections import namedtuple
 
 from utils.model_and_training import RNA_Unet
-from utils.post_processing import prepare_input, blossom_weak
+from utils.post_processing import prepare_input, blossom_weak, pairs_to_matrix, postprocess_many
 
 if __name__ == '__main__': 
     device = 'cuda' if torch.cuda.is_available() else 'cpu'
@@ -26,24 +26,25 @@ if __name__ == '__main__':
     print('-- Predicting --')
 
     progress_bar = tqdm(total=len(data), unit='sequence')
+
+    names = [os.path.basename(file) for file in data]
+
+    def predict_all():
+        for file in data:
+            #Prepare data
+            file_data = pickle.load(open(file, 'rb'))
+            sequence = file_data.sequence
+            input = file_data.input.unsqueeze(0).to(device)
+            file_data = None #Clear memory
+
+            #Predict
+            output = model(input).squeeze(0).squeeze(0).detach()
+            yield prepare_input(output, sequence, device), sequence
     
-    for file in data:
-        #Prepare data
-        name = os.path.basename(file)
-        file_data = pickle.load(open(file, 'rb'))
-        sequence = file_data.sequence
-        input = file_data.input.unsqueeze(0).to(device)
-        file_data = None #Clear memory
-
-        #Predict
-        output = model(input).squeeze(0).squeeze(0).detach()
-
-        #Post-process
-        output = prepare_input(output, sequence, device)
-        output = blossom_weak(output, sequence, device)
-
-        #Save results
-        pickle.dump(output, open(f'results_RNAUnet/{name}', 'wb'))
+    #Post-process on a process pool while the next sequences are predicted
+    for index, output, _ in postprocess_many(predict_all(), blossom_weak, ordered=False):
+        #Save results as a matrix to be compared with the other methods
+        pickle.dump(pairs_to_matrix(output, device), open(f'results_RNAUnet/{names[index]}', 'wb'))
 
         progress_bar.update(1)
     
@@ -9,7 +9,7 @@ from collections import namedtuple
 
 from utils.prepare_data import make_matrix_from_sequence_8
 from utils.model_and_training import RNA_Unet
-from utils.post_processing import prepare_input, blossom_weak
+from utils.post_processing import prepare_input, blossom_weak, pairs_to_matrix, postprocess_many
 from utils.plots import plot_timedict
 
 def format_time(seconds: float) -> str:
@@ -27,32 +27,48 @@ def format_time(seconds: float) -> str:
     minutes, seconds = divmod(remainder, 60)
     return '{:02d}:{:02d}:{:02d}'.format(hours, minutes, seconds)
 
-def predict(sequence: str, name: str) -> tuple:
+def predict(sequence: str) -> tuple:
     """
-    Uses the model to predict the structure of a given sequence.
-    Saves the result and returns the time it took for the prediction.
-    The time is split into the time without post-processing, the time for only prediction, the time without conversion and the total time.
+    Uses the model to predict the structure of a given sequence, without post-processing.
+    Returns the masked output and the time it took for the prediction.
+    The time is split into the time without post-processing, the time for only prediction and the time for masking.
 
     Parameters:
     - sequence (str): The sequence to predict.
-    - name (str): The name of the sequence.
 
     Returns:
-    - tuple: The time it took for the prediction in the order (time without post-processing, time for only prediction, time without conversion, total time)
+    - tuple: The masked output and the times in the order (time without post-processing, time for only prediction, time for masking)
     """
     start1 = time.time()
     input = make_matrix_from_sequence_8(sequence, device=device).unsqueeze(0).to(device)
     start2 = time.time()
     output = model(input).squeeze(0).squeeze(0).detach() 
-    time1 = time.time()-start1 #Time without post-processing
-    time2 = time.time()-start2 #Time for only prediction
+    end_time = time.time()
+    time1 = end_time-start1 #Time without post-processing
+    time2 = end_time-start2 #Time for only prediction
     output = prepare_input(output, sequence, device)
-    output = blossom_weak(output, sequence, device)
-    time3 = time.time()-start2 #Total time without conversion
-    time4 = time.time()-start1 #Total time
-    if device == 'cpu':
-        pickle.dump(output, open(f'steps/RNA_Unet/{name}', 'wb'))
-    return time1, time2, time3, time4
+    time_mask = time.time()-end_time #Time for masking
+    return output, time1, time2, time_mask
+
+def predict_all(files: list, names: list, timings: list):
+    """
+    Predicts the structures of all files and yields the outputs to be post-processed.
+    The names, lengths and times of the predictions are appended to 'names' and 'timings'.
+
+    Parameters:
+    - files (list): The files to predict.
+    - names (list): List to append the names of the files to.
+    - timings (list): List to append the length and the times of each prediction to.
+
+    Returns:
+    - generator: Tuples of (masked output, sequence).
+    """
+    for file in files:
+        sequence = pickle.load(open(file, 'rb')).sequence
+        output, time1, time2, time_mask = predict(sequence)
+        names.append(os.path.basename(file))
+        timings.append((len(sequence), time1, time2, time_mask))
+        yield output, sequence
 
 if __name__ == '__main__':
     device = 'cuda' if torch.cuda.is_available() else 'cpu'
@@ -80,15 +96,17 @@ if __name__ == '__main__':
     
     #Predict for all sequences and save the results and times
     #Time all steps of prediction, with conversion to matrix, prediction and post-processing
-    for file in test_data:
-        name = os.path.basename(file)
-        sequence = pickle.load(open(file, 'rb')).sequence
-        time1, time2, time3, time4 = predict(sequence, name)
+    #Post-processing is run in this process, so the times are not inflated by workers competing with the prediction for the CPU
+    names, timings = [], []
+    for index, output, time_postprocess in postprocess_many(predict_all(test_data, names, timings), blossom_weak, processes=1):
+        length, time1, time2, time_mask = timings[index]
         times_wo_postprocessing.append(time1)
         times_only_predict.append(time2)
-        times_wo_conversion.append(time3)
-        times_total.append(time4)
-        lengths.append(len(sequence))
+        times_wo_conversion.append(time2 + time_mask + time_postprocess)
+        times_total.append(time1 + time_mask + time_postprocess)
+        lengths.append(length)
+        if device == 'cpu':
+            pickle.dump(pairs_to_matrix(output, device), open(f'steps/RNA_Unet/{names[index]}', 'wb'))
         
         progress_bar.update(1)
 
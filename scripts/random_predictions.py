@@ -7,8 +7,8 @@ from functools import partial
 import pandas as pd
 import numpy as np
 
-from utils.model_and_training import evaluate
-from utils.post_processing import prepare_input, blossom_weak
+from utils.model_and_training import evaluate_pairs
+from utils.post_processing import prepare_input, blossom_weak, matrix_to_pairs
 
 def has_pk(pairings: np.ndarray) -> bool:
     """
@@ -47,21 +47,20 @@ def calculate_weighted_f1(lengths: list, f1s: list) -> float:
     return sum(weighted_f1s)
 
 
-def scores_pseudoknot(predicted: np.ndarray, target_pk: bool) -> np.ndarray:
+def scores_pseudoknot(predicted: torch.Tensor, target_pk: bool) -> np.ndarray:
     """
     Returns the [TN, FN, FP, TP] for pseudoknots in the predicted and target structure.
 
     Parameters:
-    - predicted (np.ndarray): The predicted structure as a NumPy array.
-    - target (np.ndarray): The target structure as a NumPy array.
+    - predicted (torch.Tensor): The predicted structure as a pair vector with -1 for unpaired bases.
+    - target_pk (bool): True if the target structure has a pseudoknot.
 
     Returns:
     - np.ndarray: The [TN, FN, FP, TP] for pseudoknots in the predicted and target structure.
     """
     pk_score = np.array([0, 0, 0, 0])
 
-    predicted = predicted.squeeze()
-    i = has_pk(np.argmax(predicted, axis=1))
+    i = has_pk(torch.where(predicted < 0, torch.arange(len(predicted)), predicted))
     j = target_pk
     pk_score[i*2+j] += 1
 
@@ -105,8 +104,9 @@ def evaluate_random_prediction(file, dataset, pseudoknots, lock):
 
     predicted = make_random_prediction(data.sequence)
 
-    results.extend(evaluate(predicted, target, device))
-    results.extend(evaluate(predicted, target, device, allow_shift=True))
+    target_pairs = matrix_to_pairs(target)
+    results.extend(evaluate_pairs(predicted, target_pairs))
+    results.extend(evaluate_pairs(predicted, target_pairs, allow_shift=True))
 
     sequence_pk = scores_pseudoknot(predicted, target_pk) #Check if pseudoknots are present in the predicted and target structure
     with lock:
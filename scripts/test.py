@@ -1,9 +1,24 @@
 import utils.prepare_data as prep
 import scripts.utils.model_and_training as train
 import utils.post_processing as post_process
+import utils.blossom as blossom
+import utils.Mfold1 as Mfold1
+import utils.Mfold2 as Mfold2
+import utils.hotknots as hotknots
 
 import numpy as np
-import torch, pytest, os
+import torch, pytest, os, sys, inspect, pickle, ast, resource
+
+#The scripts in other_methods import the runner as a top-level module
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'other_methods'))
+import other_methods.nussinov as nussinov
+import other_methods.cnnfold_predict as cnnfold
+import runner
+
+from utils.dp_tables import DPTable
+
+from concurrent.futures import ThreadPoolExecutor
+from collections import namedtuple
 
 ### FUNCTIONS USED IN TESTS ###
 @pytest.fixture
@@ -49,6 +64,93 @@ def make_ct_file_1(tmpdir):
     return str(ct_file_path)
 
 
+@pytest.fixture
+def simfold_stub(tmpdir):
+    """
+    Stand-in for the SimFold executable, that pairs the outermost bases that are allowed to pair and logs its calls
+    """
+    stub = tmpdir.join("simfold")
+    stub.write(f"""#!{sys.executable}
+import sys
+sequence, constraints = sys.argv[sys.argv.index('-s')+1], sys.argv[sys.argv.index('-r')+1]
+with open('calls.txt', 'a') as f:
+    f.write(f'{{sequence}} {{constraints}}\\n')
+
+structure = list(constraints.replace('_', '.'))
+i, j = 0, len(sequence)-1
+while j-i > 3:
+    if constraints[i] != '_': i += 1
+    elif constraints[j] != '_': j -= 1
+    elif sequence[i]+sequence[j] in {{'AU', 'UA', 'CG', 'GC', 'GU', 'UG'}}:
+        structure[i], structure[j] = '(', ')'
+        i, j = i+1, j-1
+    else: i += 1
+print(sequence, constraints, '0.0', ''.join(structure))
+""")
+    stub.chmod(0o755)
+    return str(stub), str(tmpdir)
+
+
+@pytest.fixture
+def hotknots_input():
+    """
+    Makes the input of the HotKnots tests, which is the first bases of a sequence with several stems and a random symmetric matrix made with the given seed
+    """
+    def make(seed: int, length: int) -> tuple:
+        torch.manual_seed(seed)
+        sequence = 'GGGGCAAAAGCCCCAUAGGCGAAAACGCCUAGGAUCCAUGCAAGCAUGGAUCC'[:length]
+        matrix = torch.rand((length, length))*3
+        return sequence, (matrix + matrix.T)/2
+    return make
+
+
+@pytest.fixture
+def predictor_stub(tmpdir):
+    """
+    Stand-in for an external structure predictor, that pairs the first and last base and logs its calls.
+    Sequences starting with 'T' sleep, and sequences starting with 'F' fail the first time they are predicted
+    """
+    stub = tmpdir.join("predictor")
+    stub.write(f"""#!{sys.executable}
+import sys, os, time
+sequence = open(sys.argv[1]).read()
+with open('calls.txt', 'a') as f:
+    f.write(sequence + '\\n')
+
+if sequence[0] == 'T':
+    time.sleep(10)
+if sequence[0] == 'F' and not os.path.exists(sequence):
+    open(sequence, 'w').close()
+    sys.exit('Failed')
+print(len(sequence)-1, *range(1, len(sequence)-1), 0)
+""")
+    stub.chmod(0o755)
+
+    files = []
+    for i, sequence in enumerate(['GAAAC', 'FAAAAC', 'TAAAC', 'GAAAC']):
+        files.append(str(tmpdir.join(f'{i}.pkl')))
+        pickle.dump(RNA(None, None, len(sequence), None, str(i), sequence), open(files[-1], 'wb'))
+    return str(stub), files, str(tmpdir)
+
+
+@pytest.fixture
+def ufold_features():
+    """
+    The input featurization of ufold_predict.py. The script imports the UFold repository, so only its constants and the featurization functions are loaded from the source
+    """
+    path = os.path.join(os.path.dirname(__file__), '..', 'other_methods', 'ufold_predict.py')
+    tree = ast.parse(open(path).read())
+    #The constants are the statements from BASES to the first function
+    start = next(i for i, node in enumerate(tree.body) if isinstance(node, ast.Assign) and ast.unparse(node.targets[0]) == 'BASES')
+    end = next(i for i, node in enumerate(tree.body) if isinstance(node, ast.FunctionDef))
+    functions = [node for node in tree.body if isinstance(node, ast.FunctionDef) and node.name in ['get_cut_len', 'creatmat', 'featurize']]
+    tree.body = tree.body[start:end] + functions
+    namespace = {'np': np, 'torch': torch}
+    exec(compile(tree, path, 'exec'), namespace)
+    return namespace
+
+RNA = namedtuple('RNA', 'input output length family name sequence')
+
 
 ### FUNCTIONS FOR PREPARING/HANDLING DATA
 def test_read_ct(make_ct_file_1):
@@ -226,37 +328,37 @@ def test_all_paired():
     sequence = 'AUCGAUCGAUCGAUCGAUCGAUCGAUCGAUCGAUCGAUCGAUCGAUCGAU'
 
     #Row wise
-    assert torch.all(torch.any(post_process.argmax_postprocessing(matrix1, 'sequence', 'cpu'), axis=1))
-    assert torch.all(torch.any(post_process.blossom_postprocessing(matrix1, 'sequence', 'cpu'), axis=1))
-    assert torch.all(torch.any(post_process.blossom_weak(matrix1, 'sequence', 'cpu'), axis=1)) 
-    assert torch.all(torch.any(post_process.Mfold_constrain_postprocessing(matrix1, sequence, 'cpu'), axis=1)) 
-    assert torch.all(torch.any(post_process.Mfold_param_postprocessing(matrix1, sequence, 'cpu'), axis=1)) 
-
-    assert torch.all(torch.any(post_process.argmax_postprocessing(matrix2, 'sequence', 'cpu'), axis=1))
-    assert torch.all(torch.any(post_process.blossom_postprocessing(matrix2, 'sequence', 'cpu'), axis=1))
-    assert torch.all(torch.any(post_process.blossom_weak(matrix2, 'sequence', 'cpu'), axis=1)) 
-    assert torch.all(torch.any(post_process.Mfold_constrain_postprocessing(matrix2, sequence, 'cpu'), axis=1))
-    assert torch.all(torch.any(post_process.Mfold_param_postprocessing(matrix2, sequence, 'cpu'), axis=1))
+    assert torch.all(torch.any(post_process.pairs_to_matrix(post_process.argmax_postprocessing(matrix1, 'sequence', 'cpu'), 'cpu'), axis=1))
+    assert torch.all(torch.any(post_process.pairs_to_matrix(post_process.blossom_postprocessing(matrix1, 'sequence', 'cpu'), 'cpu'), axis=1))
+    assert torch.all(torch.any(post_process.pairs_to_matrix(post_process.blossom_weak(matrix1, 'sequence', 'cpu'), 'cpu'), axis=1)) 
+    assert torch.all(torch.any(post_process.pairs_to_matrix(post_process.Mfold_constrain_postprocessing(matrix1, sequence, 'cpu'), 'cpu'), axis=1)) 
+    assert torch.all(torch.any(post_process.pairs_to_matrix(post_process.Mfold_param_postprocessing(matrix1, sequence, 'cpu'), 'cpu'), axis=1)) 
+
+    assert torch.all(torch.any(post_process.pairs_to_matrix(post_process.argmax_postprocessing(matrix2, 'sequence', 'cpu'), 'cpu'), axis=1))
+    assert torch.all(torch.any(post_process.pairs_to_matrix(post_process.blossom_postprocessing(matrix2, 'sequence', 'cpu'), 'cpu'), axis=1))
+    assert torch.all(torch.any(post_process.pairs_to_matrix(post_process.blossom_weak(matrix2, 'sequence', 'cpu'), 'cpu'), axis=1)) 
+    assert torch.all(torch.any(post_process.pairs_to_matrix(post_process.Mfold_constrain_postprocessing(matrix2, sequence, 'cpu'), 'cpu'), axis=1))
+    assert torch.all(torch.any(post_process.pairs_to_matrix(post_process.Mfold_param_postprocessing(matrix2, sequence, 'cpu'), 'cpu'), axis=1))
 
     #Column wise (without argmax)
-    assert torch.all(torch.any(post_process.blossom_postprocessing(matrix1, 'sequence', 'cpu'), axis=0))
-    assert torch.all(torch.any(post_process.blossom_weak(matrix1, 'sequence', 'cpu'), axis=0)) 
-    assert torch.all(torch.any(post_process.Mfold_constrain_postprocessing(matrix1, sequence, 'cpu'), axis=0)) 
-    assert torch.all(torch.any(post_process.Mfold_param_postprocessing(matrix1, sequence, 'cpu'), axis=0)) 
+    assert torch.all(torch.any(post_process.pairs_to_matrix(post_process.blossom_postprocessing(matrix1, 'sequence', 'cpu'), 'cpu'), axis=0))
+    assert torch.all(torch.any(post_process.pairs_to_matrix(post_process.blossom_weak(matrix1, 'sequence', 'cpu'), 'cpu'), axis=0)) 
+    assert torch.all(torch.any(post_process.pairs_to_matrix(post_process.Mfold_constrain_postprocessing(matrix1, sequence, 'cpu'), 'cpu'), axis=0)) 
+    assert torch.all(torch.any(post_process.pairs_to_matrix(post_process.Mfold_param_postprocessing(matrix1, sequence, 'cpu'), 'cpu'), axis=0)) 
 
-    assert torch.all(torch.any(post_process.blossom_postprocessing(matrix2, 'sequence', 'cpu'), axis=0)) 
-    assert torch.all(torch.any(post_process.blossom_weak(matrix2, 'sequence', 'cpu'), axis=0)) 
-    assert torch.all(torch.any(post_process.Mfold_constrain_postprocessing(matrix2, sequence, 'cpu'), axis=0))
-    assert torch.all(torch.any(post_process.Mfold_param_postprocessing(matrix2, sequence, 'cpu'), axis=0))
+    assert torch.all(torch.any(post_process.pairs_to_matrix(post_process.blossom_postprocessing(matrix2, 'sequence', 'cpu'), 'cpu'), axis=0)) 
+    assert torch.all(torch.any(post_process.pairs_to_matrix(post_process.blossom_weak(matrix2, 'sequence', 'cpu'), 'cpu'), axis=0)) 
+    assert torch.all(torch.any(post_process.pairs_to_matrix(post_process.Mfold_constrain_postprocessing(matrix2, sequence, 'cpu'), 'cpu'), axis=0))
+    assert torch.all(torch.any(post_process.pairs_to_matrix(post_process.Mfold_param_postprocessing(matrix2, sequence, 'cpu'), 'cpu'), axis=0))
 
 def test_argmax(): 
     matrix1 = torch.rand((50, 50))
 
-    assert isinstance(post_process.argmax_postprocessing(matrix1, 'sequence', 'cpu'), torch.Tensor) #Test that matrix is returned
-    assert torch.nonzero(post_process.argmax_postprocessing(matrix1, 'sequence', 'cpu')).size()[0] == 50 #Test correct number of values is in the matrix
+    assert isinstance(post_process.pairs_to_matrix(post_process.argmax_postprocessing(matrix1, 'sequence', 'cpu'), 'cpu'), torch.Tensor) #Test that matrix is returned
+    assert torch.nonzero(post_process.pairs_to_matrix(post_process.argmax_postprocessing(matrix1, 'sequence', 'cpu'), 'cpu')).size()[0] == 50 #Test correct number of values is in the matrix
 
     # Test that the functionality is correct
-    result = post_process.argmax_postprocessing(matrix1, 'sequence', 'cpu')
+    result = post_process.pairs_to_matrix(post_process.argmax_postprocessing(matrix1, 'sequence', 'cpu'), 'cpu')
     for i in range(50):
         for j in range(50):
             print(result[i, j], end=' ')
@@ -271,15 +373,176 @@ def test_argmax():
 def test_blossum():
     matrix1 = torch.rand((50, 50))
 
-    result1 = post_process.blossom_postprocessing(matrix1, 'sequence', 'cpu')
-    result2 = post_process.blossom_weak(matrix1, 'sequence', 'cpu')
+    result1 = post_process.pairs_to_matrix(post_process.blossom_postprocessing(matrix1, 'sequence', 'cpu'), 'cpu')
+    result2 = post_process.pairs_to_matrix(post_process.blossom_weak(matrix1, 'sequence', 'cpu'), 'cpu')
     assert torch.allclose(result1, result1.T)
     assert torch.allclose(result2, result2.T)
 
     matrix = torch.zeros((3, 3))
-    result = post_process.blossom_weak(matrix, 'sequence', 'cpu')
+    result = post_process.pairs_to_matrix(post_process.blossom_weak(matrix, 'sequence', 'cpu'), 'cpu')
     assert torch.equal(result, torch.eye(3))
 
+def test_blossom_unpaired(): 
+    sequence = 'AUCGAUCGAUCGAUCGAUCGAUCGAUCGAUCGAUCGAUCGAUCGAUCGAU'
+    matrix = post_process.prepare_input(torch.rand((50, 50)), sequence, 'cpu')
+    n = matrix.shape[0]
+
+    #Reference: copy the matrix to a 2Nx2N graph where each base can pair with its copy
+    A = torch.zeros((2*n, 2*n))
+    A[:n, :n] = A[n:, n:] = matrix
+    A[:n, n:] = A[n:, :n] = matrix*torch.eye(n)
+
+    doubled = torch.zeros_like(matrix)
+    for (i, j) in blossom.max_weight_matching_matrix(A):
+        if i >= n and j >= n:
+            continue
+        doubled[i%n, j%n] = doubled[j%n, i%n] = 1
+
+    assert torch.equal(doubled, post_process.pairs_to_matrix(post_process.blossom_postprocessing(matrix, sequence, 'cpu'), 'cpu'))
+
+def test_greedy(): 
+    matrix = torch.rand((50, 50))
+    matrix = (matrix + matrix.T) / 2
+
+    pairs = post_process.greedy_postprocessing(matrix, 'sequence', 'cpu')
+    result = post_process.pairs_to_matrix(pairs, 'cpu')
+    assert torch.allclose(result, result.T)
+    assert torch.all(result.sum(dim=1) == 1) #Every base is in exactly one pair or unpaired
+
+    #Greedy matching has at least half the weight of the maximum weight matching
+    exact = post_process.matching_weight(matrix, post_process.blossom_weak(matrix, 'sequence', 'cpu'))
+    approx = post_process.matching_weight(matrix, pairs)
+    assert 0.5 * exact <= approx <= exact + 1e-4
+
+    #Local swaps only increase the weight, and the number of rounds is bounded
+    improved = post_process.matching_weight(matrix, post_process.greedy_postprocessing(matrix, 'sequence', 'cpu', local_search=True))
+    assert approx - 1e-4 <= improved <= exact + 1e-4
+    assert blossom.greedy_matching_matrix(matrix, local_search=True, max_rounds=0) == blossom.greedy_matching_matrix(matrix)
+
+    matrix = torch.zeros((3, 3))
+    result = post_process.pairs_to_matrix(post_process.greedy_postprocessing(matrix, 'sequence', 'cpu'), 'cpu')
+    assert torch.equal(result, torch.eye(3))
+
+def test_nussinov(): 
+    #Nested structure on a stem of three pairs where a crossing pair is stronger than one of the nested ones
+    matrix = torch.eye(10) * 0.2
+    for i, j, value in [(0, 9, 0.9), (1, 8, 0.8), (2, 7, 0.4), (3, 6, 0.9), (5, 9, 0.95)]:
+        matrix[i, j] = matrix[j, i] = value
+
+    pairs = post_process.nussinov_postprocessing(matrix, 'sequence', 'cpu')
+    assert pairs.tolist() == [9, 8, 7, 6, -1, -1, 3, 2, 1, 0]
+
+    #Weak pairs are left out when basepairs have a low weight
+    pairs = post_process.nussinov_postprocessing(matrix, 'sequence', 'cpu', gamma=0.3)
+    assert pairs.tolist() == [9, 8, -1, 6, -1, -1, 3, -1, 1, 0]
+
+    #Only pairs within the span are allowed
+    pairs = post_process.nussinov_postprocessing(matrix, 'sequence', 'cpu', span=4)
+    assert pairs.tolist() == [-1, -1, -1, -1, -1, 9, -1, -1, -1, 5]
+
+    #The banded table gives the same result as the full table when the span covers all pairs
+    matrix = torch.rand((40, 40))
+    matrix = post_process.prepare_input(matrix, 'GGACUACGUAGCAUGCAUGCGAUCGAUCGUAGCUAGCUAC', 'cpu')
+    assert torch.equal(post_process.nussinov_postprocessing(matrix, 'sequence', 'cpu'), post_process.nussinov_postprocessing(matrix, 'sequence', 'cpu', span=39))
+
+def test_pairs(): 
+    pairs = torch.tensor([3, -1, 4, 0, 2, -1])
+
+    matrix = post_process.pairs_to_matrix(pairs, 'cpu')
+    assert torch.equal(matrix, matrix.T)
+    assert torch.all(matrix.sum(dim=1) == 1)
+    assert matrix[1, 1] == 1 and matrix[0, 3] == 1 and matrix[2, 4] == 1
+    assert torch.equal(post_process.matrix_to_pairs(matrix), pairs)
+    assert torch.equal(post_process.matrix_to_pairs(post_process.pairs_to_matrix(pairs, 'cpu', unpaired=False)), pairs)
+
+    assert torch.equal(post_process.matching_to_pairs({(0, 3), (4, 2), (1, 1)}, 6, 'cpu'), pairs)
+
+def test_adaptive(): 
+    sequence = 'AUCGAUCGAUCGAUCGAUCGAUCGAUCGAUCGAUCGAUCGAUCGAUCGAU'
+    matrix = post_process.prepare_input(torch.rand((50, 50)), sequence, 'cpu')
+
+    pairs, method = post_process.adaptive_postprocessing(matrix, sequence, 'cpu')
+    assert method == 'blossom'
+    assert torch.equal(pairs, post_process.blossom_postprocessing(matrix, sequence, 'cpu'))
+
+    budget = post_process.estimate_postprocessing_time(matrix, 'sparse blossom', k=2)
+    pairs, method = post_process.adaptive_postprocessing(matrix, sequence, 'cpu', time_budget=budget, k=2)
+    assert method == 'sparse blossom'
+    assert torch.equal(pairs, post_process.sparse_blossom_postprocessing(matrix, sequence, 'cpu', k=2))
+
+    pairs, method = post_process.adaptive_postprocessing(matrix, sequence, 'cpu', time_budget=0)
+    assert method == 'greedy'
+    paired = torch.nonzero(pairs >= 0).flatten()
+    assert torch.equal(pairs[pairs[paired]], paired) #Pairs are symmetric
+
+    #With all candidate pairs kept, the sparse matching is the exact matching
+    assert torch.equal(post_process.sparse_blossom_postprocessing(matrix, sequence, 'cpu', k=50), post_process.blossom_postprocessing(matrix, sequence, 'cpu'))
+
+def test_postprocess_many(): 
+    sequence = 'AUCGAUCGAUCGAUCGAUCGAUCGAUCGAUCGAUCGAUCGAUCGAUCGAU'
+    jobs = [(post_process.prepare_input(torch.rand((50, 50)), sequence, 'cpu'), sequence) for _ in range(6)]
+    expected = [post_process.blossom_weak(matrix, sequence, 'cpu') for matrix, sequence in jobs]
+
+    results = list(post_process.postprocess_many(jobs, post_process.blossom_weak, processes=2))
+    assert [index for index, _, _ in results] == list(range(6)) #Results are returned in order
+    assert all(torch.equal(pairs, expected[index]) for index, pairs, _ in results)
+
+    results = post_process.postprocess_many(jobs, post_process.blossom_weak, processes=2, ordered=False)
+    assert all(torch.equal(pairs, expected[index]) for index, pairs, _ in results)
+
+    #Only a bounded number of jobs is read ahead of the results
+    read = []
+    def generate():
+        for _ in range(20):
+            read.append(1)
+            yield jobs[0]
+    for ordered in [True, False]:
+        read.clear()
+        results = post_process.postprocess_many(generate(), post_process.blossom_weak, processes=2, ordered=ordered)
+        next(results)
+        assert len(read) <= 4
+        assert len(list(results)) == 19
+
+def test_Mfold_postprocessing_many():
+    torch.manual_seed(0)
+    sequences = ['GGGAAACUCCGAUUCGGAGUACGGAAUCCGUAGGCUUCCA', 'GGGAAACCCAGGGAAACCC', 'CGUGUCAGGUCCGGAAGGAAGCAGCACUAAC', 'GGGGAAAACCCC']
+    jobs = [(torch.rand((len(sequence), len(sequence))), sequence) for sequence in sequences]
+
+    for func, many in [(post_process.Mfold_param_postprocessing, post_process.Mfold_param_postprocessing_many),
+                       (post_process.Mfold_constrain_postprocessing, post_process.Mfold_constrain_postprocessing_many)]:
+        expected = [func(matrix, sequence, 'cpu') for matrix, sequence in jobs]
+
+        #The longest sequence is run first
+        results = list(many(jobs, processes=1))
+        assert [index for index, _, _ in results] == [0, 2, 1, 3]
+        assert all(torch.equal(pairs, expected[index]) for index, pairs, _ in results)
+
+        results = list(many(jobs, processes=2))
+        assert sorted(index for index, _, _ in results) == list(range(len(jobs)))
+        assert all(torch.equal(pairs, expected[index]) for index, pairs, _ in results)
+
+def test_Mfold_postprocessing_many_fd_limit():
+    #More jobs than open files are allowed, which fails if the matrices are all in shared memory at once
+    sequence = 'GGGAAACCC'
+    matrix = torch.rand((len(sequence), len(sequence)))
+    expected = post_process.Mfold_param_postprocessing(matrix, sequence, 'cpu')
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    limit = len(os.listdir('/proc/self/fd')) + 64
+    jobs = [(matrix.clone(), sequence) for _ in range(limit + 100)] + [(matrix.numpy(), sequence)]
+
+    resource.setrlimit(resource.RLIMIT_NOFILE, (limit, hard))
+    try:
+        count = 0
+        for _, pairs, _ in post_process.Mfold_param_postprocessing_many(jobs, processes=2):
+            assert torch.equal(pairs, expected)
+            count += 1
+    finally:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+
+    assert count == len(jobs)
+    assert not any(matrix.is_shared() for matrix, _ in jobs[:-1]) #The matrices of the caller are not moved
+
 def test_Mfold(): 
     sequence = 'CGUGUCAGGUCCGGAAGGAAGCAGCACUAAC'
     pairs = [0, 26, 25, 24, 23, 0, 0, 0, 0, 18, 17, 16, 0, 0, 0, 0, 11, 10, 9, 0, 0, 0, 0, 4, 3, 2, 1, 0, 0, 0, 0]
@@ -291,12 +554,368 @@ def test_Mfold():
         else: 
             matrix[i, i] = 1
     
-    result = post_process.Mfold_param_postprocessing(matrix, sequence, 'cpu')
+    result = post_process.pairs_to_matrix(post_process.Mfold_param_postprocessing(matrix, sequence, 'cpu'), 'cpu')
 
     assert np.array_equal(matrix, result)
 
+def test_dp_table():
+    #Packed and banded tables give the same cells, diagonals and views as the dense matrix
+    N = 9
+    A = np.random.default_rng(0).random((N, N))
+    i, j = np.indices((N, N))
+
+    for span, K in [(None, 6), (4, 3)]:
+        table = DPTable.from_dense(A, span)
+        stored = (j >= i) if span is None else (j >= i) & (j-i <= span)
+        assert np.array_equal(table.to_dense(), np.where(stored, A, np.inf))
+        assert table.data.size == ((N//2+1)*N if span is None else N*(span+1))
+
+        for l in range(N if span is None else span+1):
+            assert np.array_equal(table.diagonal(l), np.diagonal(A, l))
+
+        #Rows and columns of cells along a diagonal, as used for E3 and E4. For the packed table the diagonals are on both sides of N//2
+        n = 2
+        assert np.array_equal(table.view(0, 1, n, 0, 1, K), np.array([[A[c, 1+c+k] for c in range(n)] for k in range(K)]))
+        assert np.array_equal(table.view(1, 1+K, n, 1, 0, K), np.array([[A[1+c+k, 1+K+c] for c in range(n)] for k in range(K)]))
+
+    table = DPTable.empty(N, np.int8, fill=0)
+    table[2, 7] = 3
+    assert table[2, 7] == 3 and table[7, 2] == 0 and table.dtype == np.int8
+
+def test_Mfold_wavefront():
+    #Tables filled a diagonal at a time must satisfy the recursions cell by cell
+    sequence = 'GGGAAACUCCGAUUCGGAGUACGGAAUCCGUAGGCUUCCA'
+    N = len(sequence)
+    torch.manual_seed(0)
+
+    engine = Mfold1.MfoldEngine()
+    engine.set_sequence(sequence, -torch.rand((N, N)))
+    W, V = engine.fold_rna()
+    for l in range(5, N):
+        for i in range(N-l):
+            j = i+l
+            v = min(engine.find_E1(i, j), engine.find_E2(i, j, V)[0], engine.find_E3(i, j, W)[0]) if engine.pairing[i, j] else np.inf
+            assert V[i, j] == v
+            assert W[i, j] == min(W[i+1, j], W[i, j-1], V[i, j], engine.find_E4(i, j, W)[0])
+
+    engine = Mfold2.MfoldEngine()
+    engine.set_sequence(sequence, (torch.rand((N, N)) > 0.2).float())
+    W, V = engine.fold_rna()
+    for l in range(5, N):
+        for i in range(N-l):
+            j = i+l
+            E2 = min(engine.stacking(i, j, V), engine.bulge_loop_3end(i, j, V)[0], engine.bulge_loop_5end(i, j, V)[0], engine.interior_loop(i, j, V)[0])
+            v = min(engine.find_E1(i, j), E2, engine.find_E3(i, j, W)[0]) if engine.allowed[i, j] else np.inf
+            assert V[i, j] == v
+            assert W[i, j] == min(W[i+1, j], W[i, j-1], V[i, j], engine.find_E4(i, j, W)[0])
+
+def test_Mfold_max_loop():
+    #Internal loops are limited to max_loop unpaired bases, and a limit longer than the sequence gives the unlimited fold
+    sequence = 'GGGAAACUCCGAUUCGGAGUACGGAAUCCGUAGGCUUCCA'
+    N = len(sequence)
+    torch.manual_seed(0)
+    matrix = -torch.rand((N, N))
+
+    for module in [Mfold1, Mfold2]:
+        assert module.Mfold(sequence, matrix, 'cpu', max_loop=N) == module.Mfold(sequence, matrix, 'cpu', max_loop=None)
+
+    engine = Mfold1.MfoldEngine(max_loop=3)
+    engine.set_sequence(sequence, matrix)
+    W, V = engine.fold_rna()
+    for l in range(5, N):
+        for i in range(N-l):
+            j = i+l
+            energy, ij = engine.find_E2(i, j, V)
+            assert ij is None or (ij[0]-i-1) + (j-ij[1]-1) <= 3
+            v = min(engine.find_E1(i, j), energy, engine.find_E3(i, j, W)[0]) if engine.pairing[i, j] else np.inf
+            assert V[i, j] == v
+
+    engine = Mfold2.MfoldEngine(max_loop=3)
+    engine.set_sequence(sequence, -matrix)
+    W, V = engine.fold_rna()
+    for l in range(5, N):
+        for i in range(N-l):
+            j = i+l
+            ij, jp, ip = engine.interior_loop(i, j, V)[1], engine.bulge_loop_3end(i, j, V)[1], engine.bulge_loop_5end(i, j, V)[1]
+            assert ij is None or (ij[0]-i-1) + (j-ij[1]-1) <= 3
+            assert jp is None or j-jp-1 <= 3
+            assert ip is None or ip-i-1 <= 3
+
+def test_Mfold_span():
+    #Banded tables hold the same values as the full tables inside the band, and a span as long as the sequence gives the full fold
+    sequence = 'GGGAAACUCCGAUUCGGAGUACGGAAUCCGUAGGCUUCCA'
+    N = len(sequence)
+    torch.manual_seed(0)
+    matrix = -torch.rand((N, N))
+
+    for module, M in [(Mfold1, matrix), (Mfold2, -matrix)]:
+        assert module.Mfold(sequence, M, 'cpu', span=N-1) == module.Mfold(sequence, M, 'cpu')
+
+        full, banded = module.MfoldEngine(), module.MfoldEngine(span=12)
+        full.set_sequence(sequence, M)
+        fold = banded.fold(sequence, M)
+        W, V = full.fold_rna()[:2]
+        Wb, Vb = banded.fold_rna()[:2]
+
+        assert Vb.data.shape == (N, 13)
+        for l in range(13):
+            assert np.array_equal(Vb.diagonal(l), V.diagonal(l)) and np.array_equal(Wb.diagonal(l), W.diagonal(l))
+
+        assert all(abs(j-i) <= 12 for i, j in enumerate(fold))
+        assert all(fold[j] == i for i, j in enumerate(fold))
+
+def test_Mfold_sparse():
+    #The sparse fold gives the same energies as the dense fold for all candidate pairs, and a structure of candidate pairs with the minimum energy
+    sequence = 'GGGAAACUCCGAUUCGGAGUACGGAAUCCGUAGGCUUCCA'
+    N = len(sequence)
+    torch.manual_seed(0)
+    matrix = (torch.rand((N, N)) > 0.6).float()
+
+    dense, sparse = Mfold2.MfoldEngine(), Mfold2.SparseMfoldEngine()
+    dense.set_sequence(sequence, matrix)
+    sparse.set_sequence(sequence, matrix)
+    W, V = dense.fold_rna()
+    Vs, trace, Ws, Ms = sparse.fold_rna()
+
+    assert all(V[i, j] == energy for (i, j), energy in Vs.items())
+    assert Ws[-1, sparse.row(0)] == pytest.approx(W[0, N-1])
+
+    fold = sparse.backtrack(Vs, trace, Ws, Ms)
+    pairs = [(i, j) for i, j in enumerate(fold) if j > i]
+    assert all(fold[j] == i for i, j in enumerate(fold))
+    assert all((i, j) in Vs for i, j in pairs)
+    assert not any(i < k < j < l for i, j in pairs for k, l in pairs)
+    assert fold == Mfold2.Mfold_sparse(sequence, matrix, 'cpu')
+
+def test_Mfold_engine():
+    #Engines reused for sequences of different lengths and run in parallel threads must give the same folds as new engines
+    torch.manual_seed(0)
+    sequences = ['GGGAAACUCCGAUUCGGAGUACGGAAUCCGUAGGCUUCCA', 'GGGAAACCCAGGGAAACCC', 'CGUGUCAGGUCCGGAAGGAAGCAGCACUAAC']
+    jobs = [(sequence, -torch.rand((len(sequence), len(sequence)))) for sequence in sequences]
+
+    for module in [Mfold1, Mfold2]:
+        expected = [module.Mfold(sequence, matrix, 'cpu') for sequence, matrix in jobs]
+
+        engine = module.MfoldEngine()
+        assert [engine.fold(sequence, matrix) for sequence, matrix in jobs] == expected
+
+        engines = [module.MfoldEngine() for _ in jobs]
+        with ThreadPoolExecutor(len(jobs)) as executor:
+            results = list(executor.map(lambda x: x[0].fold(*x[1]), zip(engines, jobs)))
+        assert results == expected
+
+def test_Mfold_backtrack():
+    #A long stem must be backtracked without running into the recursion limit
+    stem = 100
+    sequence = 'G'*stem + 'AAAA' + 'C'*stem
+    N = len(sequence)
+
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(len(inspect.stack()) + 50)
+    try:
+        folds = [Mfold1.Mfold(sequence, -torch.ones((N, N)), 'cpu'),
+                 Mfold2.Mfold(sequence, torch.ones((N, N)), 'cpu')]
+    finally:
+        sys.setrecursionlimit(limit)
+
+    for fold in folds:
+        assert fold[:stem] == list(range(N-1, N-stem-1, -1))
+        assert [fold[i] for i in fold] == list(range(N))
+
+def test_hotspot_sets():
+    first = hotknots.HotSpot([(2, 12), (3, 11), (5, 10)], 3.0)
+    second = hotknots.HotSpot([(14, 20), (15, 19)], 2.0)
+    assert first.bases == [2, 3, 4, 5, 10, 11, 12]
+    assert not first.mask & second.mask and first.mask & hotknots.HotSpot([(12, 18)], 1.0).mask
+
+    node = hotknots.Node([second, first])
+    assert node.bases == [2, 3, 4, 5, 10, 11, 12, 14, 15, 19, 20]
+    assert node.energy == 5.0
+    assert node.key == hotknots.Node([first, second]).key
+
+    #Nodes do not share the list of hotspots and have no __dict__
+    root, other = hotknots.Node(), hotknots.Node()
+    root.hotspots.append(first)
+    assert other.hotspots == [] and not hasattr(root, '__dict__')
+
+def test_smith_waterman():
+    sequence = 'GGGGAAAACCCC'
+    N = len(sequence)
+
+    top_cells, trace = hotknots.HotKnotsEngine().smith_waterman(sequence, torch.ones((N, N)), treshold=1.0)
+    cells = [hotknots.pop_top_cell(top_cells) for _ in range(len(top_cells))]
+
+    #Cells are popped with the highest score first, and ties are popped from the last cell found
+    assert cells == [(3, (1, 11)), (2, (0, 10)), (2, (2, 11)), (2, (1, 10)), (2, (2, 10))]
+    assert hotknots.traceback_smith_waterman(trace, 1, 11) == [(1, 10), (2, 9), (3, 8)]
+
+def test_hotknots_simfold_pool(simfold_stub, hotknots_input):
+    sequence, matrix = hotknots_input(0, 37)
+
+    executable, directory = simfold_stub
+    pool = hotknots.SimFoldPool(executable, directory, workers=4)
+
+    pairs = hotknots.hotknots(matrix, sequence, 'cpu', k=3, simfold=pool)
+    bases = [base for pair in pairs for base in pair]
+    assert pairs and len(bases) == len(set(bases))
+
+    #Every segment and constraint is only folded once, also when the sequence is folded again
+    calls = open(os.path.join(directory, 'calls.txt')).read().splitlines()
+    assert len(calls) == len(set(calls))
+
+    assert hotknots.hotknots(matrix, sequence, 'cpu', k=3, simfold=pool) == pairs
+    assert open(os.path.join(directory, 'calls.txt')).read().splitlines() == calls
+
+def test_hotknots_grow_tree(simfold_stub, hotknots_input):
+    #Growing the tree on a process pool gives the same tree as growing it in the main process
+    sequence, matrix = hotknots_input(1, 53)
+
+    trees = []
+    for processes in [1, 2]:
+        engine = hotknots.HotKnotsEngine(simfold=hotknots.SimFoldPool(*simfold_stub))
+        tree = engine.initialize_tree(sequence, matrix, k=4)
+        engine.grow_tree(tree, sequence, matrix, k=4, processes=processes)
+        trees.append([([hotspot.pairs for hotspot in node.hotspots], float(node.StrSeq)) for node in tree.nodes])
+
+    assert len(trees[0]) > 5
+    assert trees[0] == trees[1]
+
+def test_hotknots_beam_search(simfold_stub, hotknots_input):
+    sequence, matrix = hotknots_input(1, 53)
+
+    engine = hotknots.HotKnotsEngine(simfold=hotknots.SimFoldPool(*simfold_stub))
+    full = engine.grow_tree(engine.initialize_tree(sequence, matrix, k=4), sequence, matrix, k=4)
+    beam = engine.beam_search(engine.initialize_tree(sequence, matrix, k=4), sequence, matrix, k=4, beam_width=10)
+
+    #Hotspot sets found in another order are pruned, without losing the best node
+    assert len({node.key for node in beam.nodes}) == len(beam.nodes) <= len(full.nodes)
+    assert max(float(node.StrSeq) for node in beam.nodes) == pytest.approx(max(float(node.StrSeq) for node in full.nodes))
+
+    #The search stops when the budget is used
+    small = engine.beam_search(engine.initialize_tree(sequence, matrix, k=4), sequence, matrix, k=4, beam_width=10, budget=len(beam.root.children)+1)
+    assert len(small.nodes) < len(beam.nodes)
+
+def test_hotknots_mfold_pool(hotknots_input):
+    #The in-process folder gives the constrained Mfold structure, with the bases marked with '.' left unpaired
+    sequence = 'GGGAAACCCAGGGAAACCC'
+    N = len(sequence)
+    assert hotknots.run_mfold(sequence, '_'*N) == '(((...))).(((...)))'
+    assert hotknots.run_mfold(sequence, '.'*10 + '_'*9) == '.'*10 + '(((...)))'
+
+    sequence, matrix = hotknots_input(0, 37)
+
+    pairs = hotknots.hotknots(matrix, sequence, 'cpu', k=3, simfold=hotknots.MfoldPool())
+    bases = [base for pair in pairs for base in pair]
+    assert pairs and len(bases) == len(set(bases))
+
 
 ### EVALUATION ###
+def test_nussinov_in_process(): 
+    #Structures from the Nussinov executable
+    assert nussinov.nussinov('GGGAAAUCCCAGGGAAACCC') == [19, 18, 17, 3, 4, 5, 14, 13, 12, 9, 10, 11, 8, 7, 6, 15, 16, 2, 1, 0]
+    assert nussinov.nussinov('GGGAAACCCAGGGAAACCCAA') == [18, 17, 16, 3, 4, 5, 12, 11, 8, 9, 10, 7, 6, 13, 14, 15, 2, 1, 0, 19, 20]
+    assert nussinov.nussinov('ACGUN') == [0, 1, 2, 3, 4]
+    assert nussinov.nussinov('') == []
+
+    #The structure is found without recursion, so long sequences do not reach the recursion limit
+    pairs = nussinov.nussinov('GGGGAAAACCCC'*100)
+    assert sorted(pairs) == list(range(1200))
+    assert all(pairs[pairs[i]] == i for i in range(1200))
+
+def test_runner(predictor_stub, monkeypatch): 
+    stub, files, tmpdir = predictor_stub
+    monkeypatch.chdir(tmpdir)
+    tool = runner.ExecutableTool('stub', [stub, '{file}'], nussinov.parse_pairs)
+
+    results = runner.run_tool(tool, files[:3], 'out', processes=2, timeout=2, cache_dir='cache', progress=False)
+    assert [result.error is None for result in results] == [True, True, False]
+    assert results[2].error.startswith('Timeout')
+    assert not any(result.cached for result in results)
+
+    #The structure is saved as a matrix, and the failing sequence was tried again
+    matrix = pickle.load(open(os.path.join('out', '1.pkl'), 'rb'))
+    assert torch.equal(matrix, torch.tensor(np.eye(6)[[5, 1, 2, 3, 4, 0]], dtype=torch.float32))
+    assert sorted(open('calls.txt').read().split()) == ['FAAAAC', 'FAAAAC', 'GAAAC', 'TAAAC']
+
+    #The finished sequences are read from the cache when the same version of the tool is run again, also for the same sequence in another file
+    open('calls.txt', 'w').close()
+    results = runner.run_tool(tool, files[:2] + files[3:], 'out', processes=1, cache_dir='cache', progress=False)
+    assert all(result.cached for result in results)
+    assert open('calls.txt').read() == ''
+
+    tool.version = 'new'
+    results = runner.run_tool(tool, files[:1], 'out', processes=1, cache_dir='cache', progress=False)
+    assert not results[0].cached and open('calls.txt').read() == 'GAAAC\n'
+
+    #In-process tools
+    tool = runner.FunctionTool('nussinov', nussinov.nussinov)
+    results = runner.run_tool(tool, files[:1], 'nussinov', processes=1, cache_dir=None, progress=False)
+    assert results[0].error is None
+    assert torch.equal(pickle.load(open(os.path.join('nussinov', '0.pkl'), 'rb')), torch.tensor(np.eye(5)[[4, 1, 2, 3, 0]], dtype=torch.float32))
+
+def test_cnnfold(): 
+    matrix = cnnfold.create_matrix('AGGGGU')
+    assert matrix.shape == (8, 6, 6)
+    assert torch.all(matrix.sum(dim=0) == 1) #Every cell has exactly one channel
+    assert matrix[0, 0, 5] == 1 and matrix[1, 5, 0] == 1 #AU and UA
+    assert matrix[3, 1, 5] == 1 and matrix[2, 5, 1] == 1 #GU and UG, the other G are too close to the U
+    assert matrix[:6].sum() == 4
+    assert torch.equal(matrix[6], torch.eye(6))
+    flat = cnnfold.create_matrix('AGGGGU', onehot=False)[0]
+    assert torch.equal(torch.diagonal(flat), torch.tensor([1, 11, 11, 11, 11, 6])) #Pairing types 4*q1 + q2 + 1, where unpaired bases have q1 = q2
+    assert flat[0, 5] == 2 and flat[5, 0] == 5 and flat[1, 5] == 10 and flat[5, 1] == 7
+    assert torch.count_nonzero(flat) == 10
+
+    matrix = torch.rand((2, 1, 20, 20))
+    topk = cnnfold.keep_topk(matrix, 3)
+    assert torch.all((topk > 0).sum(dim=-1) == 3)
+    assert torch.equal(topk.max(dim=-1)[0], matrix.max(dim=-1)[0])
+    assert torch.all(topk.sum(dim=-1) <= matrix.sum(dim=-1))
+
+    #Same matching as NetworkX on the graph with two copies of the bases
+    matrix = torch.rand((30, 30))
+    matrix = cnnfold.keep_topk((matrix + matrix.T).unsqueeze(0).unsqueeze(0), 3)[0, 0]
+    matrix = torch.maximum(matrix, matrix.T)
+    result = cnnfold.blossom(matrix)
+    assert torch.equal(result, result.T)
+    assert torch.equal(post_process.matrix_to_pairs(result), post_process.nx_blossum_postprocessing(matrix, 'sequence', 'cpu'))
+
+def test_ufold_featurize(ufold_features):
+    #Reference with the one-hot encoding of one_hot_600 and the loops of creatmat in the UFold repository
+    def paired(x, y):
+        return {'AU': 2, 'UA': 2, 'GC': 3, 'CG': 3, 'UG': 0.8, 'GU': 0.8}.get(x+y, 0)
+
+    def stem(sequence, i, j, steps, direction):
+        #Sum of the weighted pairing scores along the stem from (i, j), outwards if direction is 1 and inwards if it is -1
+        score = 0
+        for add in steps:
+            x, y = i - direction*add, j + direction*add
+            if not (0 <= x < len(sequence) and 0 <= y < len(sequence)) or paired(sequence[x], sequence[y]) == 0:
+                break
+            score += paired(sequence[x], sequence[y]) * np.exp(-0.5*add*add)
+        return score
+
+    for sequence in ['GGGGAAAACCCCAUGCUUCGGCAUGGAGCU', 'AUCGaucgNAUCGGCGUCCGAUGCAUUUUAGCUAGCAUCG', 'GCAUGCAUGCAU'*8]:
+        n = len(sequence)
+        l = ufold_features['get_cut_len'](n, 80)
+        features, one_hot = ufold_features['featurize'](sequence, l)
+        assert features.shape == (17, l, l) and one_hot.shape == (l, 4)
+
+        expected = np.zeros((l, 4))
+        expected[:n] = [[float(base.upper() == b) for b in 'AUCG'] if base.upper() in 'AUCG' else [-1]*4 for base in sequence]
+        assert np.array_equal(one_hot, expected)
+        for channel, (i, j) in enumerate([(i, j) for i in range(4) for j in range(4)]):
+            assert np.array_equal(features[channel], np.outer(expected[:, i], expected[:, j]))
+
+        upper = sequence.upper()
+        mat = np.zeros((l, l))
+        for i in range(n):
+            for j in range(n):
+                mat[i, j] = stem(upper, i, j, range(30), 1)
+                if mat[i, j] > 0:
+                    mat[i, j] += stem(upper, i, j, range(1, 30), -1)
+        assert np.allclose(features[16], mat, atol=1e-5)
+
 def test_evaluation(): 
     # Test functionality
     y_pred = torch.tensor([1, 1, 1, 1])
@@ -342,3 +961,15 @@ def test_evaluation():
     assert round(F1, 2) == 0.5
     
 
+def test_evaluation_pairs(): 
+    sequence = 'AUCGAUCGAUCGAUCGAUCGAUCGAUCGAUCGAUCGAUCGAUCGAUCGAU'
+    y_true = post_process.blossom_weak(post_process.prepare_input(torch.rand((50, 50)), sequence, 'cpu'), sequence, 'cpu')
+    
+    for _ in range(5):
+        matrix = post_process.prepare_input(torch.rand((50, 50)), sequence, 'cpu')
+        for y_pred in [post_process.blossom_weak(matrix, sequence, 'cpu'), post_process.argmax_postprocessing(matrix, sequence, 'cpu')]:
+            for allow_shift in [False, True]:
+                for include_unpaired in [False, True]: 
+                    dense = train.evaluate(post_process.pairs_to_matrix(y_pred, 'cpu'), post_process.pairs_to_matrix(y_true, 'cpu'), 'cpu', allow_shift=allow_shift, include_unpaired=include_unpaired)
+                    compact = train.evaluate_pairs(y_pred, y_true, allow_shift=allow_shift, include_unpaired=include_unpaired)
+                    assert np.allclose(dense, compact)
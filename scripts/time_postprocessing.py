@@ -4,7 +4,9 @@ import torch
 
 import pandas as pd
 
-import time, random, sys, multiprocessing 
+import time, random, sys, os, multiprocessing 
+
+from functools import partial
 
 from utils.plots import plot_timedict
 
@@ -80,7 +82,7 @@ def time_postprocess(func, n: int, min_length: int, max_length: int) -> list:
         matrix = generate_random_matrix(N)
         sequence = generate_random_sequence(N)
         t0 = time.time()
-        matrix = func(matrix, sequence)
+        matrix = func(matrix, sequence, 'cpu')
         t.append(time.time() - t0)
         
     return t
@@ -123,9 +125,39 @@ def average_times(func, func_name: str, repeats: int = 5, n: int = 51, min_lengt
     
     return average[1:]
 
+def compare_times(df: pd.DataFrame, previous_file: str) -> pd.DataFrame:
+    """
+    Finds the speedup of each function compared to the times from a previous run.
+    Used to report the gain when a post-processing method is changed, e.g. the diagonal (wavefront) fill of the Mfold tables.
+    Only functions with the same name in both runs are compared, so they must be run with the same settings as in the previous run for the speedup to be from the change alone.
+
+    Parameters:
+    - df (pd.DataFrame): The times of the current run, with the sequence lengths as index
+    - previous_file (str): The csv file with the times from the previous run
+
+    Returns:
+    - speedup (pd.DataFrame): The previous time divided by the current time for the functions timed in both runs. None if there are no previous times
+    """
+    if not os.path.exists(previous_file):
+        return None
+
+    previous = pd.read_csv(previous_file, index_col=0)
+    functions = [func_name for func_name in df.columns if func_name in previous.columns]
+
+    speedup = previous.loc[df.index, functions] / df[functions]
+
+    for func_name in functions:
+        print(f'{func_name}: {speedup[func_name].mean():.1f}x faster on average ({speedup[func_name].iloc[-1]:.1f}x for length {df.index[-1]})', file=sys.stdout)
+
+    return speedup
+
 def main(): 
-    functions = {'Mfold w/ matrix as constrains': post_processing.Mfold_constrain_postprocessing,
-                 'Mfold w/ matrix as parameters': post_processing.Mfold_param_postprocessing, 
+    #The Mfold functions are timed without a limit on internal loops, as in earlier runs, so the speedup from compare_times is only from the fill of the tables
+    #They are also timed with the default limit of 30 bases, and the gain from the limit is reported separately
+    functions = {'Mfold w/ matrix as constrains': partial(post_processing.Mfold_constrain_postprocessing, max_loop=None),
+                 'Mfold w/ matrix as parameters': partial(post_processing.Mfold_param_postprocessing, max_loop=None), 
+                 'Mfold w/ matrix as constrains, max_loop=30': post_processing.Mfold_constrain_postprocessing,
+                 'Mfold w/ matrix as parameters, max_loop=30': post_processing.Mfold_param_postprocessing, 
                  'NetworkX blossom w/ self-loops': post_processing.nx_blossum_postprocessing, 
                  'Blossom w/ self-loops': post_processing.blossom_postprocessing, 
                  'Blossom': post_processing.blossom_weak, 
@@ -139,6 +171,16 @@ def main():
     
     #Save and plot the results
     df = pd.DataFrame(timedict, index = lengths)
+
+    #Compare with the times from the previous run before they are overwritten
+    speedup = compare_times(df, 'results/postprocess_time.csv')
+    if speedup is not None:
+        speedup.to_csv('results/postprocess_speedup.csv')
+
+    for func_name in ['Mfold w/ matrix as constrains', 'Mfold w/ matrix as parameters']:
+        loop_speedup = df[func_name] / df[f'{func_name}, max_loop=30']
+        print(f'{func_name}: {loop_speedup.mean():.1f}x faster on average with max_loop=30 ({loop_speedup.iloc[-1]:.1f}x for length {df.index[-1]})', file=sys.stdout)
+
     df.to_csv('results/postprocess_time.csv')
     
     plot_timedict(timedict, lengths, 'figures/postprocess_time.png')
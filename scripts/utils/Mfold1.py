@@ -1,289 +1,434 @@
 import torch
+import numpy as np
 
-####### HELP FUNCTIONS #######
+from enum import IntEnum
 
-def declare_global_variable(seq: str, M: torch.Tensor, device: str) -> None: 
+from utils.dp_tables import DPTable, WTrace, backtrack_stack, exterior_pairs, reuse_buffer, w_trace
+
+class VTrace(IntEnum):
+    """
+    The loop that gives the minimum energy of V[i, j], in the order they are tried when backtracking
     """
-    Declares the global variables used troughout all the other functions. 
+    NONE = 0 #i and j cannot pair
+    HAIRPIN = 1 #E1
+    INTERNAL = 2 #E2
+    BIFURCATION = 3 #E3
 
-    Parameters:
-    - seq (str): The RNA sequence to fold
-    - M (torch.Tensor): The energy matrix used to calculate the energy of the different basepairs
+####### MFOLD ENGINE #######
+class MfoldEngine:
+    """
+    Folds RNA sequences with Mfold using a matrix as energy parameters for the different basepairs.
+    All state of a fold is kept on the engine, so several engines can fold in parallel threads.
+    The DP tables are kept between folds and only reallocated if a longer sequence is folded, so an engine can be reused for many sequences.
 
-    Returns:
-    - None
+    Internal loops (bulges and interior loops) are limited to max_loop unpaired bases, which makes the fold O(N^2*max_loop^2) instead of O(N^4).
+    With max_loop set to None all internal loops are allowed.
+
+    With a span only basepairs with j-i <= span are allowed, and the tables are stored banded with O(N*span) memory and filled in O(N*span^2) time.
+    The structures found in the band are combined over the full sequence in the exterior loop.
     """
-    global basepairs, sequence, matrix, dv
+    def __init__(self, device: str = 'cpu', max_loop: int = 30, span: int = None) -> None:
+        self.basepairs = {'AU', 'UA', 'CG', 'GC', 'GU', 'UG'}
+        self.dv = device
+        self.max_loop = max_loop
+        self.max_span = span
+        self.buffer, self.trace_buffer, self.split_buffer = None, None, None
+
+    def set_sequence(self, seq: str, M: torch.Tensor) -> None:
+        """
+        Sets the sequence and energy matrix to fold
 
-    basepairs = {'AU', 'UA', 'CG', 'GC', 'GU', 'UG'}
-    sequence = seq
-    matrix = M
-    dv = device
+        Parameters:
+        - seq (str): The RNA sequence to fold
+        - M (torch.Tensor): The energy matrix used to calculate the energy of the different basepairs
 
+        Returns:
+        - None
+        """
+        N = len(seq)
 
-### LOOP ENERGIES ###
-def find_E1(i: int, j: int) -> float:
-    """
-    E1 are the energy of base pairing between Si and Sj with one internal edge (hairpin loop) 
+        #The tables are only banded if the span is shorter than the sequence
+        self.span = self.max_span if self.max_span is not None and self.max_span < N-1 else None
 
-    Parameters:
-    - i (int): The start index of the subsequence
-    - j (int): The end index of the subsequence
+        self.sequence = seq
+        self.matrix = DPTable.from_dense(M.detach().cpu().numpy(), self.span)
 
-    Returns:
-    - energy (float): The energy of the basepairing
-    """
-    
-    energy = matrix[i, j]
+        self.codes = np.array(['ACGU'.find(x) for x in seq])
+        self.can_pair = np.array([[(x + y) in self.basepairs for y in 'ACGU'] + [False] for x in 'ACGU'] + [[False]*5])
+        self.pairing = DPTable.from_cells(lambda i, j: self.can_pair[self.codes[i], self.codes[j]], N, bool, self.span, False)
 
-    return energy
+    def tables(self, N: int, dtype: np.dtype) -> tuple[DPTable, DPTable, DPTable]:
+        """
+        Returns the W, V and P tables for a sequence of length N, filled with infinity
+        The tables that are used for backtracking (the trace codes of V and W and the split points of bifurcations) are set on the engine
+        The tables are stored in buffers that are only reallocated if they are too small or of another type
 
-def find_E2(i: int, j: int, V: torch.Tensor) -> tuple[float, tuple[int, int]]: 
-    """
-    E2 is the energy of basepairing between i and j and i' and j' resulting in two internal edges (stacking, bulge loop or internal loop)
-    i<i'<j'<j 
+        Parameters:
+        - N (int): The length of the sequence
+        - dtype (np.dtype): The type of the tables
 
-    Parameters:
-    - i (int): The start index of the subsequence
-    - j (int): The end index of the subsequence
-    - V (torch.Tensor): The V matrix
+        Returns:
+        - W, V, P (DPTable): The tables
+        """
+        rows, cols = DPTable.shape(N, self.span)
+        size = rows*cols
 
-    Returns:
-    - energy (float): The minimum energy of the basepairing given that two internal edges are formed
-    - ij (tuple[int, int]): The indices of the second edge of subsequence that gives the minimum energy
-    """  
-    energy = float('inf')
-    ij = None
-
-    for ip in range(i+1, j-2): 
-        for jp in range(ip+3, j): 
-            if (sequence[ip] + sequence[jp]) in basepairs:
-                energy_loop = matrix[i, j] + V[ip, jp]
-                if energy_loop < energy: 
-                    energy = energy_loop
-                    ij = (ip, jp) 
-    return energy, ij
-
-def find_E3(i: int, j: int, W: torch.Tensor) -> tuple[float, tuple[int, int]]: 
-    """
-    E3 is the energy of a structure that contains more than two internal edges (bifurcating loop)
-    The energy is the energy of the sum of the substructures 
-    i+1<i'<j-2
+        self.buffer = reuse_buffer(self.buffer, 3*size, dtype)
+        self.trace_buffer = reuse_buffer(self.trace_buffer, 2*size, np.int8)
+        self.split_buffer = reuse_buffer(self.split_buffer, 2*size, np.int32)
 
-    Parameters:
-    - i (int): The start index of the subsequence
-    - j (int): The end index of the subsequence
-    - W (torch.Tensor): The W matrix
+        self.V_trace, self.W_trace = (DPTable.empty(N, np.int8, self.span, WTrace.NONE, self.trace_buffer[k*size:(k+1)*size]) for k in range(2))
+        self.V_split, self.W_split = (DPTable.empty(N, np.int32, self.span, -1, self.split_buffer[k*size:(k+1)*size]) for k in range(2))
 
-    Returns:
-    - energy (float): The minimum energy of the basepairing given that more than two internal edges are formed
-    - ij (tuple[int, int]): The indices of the subsequence that gives the minimum energy
-    """
-    energy = float('inf')
-    ij = None
-
-    #Try all combinations of substructure and save the one that gives the lowest energy
-    for ip in range(i+2, j-2):  
-        loop_energy = W[i+1, ip] + W[ip+1, j-1]
-        if loop_energy < energy: 
-            energy = loop_energy
-            ij = (ip, ip+1)
-    return energy, ij
-
-def find_E4(i: int, j: int, W: torch.Tensor) -> tuple[float, tuple[int, int]]: 
-    """
-    E4 is the energy when i and j are both in base pairs, but not with each other. 
-    It find the minimum of combinations of two possible subsequences containing i and j
+        return tuple(DPTable.empty(N, dtype, self.span, buffer=self.buffer[k*size:(k+1)*size]) for k in range(3))
 
-    Parameters:
-    - i (int): The start index of the subsequence
-    - j (int): The end index of the subsequence
-    - W (torch.Tensor): The W matrix
+    ### LOOP ENERGIES ###
+    def find_E1(self, i: int, j: int) -> float:
+        """
+        E1 are the energy of base pairing between Si and Sj with one internal edge (hairpin loop)
 
-    Returns:
-    - energy (float): The minimum energy of the basepairing given that i and j are both in base pairs
-    - ij (tuple[int, int]): The indices of the subsequence that gives the minimum energy
-    """
-    energy = float('inf')
-    ij = None
+        Parameters:
+        - i (int): The start index of the subsequence
+        - j (int): The end index of the subsequence
 
-    for ip in range(i+1, j-1): 
-        subsequence_energy = W[i, ip] + W[ip+1, j]
-        
-        if subsequence_energy < energy: 
-            energy = subsequence_energy
-            ij = (ip, ip+1)
+        Returns:
+        - energy (float): The energy of the basepairing
+        """
 
-    return energy, ij
+        energy = self.matrix[i, j]
 
-def penta_nucleotides(W: torch.Tensor, V: torch.Tensor) -> None:
-    """
-    Fills out the first entries in the matrices V and W 
-    The shortest possible subsequences are of length 5 and can only form hairpin loops of size 3 if i and j basepair
+        return energy
 
-    Parameters:
-    - W (torch.Tensor): The W matrix
-    - V (torch.Tensor): The V matrix
+    def find_E2(self, i: int, j: int, V: DPTable) -> tuple[float, tuple[int, int]]:
+        """
+        E2 is the energy of basepairing between i and j and i' and j' resulting in two internal edges (stacking, bulge loop or internal loop)
+        i<i'<j'<j and (i'-i-1) + (j-j'-1) <= max_loop
 
-    Returns:
-    - None
-    """
-    N = len(sequence)
-
-    for i in range(0, N-4): 
-        j = i+4
-        bp = sequence[i]+sequence[j]
-        if bp not in basepairs:
-            V[i,j] = W[i,j ]= float('inf')
-        else: 
-            V[i,j] = W[i,j] = matrix[i, j] 
-
-### FILL V AND W ###
-def compute_V(i: int, j: int, W: torch.Tensor, V: torch.Tensor) -> None: 
-    """
-    Computes the minimization over E1, E2 and E3, which will give the value at V[i,j]
+        Parameters:
+        - i (int): The start index of the subsequence
+        - j (int): The end index of the subsequence
+        - V (DPTable): The V matrix
 
-    Parameters:
-    - i (int): The start index of the subsequence
-    - j (int): The end index of the subsequence
-    - W (torch.Tensor): The W matrix
-    - V (torch.Tensor): The V matrix
+        Returns:
+        - energy (float): The minimum energy of the basepairing given that two internal edges are formed
+        - ij (tuple[int, int]): The indices of the second edge of subsequence that gives the minimum energy
+        """
+        if j-2 <= i+1:
+            return float('inf'), None
 
-    Returns:
-    - None
-    """
+        L = self.max_loop if self.max_loop is not None else j-i
 
-    if sequence[i] + sequence[j] in basepairs:
-        v = min(find_E1(i, j), 
-                find_E2(i, j, V)[0], 
-                find_E3(i, j, W)[0])
+        #All i' in [i+1, j-3] and j' in [i'+3, j-1] in the order they are tried, with at most L unpaired bases between the pairs
+        ip = np.arange(i+1, min(j-2, i+2+L))[:, None]
+        jp = np.arange(max(0, j-1-L), j)[None, :]
+        allowed = (jp >= ip+3) & ((ip-i-1) + (j-jp-1) <= L) & self.can_pair[self.codes[ip], self.codes[jp]]
 
-    else: 
-        v = float('inf')
+        #V is only read for the allowed pairs, which are kept in the order they are tried
+        a, b = np.nonzero(allowed)
+        ip, jp = ip[a, 0], jp[0, b]
+        energies = self.matrix[i, j] + V[ip, jp]
 
-    V[i, j] = v
+        if len(energies) == 0:
+            return float('inf'), None
 
-def compute_W(i: int, j: int, W: torch.Tensor, V: torch.Tensor) -> None:
-    """
-    Computes the minimization over possibilities for W and fills out the entry at W[i,j]
-     Possibilities are: 
-    - i or j in a structure (W[i+1, j] or W[i, j-1])
-    - i and j basepair with each other (V[i,j])
-    - i and j both base pair but not with each other (E4)
+        k = np.argmin(energies)
+        if not energies[k] < float('inf'):
+            return float('inf'), None
 
-    Parameters:
-    - i (int): The start index of the subsequence
-    - j (int): The end index of the subsequence
-    - W (torch.Tensor): The W matrix
-    - V (torch.Tensor): The V matrix
+        return energies[k], (ip[k], jp[k])
 
-    Returns:
-    - None
-    """
-    w = min(W[i+1,j], W[i,j-1], V[i,j], find_E4(i, j, W)[0])
+    def find_E2_window(self, l: int, n: int, V: DPTable) -> np.ndarray:
+        """
+        Finds the minimum of V[i', j'] over all i' and j' that close an internal loop of at most max_loop unpaired bases with i and j,
+        for the n cells on the diagonal V[i, i+l]
 
-    W[i,j] = w
+        The window is enumerated one i' at a time, where all j' for all cells are read from a view of V
 
+        Parameters:
+        - l (int): The difference between the end and start index of the subsequences
+        - n (int): The number of cells on the diagonal
+        - V (DPTable): The V matrix
 
-def fold_rna() -> tuple[torch.Tensor, torch.Tensor]: 
-    """
-    Fills out the W and V matrices to find the fold that gives the minimum free energy
-    Follows Mfold as desribed by M. Zuker
+        Returns:
+        - energy (np.ndarray): The minimum of V in the window of each cell
+        """
+        #Inner pairs must span at least 4, so i'-i-1 + j-j'-1 <= l-6
+        D = min(self.max_loop, l-6)
+        energy = np.full(n, np.inf, dtype=V.dtype)
 
-    The V matrix contains the minimum free energy for the subsequences i and j, if i and j has to form a pair. 
-    If i and j are not able to basepair the energy will be infinity (not a possible structure)
+        for a in range(D+1): #i' = i+1+a, j' in [j-1-(D-a), j-1]
+            energy = np.minimum(energy, V.view(1+a, l-1-D+a, n, 0, 1, D-a+1).min(axis=0))
 
-    The W matrix contains the minimum free energy for the subsequences i and j where base pairing between i and j is not nessecary.
+        return energy
 
-    The floats in the matrix M is used as energy parameters for pairing of the different nucleotides.
+    def find_E3_diagonal(self, i: int, j: int, n: int, W: DPTable) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Finds E3 for the n cells on the diagonal starting at (i, j)
+        E3 is the energy of a structure that contains more than two internal edges (bifurcating loop)
+        The energy is the energy of the sum of the substructures W[i+1, i'] + W[i'+1, j-1] with i+1<i'<j-2
+
+        Parameters:
+        - i (int): The start index of the first subsequence
+        - j (int): The end index of the first subsequence
+        - n (int): The number of cells on the diagonal
+        - W (DPTable): The W matrix
+
+        Returns:
+        - energy (np.ndarray): The minimum energy of each cell
+        - ip (np.ndarray): The i' that gives the minimum energy of each cell, or -1 if no structure is possible
+        """
+        K = j-i-4 #i' in [i+2, j-3]
 
-    Returns:
-    - W (torch.Tensor): The W matrix
-    - V (torch.Tensor): The V matrix
-    """
-    N = len(sequence)
-    W, V = torch.full([N, N], float('inf'), device=dv), torch.full([N, N], float('inf'), device=dv)
+        if K <= 0:
+            return np.full(n, np.inf, dtype=W.dtype), np.full(n, -1)
 
+        energies = W.view(i+1, i+2, n, 0, 1, K) + W.view(i+3, j-1, n, 1, 0, K)
 
-    #Fills out the table with all posible penta nucleotide subsequences
-    # Penta nucleotides are the base cases. If subsequences are shorter they cannot be folded
-    penta_nucleotides(W, V) 
+        k = np.argmin(energies, axis=0)
+        energy = np.take_along_axis(energies, k[None, :], axis=0)[0]
 
-    for l in range(5, N): #Computes the best score for all subsequences that are longer than 5 nucleotides with increasing length
-        for i in range(0, N-5): 
-            j = i+l
-            if j < N: 
-                compute_V(i, j, W, V) 
-                compute_W(i, j, W, V)
+        return energy, np.where(energy < np.inf, np.arange(i, i+n) + 2 + k, -1)
 
-    return W, V
+    def find_E3(self, i: int, j: int, W: DPTable) -> tuple[float, tuple[int, int]]:
+        """
+        E3 is the energy of a structure that contains more than two internal edges (bifurcating loop)
+        The energy is the energy of the sum of the substructures
+        i+1<i'<j-2
+
+        Parameters:
+        - i (int): The start index of the subsequence
+        - j (int): The end index of the subsequence
+        - W (DPTable): The W matrix
+
+        Returns:
+        - energy (float): The minimum energy of the basepairing given that more than two internal edges are formed
+        - ij (tuple[int, int]): The indices of the subsequence that gives the minimum energy
+        """
+        energy, ip = self.find_E3_diagonal(i, j, 1, W)
 
+        return energy[0], ((ip[0], ip[0]+1) if ip[0] >= 0 else None)
 
-### BACTRACKING ### 
+    def find_E4_diagonal(self, i: int, j: int, n: int, W: DPTable) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Finds E4 for the n cells on the diagonal starting at (i, j)
+        E4 is the energy when i and j are both in base pairs, but not with each other.
+        It find the minimum of W[i, i'] + W[i'+1, j] with i<i'<j-1
+
+        Parameters:
+        - i (int): The start index of the first subsequence
+        - j (int): The end index of the first subsequence
+        - n (int): The number of cells on the diagonal
+        - W (DPTable): The W matrix
+
+        Returns:
+        - energy (np.ndarray): The minimum energy of each cell
+        - ip (np.ndarray): The i' that gives the minimum energy of each cell, or -1 if no structure is possible
+        """
+        K = j-i-2 #i' in [i+1, j-2]
 
-def backtrack(W: torch.Tensor, V: torch.Tensor) -> list: 
-    """
-    Backtracks trough the W, V matrices to find the final fold
-    Returns the fold as a list of tuples containing the indices of the basepairs
+        if K <= 0:
+            return np.full(n, np.inf, dtype=W.dtype), np.full(n, -1)
 
-    Parameters:
-    - W (torch.Tensor): The W matrix
-    - V (torch.Tensor): The V matrix
+        energies = W.view(i, i+1, n, 0, 1, K) + W.view(i+2, j, n, 1, 0, K)
 
-    Returns:
-    - pairs (list): The secondary structure of the RNA
-    """
-    pairs = [i for i in range(W.shape[0])]
+        k = np.argmin(energies, axis=0)
+        energy = np.take_along_axis(energies, k[None, :], axis=0)[0]
+
+        return energy, np.where(energy < np.inf, np.arange(i, i+n) + 1 + k, -1)
+
+    def find_E4(self, i: int, j: int, W: DPTable) -> tuple[float, tuple[int, int]]:
+        """
+        E4 is the energy when i and j are both in base pairs, but not with each other.
+        It find the minimum of combinations of two possible subsequences containing i and j
+
+        Parameters:
+        - i (int): The start index of the subsequence
+        - j (int): The end index of the subsequence
+        - W (DPTable): The W matrix
+
+        Returns:
+        - energy (float): The minimum energy of the basepairing given that i and j are both in base pairs
+        - ij (tuple[int, int]): The indices of the subsequence that gives the minimum energy
+        """
+        energy, ip = self.find_E4_diagonal(i, j, 1, W)
+
+        return energy[0], ((ip[0], ip[0]+1) if ip[0] >= 0 else None)
+
+    def penta_nucleotides(self, W: DPTable, V: DPTable, P: DPTable) -> None:
+        """
+        Fills out the first entries in the matrices V and W
+        The shortest possible subsequences are of length 5 and can only form hairpin loops of size 3 if i and j basepair
+
+        Parameters:
+        - W (DPTable): The W matrix
+        - V (DPTable): The V matrix
+        - P (DPTable): The minimum of V over all inner subsequences
+
+        Returns:
+        - None
+        """
+        energy = np.where(self.pairing.diagonal(4), self.matrix.diagonal(4), np.inf)
+
+        for table in [W, V, P]:
+            table.set_diagonal(4, energy)
+
+        self.V_trace.set_diagonal(4, np.where(energy < np.inf, VTrace.HAIRPIN, VTrace.NONE))
+        self.W_trace.set_diagonal(4, np.where(energy < np.inf, WTrace.PAIR, WTrace.NONE))
+
+    ### FILL V AND W ###
+    def compute_V(self, l: int, W: DPTable, V: DPTable, P: DPTable) -> None:
+        """
+        Computes the minimization over E1, E2 and E3 for all cells on the diagonal V[i, i+l]
+
+        E2 is the pair energy plus the minimum of V[i', j'] for the allowed i<i'<j'<j. Since rounding is monotonic this is the same as the minimum of the sums.
+        Without a limit on the loop size the minimum over all inner subsequences is kept in P and updated for each diagonal.
+
+        Parameters:
+        - l (int): The difference between the end and start index of the subsequences
+        - W (DPTable): The W matrix
+        - V (DPTable): The V matrix
+        - P (DPTable): The minimum of V over all inner subsequences
+
+        Returns:
+        - None
+        """
+        n = len(self.sequence)-l
+
+        E1 = self.matrix.diagonal(l)
+        E2 = E1 + (P.diagonal(l-2)[1:n+1] if self.max_loop is None else self.find_E2_window(l, n, V))
+        E3, ip = self.find_E3_diagonal(0, l, n, W)
+
+        v = np.where(self.pairing.diagonal(l), np.minimum(np.minimum(E1, E2), E3), np.inf)
+
+        V.set_diagonal(l, v)
+        self.V_trace.set_diagonal(l, np.select([~(v < np.inf), v == E1, v == E2, v == E3], [VTrace.NONE, VTrace.HAIRPIN, VTrace.INTERNAL, VTrace.BIFURCATION], VTrace.NONE))
+        self.V_split.set_diagonal(l, ip)
+        if self.max_loop is None:
+            P.set_diagonal(l, np.minimum(v, np.minimum(P.diagonal(l-1)[1:n+1], P.diagonal(l-1)[:n])))
+
+    def compute_W(self, l: int, W: DPTable, V: DPTable) -> None:
+        """
+        Computes the minimization over possibilities for W and fills out the cells on the diagonal W[i, i+l]
+         Possibilities are:
+        - i or j in a structure (W[i+1, j] or W[i, j-1])
+        - i and j basepair with each other (V[i,j])
+        - i and j both base pair but not with each other (E4)
+
+        Parameters:
+        - l (int): The difference between the end and start index of the subsequences
+        - W (DPTable): The W matrix
+        - V (DPTable): The V matrix
+
+        Returns:
+        - None
+        """
+        n = len(self.sequence)-l
+
+        skip_i, skip_j = W.diagonal(l-1)[1:n+1], W.diagonal(l-1)[:n]
+        E4, ip = self.find_E4_diagonal(0, l, n, W)
+
+        w = np.minimum(np.minimum(skip_i, skip_j), np.minimum(V.diagonal(l), E4))
+
+        W.set_diagonal(l, w)
+        self.W_trace.set_diagonal(l, w_trace(w, skip_i, skip_j, V.diagonal(l), E4))
+        self.W_split.set_diagonal(l, ip)
 
-    N = W.shape[0]-1
-    
-    j = W.shape[0]-1
-    i = 0
 
-    def trace_V(i: int, j: int) -> None: 
+    def fold_rna(self) -> tuple[DPTable, DPTable]:
         """
-        Traces backwards trough the V matrix recursively to find the secondary structure
+        Fills out the W and V matrices to find the fold that gives the minimum free energy
+        Follows Mfold as desribed by M. Zuker
+
+        The V matrix contains the minimum free energy for the subsequences i and j, if i and j has to form a pair.
+        If i and j are not able to basepair the energy will be infinity (not a possible structure)
+
+        The W matrix contains the minimum free energy for the subsequences i and j where base pairing between i and j is not nessecary.
+
+        The floats in the matrix M is used as energy parameters for pairing of the different nucleotides.
+
+        The matrices are filled one diagonal (subsequences of the same length) at a time, since all cells on a diagonal only depend on shorter subsequences.
+        With a span only the diagonals up to the span are filled.
+
+        Returns:
+        - W (DPTable): The W matrix
+        - V (DPTable): The V matrix
         """
-        if V[i,j] == find_E1(i, j): 
-            pairs[i] = j
-            pairs[j] = i
-        
-        elif V[i,j] == find_E2(i, j, V)[0]:
-            ij = find_E2(i, j, V)[1]
-            pairs[i] = j
-            pairs[j] = i
-            trace_V(ij[0], ij[1])
-    
-        elif V[i, j] == find_E3(i, j, W)[0]: 
-            ij = find_E3(i, j, W)[1]
-            pairs[i] = j
-            pairs[j] = i
-            trace_W(i+1, ij[0]), trace_W(ij[1], j-1)
-
-    def trace_W(i: int, j: int) -> None: 
+        N = len(self.sequence)
+        W, V, P = self.tables(N, self.matrix.dtype)
+        L = N if self.span is None else self.span+1
+
+
+        #Fills out the table with all posible penta nucleotide subsequences
+        # Penta nucleotides are the base cases. If subsequences are shorter they cannot be folded
+        if L > 4:
+            self.penta_nucleotides(W, V, P)
+
+        for l in range(5, L): #Computes the best score for all subsequences that are longer than 5 nucleotides with increasing length
+            self.compute_V(l, W, V, P)
+            self.compute_W(l, W, V)
+
+        return W, V
+
+
+    ### BACTRACKING ###
+    def backtrack(self, W: DPTable, V: DPTable) -> list:
         """
-        Traces backwards trough the W matrix recursively to find the secondary structure
+        Backtracks trough the trace codes of the W, V matrices to find the final fold
+        The cells left to trace are kept on a stack, so there is no limit on the depth of the structure
+
+        Parameters:
+        - W (DPTable): The W matrix
+        - V (DPTable): The V matrix
+
+        Returns:
+        - pairs (list): The secondary structure of the RNA
         """
-        if i < N and W[i,j] == W[i+1, j]: 
-            trace_W(i+1, j)
+        def trace_V(i: int, j: int) -> list:
+            """
+            Returns the cells to trace inside the basepair i, j
+            The inner pair of an internal loop is only found for the pairs in the structure, since it is not stored when filling V
+            """
+            code = self.V_trace[i, j]
 
-        elif j > 0 and W[i,j] == W[i, j-1]: 
-            trace_W(i, j-1)
+            if code == VTrace.INTERNAL:
+                ij = self.find_E2(i, j, V)[1]
+                return [('V', int(ij[0]), int(ij[1]))]
 
-        elif W[i, j] == V[i, j]: 
-            trace_V(i, j)
+            if code == VTrace.BIFURCATION:
+                k = int(self.V_split[i, j])
+                return [('W', i+1, k), ('W', k+1, j-1)]
 
-        elif W[i,j] == find_E4(i, j, W)[0]: 
-            ij = find_E4(i,j,W)[1] 
-            trace_W(i, ij[0]), trace_W(ij[1], j)
-    
-    #Fill out the pairs list with the secondary structure
-    trace_W(i, j)
+            return []
 
-    return pairs
+        #Start from the full sequence, or from the substructures in the exterior loop if the tables are banded
+        if W.span is None:
+            stack = [('W', 0, W.N-1)]
+        else:
+            stack = [('V', i, j) for i, j in exterior_pairs(V)]
 
+        return backtrack_stack(W.N, stack, self.W_trace, self.W_split, trace_V)
 
-def Mfold(sequence: str, matrix: torch.Tensor, device: str) -> list: 
+    def fold(self, sequence: str, matrix: torch.Tensor) -> list:
+        """
+        Folds the RNA sequence to find the secondary structure with the minimum free energy
+        Uses the matrix as energy parameters for the different basepairs
+
+        Parameters:
+        - sequence (str): The RNA sequence to fold
+        - matrix (torch.Tensor): The energy matrix used to calculate the energy of the different basepairs
+
+        Returns:
+        - fold (list): The secondary structure of the RNA
+        """
+        self.set_sequence(sequence, matrix)
+
+        W, V = self.fold_rna()
+        fold = self.backtrack(W, V)
+
+        return [int(x) for x in fold]
+
+
+def Mfold(sequence: str, matrix: torch.Tensor, device: str, max_loop: int = 30, span: int = None) -> list:
     """
     Folds the RNA sequence to find the secondary structure with the minimum free energy
     Uses the matrix as energy parameters for the different basepairs
@@ -291,13 +436,11 @@ def Mfold(sequence: str, matrix: torch.Tensor, device: str) -> list:
     Parameters:
     - sequence (str): The RNA sequence to fold
     - matrix (torch.Tensor): The energy matrix used to calculate the energy of the different basepairs
+    - device (str): The device to run the calculations on
+    - max_loop (int): The maximum number of unpaired bases in internal loops. None allows all internal loops. Default is 30
+    - span (int): The maximum distance j-i between paired bases, where the tables are stored banded. None allows all basepairs. Default is None
 
     Returns:
     - fold (list): The secondary structure of the RNA
     """
-    declare_global_variable(sequence, matrix, device)
-
-    W, V = fold_rna()
-    fold = backtrack(W, V)
-
-    return fold 
\ No newline at end of file
+    return MfoldEngine(device, max_loop, span).fold(sequence, matrix)
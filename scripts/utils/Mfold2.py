@@ -1,56 +1,72 @@
-import math, os, torch
+import bisect, math, os, torch
+import numpy as np
 import pandas as pd
 
-####### HELP FUNCTIONS #######
+from functools import lru_cache
+from enum import IntEnum
+
+from utils.dp_tables import DPTable, WTrace, backtrack_stack, exterior_pairs, reuse_buffer, w_trace
 
+####### HELP FUNCTIONS #######
+LOOP_TYPES = ['IL', 'BL', 'HL']
 
-def declare_global_variable(seq: str, M: torch.Tensor, device: str) -> None: 
+class VTrace(IntEnum):
+    """
+    The loop that gives the minimum energy of V[i, j], in the order they are tried when backtracking
     """
-    Declares the global variables used troughout all the other functions. 
+    NONE = 0 #i and j cannot pair
+    HAIRPIN = 1
+    STACKING = 2
+    BULGE_3END = 3
+    BULGE_5END = 4
+    INTERIOR = 5
+    BIFURCATION = 6
 
-    Parameters:
-    - seq (str): The RNA sequence to fold
-    - M (torch.Tensor): The energy matrix used to calculate the energy of the different basepairs
-    - device (str): The device to run the calculations on
+@lru_cache(maxsize=None)
+def read_parameters() -> tuple[list, np.ndarray, np.ndarray]:
+    """
+    Reads the energy parameter files into NumPy arrays. The files are only read once per process, and the arrays are read-only so they can be shared by all engines.
 
     Returns:
-    - None
+    - pair_types (list): The basepairs in the order of the stacking table
+    - stacking_table (np.ndarray): The stacking energies indexed by the pair types. The last row and column are 0, so they are used for bases that cannot pair
+    - loop_table (np.ndarray): The loop energies of size 0 to 10, with a column for each loop type
     """
-    global basepairs, sequence, matrix, parameters, asymmetric_penalty_function, dv
-
     #Find absolute path of script, to be able to open csv files whereever the script is called from
     script_dir = os.path.dirname(os.path.abspath(__file__))
     file_stacking = os.path.join(script_dir, 'parameters', 'stacking_1988.csv')
     file_loop = os.path.join(script_dir, 'parameters', 'loop_1989.csv')
-    
+
     try:
-        loops = pd.read_csv(file_loop) 
+        loops = pd.read_csv(file_loop)
         stacking = pd.read_csv(file_stacking, index_col=0)
     except FileNotFoundError:
         raise FileNotFoundError("One or both parameter files not found")
     except pd.errors.EmptyDataError:
         raise ValueError("One or both parameter files are empty or in an unexpected file format")
-    
-    basepairs = {'AU', 'UA', 'CG', 'GC', 'GU', 'UG'}
-    sequence = seq
-    matrix = M
-    parameters = (loops, stacking)
-    asymmetric_penalty_function = make_asymmetric_penalty([0.4, 0.3, 0.2, 0.1], 3)
-    dv = device
 
+    pair_types = list(stacking.index)
+    stacking_table = np.zeros((len(pair_types)+1, len(pair_types)+1), dtype=np.float32)
+    stacking_table[:-1, :-1] = stacking.loc[pair_types, pair_types].to_numpy()
+
+    loop_table = loops[LOOP_TYPES].to_numpy(dtype=np.float64)
+
+    stacking_table.setflags(write=False)
+    loop_table.setflags(write=False)
+
+    return pair_types, stacking_table, loop_table
 
-####### FOLD FUNCTIONS #######
-def make_asymmetric_penalty(f: list, penalty_max: int) -> callable: 
+def make_asymmetric_penalty(f: list, penalty_max: int) -> callable:
     """
     f has to be a list. In articles writen as f(1), f(2) and so forth
 
-    The asymmetry function is used to calculate a penalty to internal loops that are asymmetric. 
+    The asymmetry function is used to calculate a penalty to internal loops that are asymmetric.
     This penalty does not exists in the orginial paper, but is added later
 
     This functions returns a function that uses the given parameters to calculate the penalty for asymmetric loops of given size
 
-    Parameters: 
-    - f: list that gives the values from f(0) to f(m_max). 
+    Parameters:
+    - f: list that gives the values from f(0) to f(m_max).
     - penalty_max: that maximum penalty that can be addded to ad asymmetric interior loop
 
     Returns:
@@ -61,450 +77,900 @@ def make_asymmetric_penalty(f: list, penalty_max: int) -> callable:
 
     def asymmetry_func(i: int, ip: int, j: int, jp: int) -> float:
         """
-        Calculates the penalty to add to the asymmetric interior loop enclosed by the base pairs i and j and i' and p' 
+        Calculates the penalty to add to the asymmetric interior loop enclosed by the base pairs i and j and i' and p'
+        Works on arrays of indices as well, to find the penalty for several loops at once
         """
         N1 = (ip-i-1)
         N2 =(j-jp-1)
-        N = abs(N1-N2)
-        M = min(M_max, N1, N2)-1
-        penalty = min(penalty_max, N*f[M]) 
+        N = np.abs(N1-N2)
+        M = np.minimum(np.minimum(M_max, N1), N2)-1
+        penalty = np.minimum(penalty_max, N*np.asarray(f)[M])
         return penalty
 
     return asymmetry_func
 
-def loop_greater_10(loop_type: str, length: int) -> float:
+def first_minimum(energies: np.ndarray, start: int) -> tuple[np.ndarray, np.ndarray]:
     """
-    Calculates the energy parameters for loops with a size greater than 10 
-    The parameter is calculated as described in 'Improved predictions of secondary structures for RNA'
+    Finds the minimum energy of each cell (column) and the first index where it is found, as when trying the options in order
 
-    Parameters: 
-    - loop_type (str): type of loop to calculate energy for (HL, IL or BL)
-    - length (int): length of the loop
+    Parameters:
+    - energies (np.ndarray): The energies of the options for each cell, with shape (K, n)
+    - start (int): The index of the first option
 
     Returns:
-    - G (float): The energy of the loop
+    - energy (np.ndarray): The minimum energy of each cell
+    - index (np.ndarray): The index of the option that gives the minimum energy, or -1 if no option is possible
     """
-    R = 0.001987 #In kcal/(mol*K)
-    T = 310.15 #In K
-    G_max = parameters[0].at[10, loop_type]
+    k = np.argmin(energies, axis=0)
+    energy = np.take_along_axis(energies, k[None, :], axis=0)[0]
 
-    G = G_max + 1.75*R*T*math.log(length/10)
+    return energy, np.where(energy < np.inf, start + k, -1)
 
-    return G
 
-### LOOP ENERGIES ###
-def stacking(i: int, j: int, V: torch.Tensor) -> float: 
+####### MFOLD ENGINE #######
+class MfoldEngine:
     """
-    Find the energy parameter for basepairing of Sij and Si+1j-1, which results in basepair stacking
-    If Si+1 and Sj+1 cannot basepair the energy is infinity
-    Allows for Watson-Crick basepairs and wobble basepairs
+    Folds RNA sequences with Mfold using a matrix as constraints for which basepairs are allowed.
+    All state of a fold is kept on the engine, so several engines can fold in parallel threads.
+    The energy parameters and DP tables are kept between folds and only extended if a longer sequence is folded, so an engine can be reused for many sequences.
 
-    Parameters:
-    - i (int): The start index of the subsequence
-    - j (int): The end index of the subsequence
-    - V (torch.Tensor): The V matrix
+    Bulge and interior loops are limited to max_loop unpaired bases, which makes the loops O(N^2*max_loop^2) instead of O(N^4).
+    With max_loop set to None all loops are allowed.
 
-    Returns:
-    - energy (float): The energy of the basepairing
+    With a span only basepairs with j-i <= span are allowed, and the tables are stored banded with O(N*span) memory and filled in O(N*span^2) time.
+    The structures found in the band are combined over the full sequence in the exterior loop.
     """
+    def __init__(self, device: str = 'cpu', max_loop: int = 30, span: int = None) -> None:
+        self.basepairs = {'AU', 'UA', 'CG', 'GC', 'GU', 'UG'}
+        self.dv = device
+        self.max_loop = max_loop
+        self.max_span = span
+        self.pair_types, self.stacking_table, self.loop_table = read_parameters()
+        self.asymmetric_penalty_function = make_asymmetric_penalty([0.4, 0.3, 0.2, 0.1], 3)
+        self.loop_energies, self.interior_energies = None, None
+        self.buffer, self.trace_buffer, self.split_buffer = None, None, None
 
-    prev_bp = sequence[i+1] + sequence[j-1]   
-    
-    #If previous bases can form a base pair stacking is possible
-    if matrix[i+1, j-1] and prev_bp in basepairs: 
-        current_bp = sequence[i] + sequence[j]
-        energy = parameters[1].at[current_bp, prev_bp] + V[i+1, j-1]
-    
-    else: 
-        energy = float('inf')
-    
-    return energy
-
-def bulge_loop_3end(i: int, j: int, V: torch.Tensor) -> tuple[float, int]: 
-    """
-    Find the energy parameter of introducing a bulge loop on the 3' end of the strand 
+    def load_parameters(self, N: int) -> None:
+        """
+        Finds the loop energies by size, with the energies of loops longer than 10 extrapolated in advance for all sizes up to N.
+        The loop energies are only recalculated if a longer sequence is folded.
 
-    Parameters:
-    - i (int): The start index of the subsequence
-    - j (int): The end index of the subsequence
-    - V (torch.Tensor): The V matrix
+        Parameters:
+        - N (int): The length of the sequence to fold
 
-    Returns:
-    - energy (float): The energy of the bulge loop
-    - ij (int): The index of the subsequence that gives the minimum energy
-    """
-    energy = float('inf')
-    ij = None
-
-    #Try all sizes of bulge loop and save the one that gives the lowest energy
-    for jp in range(i+2,j-1):  
-        bp = sequence[i+1]+sequence[jp]
-        if matrix[i+1, jp] and bp in basepairs: 
-            size = j-jp-1
-            if size <= 10:
-               BL_energy = parameters[0].at[size, "BL"] + V[i+1, jp]
-               if size == 1: #Add stacking parameter if stacking for bulge loops is retained
-                   BL_energy += parameters[1].at[(sequence[i]+sequence[j]), bp]
-            else: 
-                BL_energy = loop_greater_10("BL", size) + V[i+1, jp]
-            
-            if BL_energy < energy: 
-                energy = BL_energy
-                ij = jp
-    
-    return energy, ij
-
-def bulge_loop_5end(i: int, j: int, V: torch.Tensor) -> tuple[float, int]:
-    """
-    Find the energy parameter of introducing a bulge loop on the 5' end of the strand
+        Returns:
+        - None
+        """
+        if self.loop_energies is None or len(self.loop_energies) <= N:
+            #Loop energies for all sizes, rounded to float32 as they are when they are added to the tables
+            self.loop_energies = np.array([self.loop_table[size] if size <= 10 else [self.loop_greater_10(loop_type, size) for loop_type in LOOP_TYPES] for size in range(N+1)], dtype=np.float32)
 
-    Parameters:
-    - i (int): The start index of the subsequence
-    - j (int): The end index of the subsequence
-    - V (torch.Tensor): The V matrix
+            #Interior loops use the extrapolated energy for all sizes
+            self.interior_energies = np.array([np.inf] + [self.loop_greater_10("IL", size) for size in range(1, N+1)], dtype=np.float32)
 
-    Returns:
-    - energy (float): The energy of the bulge loop 
-    - ij (int): The index of the subsequence that gives the minimum energy
-    """
-    energy = float('inf')
-    ij = None
-    
-    #Try all sizes of bulge loop and save the one that gives the lowest energy
-    for ip in range(i+2,j-1):  
-        bp = sequence[ip]+sequence[j-1]
-        if matrix[ip, j-1] and bp in basepairs: 
-            size = ip-i-1
-            if size <= 10:
-                BL_energy = parameters[0].at[size, "BL"] + V[ip, j-1]
-                if size == 1: #Add stacking parameter if stacking for bulge loops is retained
-                    BL_energy += parameters[1].at[(sequence[i]+sequence[j]), bp] 
-            else: 
-                BL_energy = loop_greater_10("BL", size) + V[ip, j-1]
-
-            if BL_energy < energy: 
-                energy = BL_energy
-                ij = ip
-
-    return energy, ij
-
-def interior_loop(i: int, j: int, V: torch.Tensor) -> tuple[float, tuple[int, int]]: 
-    """
-    Find the energy parameter of adding a interior loop
+    def set_sequence(self, seq: str, M: torch.Tensor) -> None:
+        """
+        Sets the sequence and constraint matrix to fold
 
-    Parameters:
-    - i (int): The start index of the subsequence
-    - j (int): The end index of the subsequence
-    - V (torch.Tensor): The V matrix
+        Parameters:
+        - seq (str): The RNA sequence to fold
+        - M (torch.Tensor): The matrix with the basepairs that are allowed
 
-    Returns:
-    - energy (float): The energy of the interior loop
-    - ij (tuple[int, int]): The indices of the subsequence that gives the minimum energy
-    """
-    
-    energy = float('inf')
-    ij = None
-
-    for ip in range(i+2, j-2): #Try loop of any size between i and i'
-        for jp in range(ip+3, j-1): #Try loop of any size between j and j'
-            bp_prime = sequence[ip] + sequence[jp]
-            if matrix[ip, jp] and bp_prime in basepairs:
-                size = (ip-i-1)+(j-jp-1)
-
-                IL_energy = (parameters[0].at[size, "IL"] + V[ip, jp]) if 0 > size <= 10 else (loop_greater_10("IL", size) + V[ip, jp])
-                
-                #Add penalty to energy if loop is asymmetric
-                if (ip-i-1) != (j-jp-1): 
-                    IL_energy += asymmetric_penalty_function(i, ip, j, jp)
-
-                #Add penalty if closing base pairs are AU og GU base pairs
-                bp = sequence[i] + sequence[j]
-                if bp in ['GU', 'UG', 'AU', 'UA']: 
-                    IL_energy += 0.9
-                if bp_prime in ['GU', 'UG', 'AU', 'UA']:
-                    IL_energy += 0.9 
-                
-                #Check if energy is smaller than current min
-                if IL_energy < energy: 
-                    energy = IL_energy
-                    ij = (ip, jp)
-    
-    return energy, ij
-
-def find_E1(i: int, j: int) -> float:
-    """
-    E1 are the energy of base pairing between Si and Sj with one internal edge (hairpin loop) 
+        Returns:
+        - None
+        """
+        N = len(seq)
+        self.load_parameters(N)
 
-    Parameters:
-    - i (int): The start index of the subsequence
-    - j (int): The end index of the subsequence
+        #The tables are only banded if the span is shorter than the sequence
+        self.span = self.max_span if self.max_span is not None and self.max_span < N-1 else None
 
-    Returns:
-    - energy (float): The energy of the basepairing
-    """
-    size = j-i-1    
+        self.sequence = seq
+        self.matrix = DPTable.from_dense(M.detach().cpu().numpy(), self.span, 0)
 
-    energy = parameters[0].at[size,"HL"] if size <= 10 else loop_greater_10("HL", size)
+        #Pairs of the sequence as indices in the stacking table, -1 if the bases cannot pair
+        codes = np.array(['ACGU'.find(x) for x in seq])
+        pair_table = np.array([[self.pair_types.index(x + y) if (x + y) in self.basepairs else -1 for y in 'ACGU'] + [-1] for x in 'ACGU'] + [[-1]*5])
+        self.pair_code = DPTable.from_cells(lambda i, j: pair_table[codes[i], codes[j]], N, int, self.span, -1)
 
-    return energy
+        self.allowed = DPTable((self.matrix.data != 0) & (self.pair_code.data >= 0), self.span, False)
+        self.weak_pairs = DPTable(np.where(np.isin(self.pair_code.data, [self.pair_types.index(bp) for bp in ['GU', 'UG', 'AU', 'UA']]), np.float32(0.9), np.float32(0)), self.span, 0)
 
-def find_E2(i: int, j: int, V: torch.Tensor) -> float: 
-    """
-    E2 is the energy of basepairing between i and j and i' and j' resulting in two internal edges (stacking, bulge loop or internal loop)
-    i<i'<j'<j
-    Returns the minimum of the 3 options  
+    def tables(self, N: int) -> tuple[DPTable, DPTable]:
+        """
+        Returns the W and V tables for a sequence of length N, filled with infinity
+        The tables that are used for backtracking (the trace codes of V and W and the split points of bifurcations) are set on the engine
+        The tables are stored in buffers that are only reallocated if they are too small
 
-    Parameters:
-    - i (int): The start index of the subsequence
-    - j (int): The end index of the subsequence
-    - V (torch.Tensor): The V matrix
+        Parameters:
+        - N (int): The length of the sequence
 
-    Returns:
-    - energy (float): The minimum energy of the basepairing given that two internal edges are formed
-    """
-    energy = min(stacking(i, j, V), 
-                 bulge_loop_3end(i, j, V)[0], 
-                 bulge_loop_5end(i, j, V)[0], 
-                 interior_loop(i, j, V)[0])
-    return energy
+        Returns:
+        - W, V (DPTable): The tables
+        """
+        rows, cols = DPTable.shape(N, self.span)
+        size = rows*cols
 
-def find_E3(i: int, j: int, W: torch.Tensor) -> tuple[float, tuple[int, int]]: 
-    """
-    E3 is the energy of a structure that contains more than two internal edges (bifurcating loop)
-    The energy is the energy of the sum of the substructures 
-    i+1<i'<j-2
+        self.buffer = reuse_buffer(self.buffer, 2*size, np.float32)
+        self.trace_buffer = reuse_buffer(self.trace_buffer, 2*size, np.int8)
+        self.split_buffer = reuse_buffer(self.split_buffer, 2*size, np.int32)
 
-    Parameters:
-    - i (int): The start index of the subsequence
-    - j (int): The end index of the subsequence
-    - W (torch.Tensor): The W matrix
+        self.V_trace, self.W_trace = (DPTable.empty(N, np.int8, self.span, WTrace.NONE, self.trace_buffer[k*size:(k+1)*size]) for k in range(2))
+        self.V_split, self.W_split = (DPTable.empty(N, np.int32, self.span, -1, self.split_buffer[k*size:(k+1)*size]) for k in range(2))
 
-    Returns:
-    - energy (float): The energy of the bifurcating loop
-    - ij (tuple[int, int]): The indices of the subsequence that gives the minimum energy
-    """
-    energy = float('inf')
-    ij = None
-
-    #Try all combinations of substructure and save the one that gives the lowest energy
-    for ip in range(i+2, j-2):  
-        loop_energy = W[i+1, ip] + W[ip+1, j-1]
-        if loop_energy < energy: 
-            energy = loop_energy
-            ij = (ip, ip+1)
-    return energy, ij
-
-def find_E4(i: int, j: int, W: torch.Tensor) -> tuple[float, tuple[int, int]]: 
-    """
-    E4 is the energy when i and j are both in base pairs, but not with each other. 
-    It find the minimum of combinations of two possible subsequences containing i and j
+        return tuple(DPTable.empty(N, np.float32, self.span, buffer=self.buffer[k*size:(k+1)*size]) for k in range(2))
 
-    Parameters:
-    - i (int): The start index of the subsequence
-    - j (int): The end index of the subsequence
-    - W (torch.Tensor): The W matrix
+    def loop_greater_10(self, loop_type: str, length: int) -> float:
+        """
+        Calculates the energy parameters for loops with a size greater than 10
+        The parameter is calculated as described in 'Improved predictions of secondary structures for RNA'
 
-    Returns:
-    - energy (float): The energy of the basepairing
-    - ij (tuple[int, int]): The indices of the subsequence that gives the minimum energy
-    """
-    energy = float('inf')
-    ij = None
+        Parameters:
+        - loop_type (str): type of loop to calculate energy for (HL, IL or BL)
+        - length (int): length of the loop
 
-    for ip in range(i+1, j-1): 
-        subsequence_energy = W[i, ip] + W[ip+1, j]
-        
-        if subsequence_energy < energy: 
-            energy = subsequence_energy
-            ij = (ip, ip+1)
+        Returns:
+        - G (float): The energy of the loop
+        """
+        R = 0.001987 #In kcal/(mol*K)
+        T = 310.15 #In K
+        G_max = self.loop_table[10, LOOP_TYPES.index(loop_type)]
 
-    return energy, ij
+        G = G_max + 1.75*R*T*math.log(length/10)
 
-def penta_nucleotides(W: torch.Tensor, V: torch.Tensor) -> None:
-    """
-    Fills out the first entries in the matrices V and W 
-    The shortest possible subsequences are of length 5 and can only form hairpin loops of size 3 if i and j basepair
+        return G
 
-    Parameters:
-    - W (torch.Tensor): The W matrix
-    - V (torch.Tensor): The V matrix
+    ### LOOP ENERGIES ###
+    # The energies are found for the n cells on the diagonal starting at (i, j), so a full diagonal can be computed at once
+    # Parameters are rounded to float32 before they are added to V, and terms are added in the same order as when the loops were written cell by cell
+    def stacking_diagonal(self, i: int, j: int, n: int, V: DPTable) -> np.ndarray:
+        """
+        Find the energy parameter for basepairing of Sij and Si+1j-1, which results in basepair stacking
+        If Si+1 and Sj+1 cannot basepair the energy is infinity
+        Allows for Watson-Crick basepairs and wobble basepairs
+
+        Parameters:
+        - i (int): The start index of the first subsequence
+        - j (int): The end index of the first subsequence
+        - n (int): The number of cells on the diagonal
+        - V (DPTable): The V matrix
+
+        Returns:
+        - energy (np.ndarray): The energy of the basepairing for each cell
+        """
+        if j-i < 2:
+            return np.full(n, np.inf, dtype=np.float32)
 
-    Returns:
-    - None
-    """
-    N = len(sequence)
-
-    for i in range(0, N-4): 
-        j = i+4
-        bp = sequence[i]+sequence[j]
-        if bp not in basepairs or not matrix[i, j]:
-            V[i,j] = W[i,j ]= float('inf')
-        else: 
-            V[i,j] = W[i,j] = parameters[0].at[3, "HL"] 
-
-### FILL V AND W ###
-def compute_V(i: int, j: int, W: torch.Tensor, V: torch.Tensor) -> None: 
-    """
-    Computes the minimization over E1, E2 and E3, which will give the value at V[i,j]
+        cells = np.arange(n)
+        inner = (i+1+cells, j-1+cells)
 
-    Parameters:
-    - i (int): The start index of the subsequence
-    - j (int): The end index of the subsequence
-    - W (torch.Tensor): The W matrix
-    - V (torch.Tensor): The V matrix
+        #If previous bases can form a base pair stacking is possible
+        energy = self.stacking_table[self.pair_code[i+cells, j+cells], self.pair_code[inner]] + V[inner]
 
-    Returns:
-    - None 
-    """
+        return np.where(self.allowed[inner], energy, np.float32(np.inf))
 
-    if matrix[i, j] and sequence[i]+sequence[j] in basepairs:
-        v = min(find_E1(i, j), 
-                find_E2(i, j, V), 
-                find_E3(i, j, W)[0])
+    def stacking(self, i: int, j: int, V: DPTable) -> float:
+        """
+        Find the energy parameter for basepairing of Sij and Si+1j-1, which results in basepair stacking
+
+        Parameters:
+        - i (int): The start index of the subsequence
+        - j (int): The end index of the subsequence
+        - V (DPTable): The V matrix
+
+        Returns:
+        - energy (float): The energy of the basepairing
+        """
+        return self.stacking_diagonal(i, j, 1, V)[0]
+
+    def bulge_loop_3end_diagonal(self, i: int, j: int, n: int, V: DPTable) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Find the energy parameter of introducing a bulge loop on the 3' end of the strand
+
+        Parameters:
+        - i (int): The start index of the first subsequence
+        - j (int): The end index of the first subsequence
+        - n (int): The number of cells on the diagonal
+        - V (DPTable): The V matrix
+
+        Returns:
+        - energy (np.ndarray): The energy of the bulge loop for each cell
+        - jp (np.ndarray): The index j' that gives the minimum energy for each cell, or -1 if no bulge loop is possible
+        """
+        K = j-i-3 #j' in [i+2, j-2]
+        Kc = K if self.max_loop is None else min(K, self.max_loop) #Bulges of at most max_loop bases
+
+        if Kc <= 0:
+            return np.full(n, np.inf, dtype=np.float32), np.full(n, -1)
+
+        cells = np.arange(n)
+
+        #Try all sizes of bulge loop, from the largest to a bulge of size 1
+        energies = self.loop_energies[Kc:0:-1, LOOP_TYPES.index("BL"), None] + V.view(i+1, i+2+K-Kc, n, 0, 1, Kc)
+
+        #Add stacking parameter if stacking for bulge loops is retained
+        energies[-1] += self.stacking_table[self.pair_code[i+cells, j+cells], self.pair_code[i+1+cells, j-2+cells]]
+
+        return first_minimum(energies, i+2+K-Kc+cells)
+
+    def bulge_loop_3end(self, i: int, j: int, V: DPTable) -> tuple[float, int]:
+        """
+        Find the energy parameter of introducing a bulge loop on the 3' end of the strand
+
+        Parameters:
+        - i (int): The start index of the subsequence
+        - j (int): The end index of the subsequence
+        - V (DPTable): The V matrix
+
+        Returns:
+        - energy (float): The energy of the bulge loop
+        - ij (int): The index of the subsequence that gives the minimum energy
+        """
+        energy, jp = self.bulge_loop_3end_diagonal(i, j, 1, V)
+
+        return energy[0], (jp[0] if jp[0] >= 0 else None)
+
+    def bulge_loop_5end_diagonal(self, i: int, j: int, n: int, V: DPTable) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Find the energy parameter of introducing a bulge loop on the 5' end of the strand
+
+        Parameters:
+        - i (int): The start index of the first subsequence
+        - j (int): The end index of the first subsequence
+        - n (int): The number of cells on the diagonal
+        - V (DPTable): The V matrix
+
+        Returns:
+        - energy (np.ndarray): The energy of the bulge loop for each cell
+        - ip (np.ndarray): The index i' that gives the minimum energy for each cell, or -1 if no bulge loop is possible
+        """
+        K = j-i-3 #i' in [i+2, j-2]
+        Kc = K if self.max_loop is None else min(K, self.max_loop) #Bulges of at most max_loop bases
+
+        if Kc <= 0:
+            return np.full(n, np.inf, dtype=np.float32), np.full(n, -1)
+
+        cells = np.arange(n)
+
+        #Try all sizes of bulge loop, from a bulge of size 1 to the largest
+        energies = self.loop_energies[1:Kc+1, LOOP_TYPES.index("BL"), None] + V.view(i+2, j-1, n, 1, 0, Kc)
+
+        #Add stacking parameter if stacking for bulge loops is retained
+        energies[0] += self.stacking_table[self.pair_code[i+cells, j+cells], self.pair_code[i+2+cells, j-1+cells]]
+
+        return first_minimum(energies, i+2+cells)
+
+    def bulge_loop_5end(self, i: int, j: int, V: DPTable) -> tuple[float, int]:
+        """
+        Find the energy parameter of introducing a bulge loop on the 5' end of the strand
+
+        Parameters:
+        - i (int): The start index of the subsequence
+        - j (int): The end index of the subsequence
+        - V (DPTable): The V matrix
+
+        Returns:
+        - energy (float): The energy of the bulge loop
+        - ij (int): The index of the subsequence that gives the minimum energy
+        """
+        energy, ip = self.bulge_loop_5end_diagonal(i, j, 1, V)
+
+        return energy[0], (ip[0] if ip[0] >= 0 else None)
+
+    def interior_loop_diagonal(self, i: int, j: int, n: int, V: DPTable) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Find the energy parameter of adding a interior loop
+
+        Parameters:
+        - i (int): The start index of the first subsequence
+        - j (int): The end index of the first subsequence
+        - n (int): The number of cells on the diagonal
+        - V (DPTable): The V matrix
+
+        Returns:
+        - energy (np.ndarray): The energy of the interior loop for each cell
+        - ip (np.ndarray): The index i' that gives the minimum energy for each cell, or -1 if no interior loop is possible
+        - jp (np.ndarray): The index j' that gives the minimum energy for each cell, or -1 if no interior loop is possible
+        """
+        l = j-i
+        cells = np.arange(n)
+
+        energy = np.full(n, np.inf, dtype=np.float32)
+        ip, jp = np.full(n, -1), np.full(n, -1)
+
+        #Add penalty if closing base pairs are AU og GU base pairs
+        closing_penalty = self.weak_pairs[i+cells, j+cells]
+
+        #The size of the loop only depends on j', since the loop between i and i' grows when the loop between j' and j shrinks
+        sizes = np.arange(l-5, 0, -1)
+
+        #Only j' that give loops of at most max_loop bases are tried, which also limits i' since there is at least one base on each side
+        L = l if self.max_loop is None else self.max_loop
+        s0 = max(0, l-5-L)
+
+        for a in range(2, min(l-4, L+1)): #Try loop of any size between i and i'
+            K = l-a-4 #j' in [i'+3, j-2]
+            if K <= s0:
+                continue
+            loop_energy = self.interior_energies[sizes[s0:K]]
+
+            #Add penalty to energy if loop is asymmetric
+            N2 = sizes[s0:K]-(a-1)
+            asymmetric_penalty = np.where(a-1 != N2, self.asymmetric_penalty_function(0, a, l, l-N2-1), 0).astype(np.float32)
+
+            energies = loop_energy[:, None] + V.view(i+a, i+a+3+s0, n, 0, 1, K-s0)
+            energies += asymmetric_penalty[:, None]
+            energies += closing_penalty[None, :]
+            energies += self.weak_pairs.view(i+a, i+a+3+s0, n, 0, 1, K-s0)
+
+            #Keep the first minimum, since i' is tried in increasing order
+            loop_min, loop_jp = first_minimum(energies, i+a+3+s0+cells)
+            better = loop_min < energy
+            energy[better] = loop_min[better]
+            ip[better], jp[better] = (i+a+cells)[better], loop_jp[better]
+
+        return energy, ip, jp
+
+    def interior_loop(self, i: int, j: int, V: DPTable) -> tuple[float, tuple[int, int]]:
+        """
+        Find the energy parameter of adding a interior loop
+
+        Parameters:
+        - i (int): The start index of the subsequence
+        - j (int): The end index of the subsequence
+        - V (DPTable): The V matrix
+
+        Returns:
+        - energy (float): The energy of the interior loop
+        - ij (tuple[int, int]): The indices of the subsequence that gives the minimum energy
+        """
+        energy, ip, jp = self.interior_loop_diagonal(i, j, 1, V)
+
+        return energy[0], ((ip[0], jp[0]) if ip[0] >= 0 else None)
+
+    def find_E1(self, i: int, j: int) -> float:
+        """
+        E1 are the energy of base pairing between Si and Sj with one internal edge (hairpin loop)
+
+        Parameters:
+        - i (int): The start index of the subsequence
+        - j (int): The end index of the subsequence
+
+        Returns:
+        - energy (float): The energy of the basepairing
+        """
+        size = j-i-1
+
+        return self.loop_energies[size, LOOP_TYPES.index("HL")]
+
+    def find_E2_diagonal(self, i: int, j: int, n: int, V: DPTable) -> tuple[np.ndarray, np.ndarray]:
+        """
+        E2 is the energy of basepairing between i and j and i' and j' resulting in two internal edges (stacking, bulge loop or internal loop)
+        i<i'<j'<j
+        Returns the minimum of the options
+
+        Parameters:
+        - i (int): The start index of the first subsequence
+        - j (int): The end index of the first subsequence
+        - n (int): The number of cells on the diagonal
+        - V (DPTable): The V matrix
+
+        Returns:
+        - energy (np.ndarray): The minimum energy of the basepairing given that two internal edges are formed for each cell
+        - loop (np.ndarray): The first loop that gives the minimum energy of each cell
+        """
+        stacking = self.stacking_diagonal(i, j, n, V)
+        bulge_3end = self.bulge_loop_3end_diagonal(i, j, n, V)[0]
+        bulge_5end = self.bulge_loop_5end_diagonal(i, j, n, V)[0]
+        interior = self.interior_loop_diagonal(i, j, n, V)[0]
 
-    else: 
-        v = float('inf')
+        energy = np.minimum(np.minimum(stacking, bulge_3end), np.minimum(bulge_5end, interior))
+        loop = np.select([energy == stacking, energy == bulge_3end, energy == bulge_5end, energy == interior],
+                         [VTrace.STACKING, VTrace.BULGE_3END, VTrace.BULGE_5END, VTrace.INTERIOR], VTrace.NONE)
 
-    V[i, j] = v
+        return energy, loop
 
-def compute_W(i: int, j: int, W: torch.Tensor, V: torch.Tensor) -> None:
+    def find_E3_diagonal(self, i: int, j: int, n: int, W: DPTable) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Finds E3 for the n cells on the diagonal starting at (i, j)
+        E3 is the energy of a structure that contains more than two internal edges (bifurcating loop)
+        The energy is the energy of the sum of the substructures W[i+1, i'] + W[i'+1, j-1] with i+1<i'<j-2
+
+        Parameters:
+        - i (int): The start index of the first subsequence
+        - j (int): The end index of the first subsequence
+        - n (int): The number of cells on the diagonal
+        - W (DPTable): The W matrix
+
+        Returns:
+        - energy (np.ndarray): The minimum energy of each cell
+        - ip (np.ndarray): The i' that gives the minimum energy of each cell, or -1 if no structure is possible
+        """
+        K = j-i-4 #i' in [i+2, j-3]
+
+        if K <= 0:
+            return np.full(n, np.inf, dtype=np.float32), np.full(n, -1)
+
+        energies = W.view(i+1, i+2, n, 0, 1, K) + W.view(i+3, j-1, n, 1, 0, K)
+
+        return first_minimum(energies, i+2+np.arange(n))
+
+    def find_E3(self, i: int, j: int, W: DPTable) -> tuple[float, tuple[int, int]]:
+        """
+        E3 is the energy of a structure that contains more than two internal edges (bifurcating loop)
+        The energy is the energy of the sum of the substructures
+        i+1<i'<j-2
+
+        Parameters:
+        - i (int): The start index of the subsequence
+        - j (int): The end index of the subsequence
+        - W (DPTable): The W matrix
+
+        Returns:
+        - energy (float): The energy of the bifurcating loop
+        - ij (tuple[int, int]): The indices of the subsequence that gives the minimum energy
+        """
+        energy, ip = self.find_E3_diagonal(i, j, 1, W)
+
+        return energy[0], ((ip[0], ip[0]+1) if ip[0] >= 0 else None)
+
+    def find_E4_diagonal(self, i: int, j: int, n: int, W: DPTable) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Finds E4 for the n cells on the diagonal starting at (i, j)
+        E4 is the energy when i and j are both in base pairs, but not with each other.
+        It find the minimum of W[i, i'] + W[i'+1, j] with i<i'<j-1
+
+        Parameters:
+        - i (int): The start index of the first subsequence
+        - j (int): The end index of the first subsequence
+        - n (int): The number of cells on the diagonal
+        - W (DPTable): The W matrix
+
+        Returns:
+        - energy (np.ndarray): The minimum energy of each cell
+        - ip (np.ndarray): The i' that gives the minimum energy of each cell, or -1 if no structure is possible
+        """
+        K = j-i-2 #i' in [i+1, j-2]
+
+        if K <= 0:
+            return np.full(n, np.inf, dtype=np.float32), np.full(n, -1)
+
+        energies = W.view(i, i+1, n, 0, 1, K) + W.view(i+2, j, n, 1, 0, K)
+
+        return first_minimum(energies, i+1+np.arange(n))
+
+    def find_E4(self, i: int, j: int, W: DPTable) -> tuple[float, tuple[int, int]]:
+        """
+        E4 is the energy when i and j are both in base pairs, but not with each other.
+        It find the minimum of combinations of two possible subsequences containing i and j
+
+        Parameters:
+        - i (int): The start index of the subsequence
+        - j (int): The end index of the subsequence
+        - W (DPTable): The W matrix
+
+        Returns:
+        - energy (float): The energy of the basepairing
+        - ij (tuple[int, int]): The indices of the subsequence that gives the minimum energy
+        """
+        energy, ip = self.find_E4_diagonal(i, j, 1, W)
+
+        return energy[0], ((ip[0], ip[0]+1) if ip[0] >= 0 else None)
+
+    def penta_nucleotides(self, W: DPTable, V: DPTable) -> None:
+        """
+        Fills out the first entries in the matrices V and W
+        The shortest possible subsequences are of length 5 and can only form hairpin loops of size 3 if i and j basepair
+
+        Parameters:
+        - W (DPTable): The W matrix
+        - V (DPTable): The V matrix
+
+        Returns:
+        - None
+        """
+        energy = np.where(self.allowed.diagonal(4), self.loop_energies[3, LOOP_TYPES.index("HL")], np.float32(np.inf))
+
+        for table in [W, V]:
+            table.set_diagonal(4, energy)
+
+        self.V_trace.set_diagonal(4, np.where(energy < np.inf, VTrace.HAIRPIN, VTrace.NONE))
+        self.W_trace.set_diagonal(4, np.where(energy < np.inf, WTrace.PAIR, WTrace.NONE))
+
+    ### FILL V AND W ###
+    def compute_V(self, l: int, W: DPTable, V: DPTable) -> None:
+        """
+        Computes the minimization over E1, E2 and E3 for all cells on the diagonal V[i, i+l]
+
+        Parameters:
+        - l (int): The difference between the end and start index of the subsequences
+        - W (DPTable): The W matrix
+        - V (DPTable): The V matrix
+
+        Returns:
+        - None
+        """
+        n = len(self.sequence)-l
+
+        E1 = self.find_E1(0, l)
+        E2, loop = self.find_E2_diagonal(0, l, n, V)
+        E3, ip = self.find_E3_diagonal(0, l, n, W)
+
+        v = np.where(self.allowed.diagonal(l), np.minimum(np.minimum(E1, E2), E3), np.float32(np.inf))
+
+        V.set_diagonal(l, v)
+        self.V_trace.set_diagonal(l, np.select([~(v < np.inf), v == E1, v == E2, v == E3], [VTrace.NONE, VTrace.HAIRPIN, loop, VTrace.BIFURCATION], VTrace.NONE))
+        self.V_split.set_diagonal(l, ip)
+
+    def compute_W(self, l: int, W: DPTable, V: DPTable) -> None:
+        """
+        Computes the minimization over possibilities for W and fills out the cells on the diagonal W[i, i+l]
+         Possibilities are:
+        - i or j in a structure (W[i+1, j] or W[i, j-1])
+        - i and j basepair with each other (V[i,j])
+        - i and j both base pair but not with each other (E4)
+
+        Parameters:
+        - l (int): The difference between the end and start index of the subsequences
+        - W (DPTable): The W matrix
+        - V (DPTable): The V matrix
+        """
+        n = len(self.sequence)-l
+
+        skip_i, skip_j = W.diagonal(l-1)[1:n+1], W.diagonal(l-1)[:n]
+        E4, ip = self.find_E4_diagonal(0, l, n, W)
+
+        w = np.minimum(np.minimum(skip_i, skip_j), np.minimum(V.diagonal(l), E4))
+
+        W.set_diagonal(l, w)
+        self.W_trace.set_diagonal(l, w_trace(w, skip_i, skip_j, V.diagonal(l), E4))
+        self.W_split.set_diagonal(l, ip)
+
+
+    def fold_rna(self) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Fills out the W and V matrices to find the fold that gives the minimum free energy
+        Follows Mfold as desribed by M. Zuker
+
+        The V matrix contains the minimum free energy for the subsequences i and j, if i and j has to form a pair.
+        If i and j are not able to basepair the energy will be infinity (not a possible structure)
+
+        The W matrix contains the minimum free energy for the subsequences i and j where base pairing between i and j is not nessecary.
+
+        Only base pairs that have a non-zero value in the M matrix are considered.
+
+        The matrices are filled one diagonal (subsequences of the same length) at a time, since all cells on a diagonal only depend on shorter subsequences.
+        With a span only the diagonals up to the span are filled.
+
+        Returns:
+        - W (DPTable): The W matrix
+        - V (DPTable): The V matrix
+        """
+        N = len(self.sequence)
+        W, V = self.tables(N)
+        L = N if self.span is None else self.span+1
+
+
+        #Fills out the table with all posible penta nucleotide subsequences
+        # Penta nucleotides are the base cases. If subsequences are shorter they cannot be folded
+        if L > 4:
+            self.penta_nucleotides(W, V)
+
+        for l in range(5, L): #Computes the best score for all subsequences that are longer than 5 nucleotides with increasing length
+            self.compute_V(l, W, V)
+            self.compute_W(l, W, V)
+
+        return W, V
+
+    ### BACTRACKING ###
+    def backtrack(self, W: DPTable, V: DPTable) -> list:
+        """
+        Backtracks trough the trace codes of the W, V matrices to find the final fold
+        The cells left to trace are kept on a stack, so there is no limit on the depth of the structure
+
+        Parameters:
+        - W (DPTable): The W matrix
+        - V (DPTable): The V matrix
+
+        Returns:
+        - pairs (list): The secondary structure of the RNA
+        """
+        def trace_V(i: int, j: int) -> list:
+            """
+            Returns the cells to trace inside the basepair i, j
+            The inner pair of bulge and interior loops is only found for the pairs in the structure, since it is not stored when filling V
+            """
+            code = self.V_trace[i, j]
+
+            if code == VTrace.STACKING:
+                return [('V', i+1, j-1)]
+
+            if code == VTrace.BULGE_3END:
+                return [('V', i+1, int(self.bulge_loop_3end(i, j, V)[1]))]
+
+            if code == VTrace.BULGE_5END:
+                return [('V', int(self.bulge_loop_5end(i, j, V)[1]), j-1)]
+
+            if code == VTrace.INTERIOR:
+                ij = self.interior_loop(i, j, V)[1]
+                return [('V', int(ij[0]), int(ij[1]))]
+
+            if code == VTrace.BIFURCATION:
+                k = int(self.V_split[i, j])
+                return [('W', i+1, k), ('W', k+1, j-1)]
+
+            return []
+
+        #Start from the full sequence, or from the substructures in the exterior loop if the tables are banded
+        if W.span is None:
+            stack = [('W', 0, W.N-1)]
+        else:
+            stack = [('V', i, j) for i, j in exterior_pairs(V)]
+
+        return backtrack_stack(W.N, stack, self.W_trace, self.W_split, trace_V)
+
+    def fold(self, sequence: str, matrix: torch.Tensor) -> list:
+        """
+        Folds a RNA sequence using Mfold as described by M. Zuker
+        Uses the matrix as constraints for which basepairs are allowed
+
+        Parameters:
+        - sequence (str): The RNA sequence to fold
+        - matrix (torch.Tensor): The energy matrix used to calculate the energy of the different basepairs
+
+        Returns:
+        - fold (list): The secondary structure of the RNA
+        """
+        self.set_sequence(sequence, matrix)
+
+        W, V = self.fold_rna()
+        fold = self.backtrack(W, V)
+
+        return [int(x) for x in fold]
+
+
+####### SPARSE MFOLD ENGINE #######
+class SparseMfoldEngine(MfoldEngine):
     """
-    Computes the minimization over possibilities for W and fills out the entry at W[i,j]
-     Possibilities are: 
-    - i or j in a structure (W[i+1, j] or W[i, j-1])
-    - i and j basepair with each other (V[i,j])
-    - i and j both base pair but not with each other (E4)
+    Folds RNA sequences with the same energy model as MfoldEngine, but only over the candidate basepairs allowed by the matrix.
+    Each position has a sorted list of the candidate partners, and V is only kept for the candidate pairs.
 
-    Parameters:
-    - i (int): The start index of the subsequence
-    - j (int): The end index of the subsequence
-    - W (torch.Tensor): The W matrix
-    - V (torch.Tensor): The V matrix
+    The W table is only stored at the starts and ends of candidate pairs, since W[i, j] = W[i', j'] where i' is the first start after i and j' is the last end before j.
+    A column of W is found from the previous column and the candidates that end in the column, with one vector operation per candidate.
+    The time and memory therefore scale with the number of candidates instead of the length of the sequence.
     """
-    w = min(W[i+1,j], W[i,j-1], V[i,j], find_E4(i, j, W)[0])
+    def __init__(self, device: str = 'cpu', max_loop: int = 30, span: int = None) -> None:
+        super().__init__(device, max_loop, span)
+        self.asymmetric_table = None
 
-    W[i,j] = w
+    def load_parameters(self, N: int) -> None:
+        """
+        Finds the loop energies by size as MfoldEngine, and the asymmetric penalties of interior loops in a table indexed by the number of unpaired bases on each side
 
+        Parameters:
+        - N (int): The length of the sequence to fold
 
-def fold_rna() -> tuple[torch.Tensor, torch.Tensor]: 
-    """
-    Fills out the W and V matrices to find the fold that gives the minimum free energy
-    Follows Mfold as desribed by M. Zuker
+        Returns:
+        - None
+        """
+        super().load_parameters(N)
 
-    The V matrix contains the minimum free energy for the subsequences i and j, if i and j has to form a pair. 
-    If i and j are not able to basepair the energy will be infinity (not a possible structure)
+        L = N if self.max_loop is None else min(N, self.max_loop)
+        if self.asymmetric_table is None or len(self.asymmetric_table) <= L:
+            N1, N2 = np.arange(L+1)[:, None], np.arange(L+1)[None, :]
+            penalty = self.asymmetric_penalty_function(0, N1+1, N1+N2+2, N1+1)
+            self.asymmetric_table = np.where((N1 != N2) & (N1 > 0) & (N2 > 0), penalty, 0).astype(np.float32)
 
-    The W matrix contains the minimum free energy for the subsequences i and j where base pairing between i and j is not nessecary.
+    def set_sequence(self, seq: str, M: torch.Tensor) -> None:
+        """
+        Sets the sequence to fold and finds the candidate basepairs, which are the pairs allowed by the matrix that can form a hairpin loop of at least 3 bases
 
-    Only base pairs that have a non-zero value in the M matrix are considered.
+        Parameters:
+        - seq (str): The RNA sequence to fold
+        - M (torch.Tensor): The matrix with the basepairs that are allowed
 
-    Returns:
-    - W (torch.Tensor): The W matrix
-    - V (torch.Tensor): The V matrix
-    """
-    N = len(sequence)
-    W, V = torch.full([N, N], float('inf'), device=dv), torch.full([N, N], float('inf'), device=dv)
+        Returns:
+        - None
+        """
+        N = len(seq)
+        self.load_parameters(N)
+        self.sequence = seq
 
+        codes = np.array(['ACGU'.find(x) for x in seq])
+        pair_table = np.array([[self.pair_types.index(x + y) if (x + y) in self.basepairs else -1 for y in 'ACGU'] + [-1] for x in 'ACGU'] + [[-1]*5])
 
-    #Fills out the table with all posible penta nucleotide subsequences
-    # Penta nucleotides are the base cases. If subsequences are shorter they cannot be folded
-    penta_nucleotides(W, V) 
+        i, j = np.nonzero(np.triu(M.detach().cpu().numpy() != 0, 4))
+        code = pair_table[codes[i], codes[j]]
+        keep = (code >= 0) if self.max_span is None else (code >= 0) & (j-i <= self.max_span)
+        i, j, code = i[keep].tolist(), j[keep].tolist(), code[keep].tolist()
 
-    for l in range(5, N): #Computes the best score for all subsequences that are longer than 5 nucleotides with increasing length
-        for i in range(0, N-5): 
-            j = i+l
-            if j < N: 
-                compute_V(i, j, W, V) 
-                compute_W(i, j, W, V)
+        #Candidate partners of each position, in increasing order
+        self.pair_code = dict(zip(zip(i, j), code))
+        self.partners_right, self.partners_left = {}, {}
+        for x, y in zip(i, j):
+            self.partners_right.setdefault(x, []).append(y)
+            self.partners_left.setdefault(y, []).append(x)
 
-    return W, V
+        weak = np.isin(np.arange(len(self.pair_types)), [self.pair_types.index(bp) for bp in ['GU', 'UG', 'AU', 'UA']])
+        self.weak_pairs = {ij: np.float32(0.9) if weak[c] else np.float32(0) for ij, c in self.pair_code.items()}
 
+        #Rows of W are the starts and columns the ends of the candidates
+        self.starts = np.unique(np.array(i, dtype=int))
+        self.ends = np.unique(np.array(j, dtype=int))
 
-### BACTRACKING ### 
-def backtrack(W: torch.Tensor, V: torch.Tensor) -> list: 
-    """
-    Backtracks trough the W, V matrices to find the final fold
-    Returns the fold as a list of tuples containing the indices of the basepairs
+    def row(self, i: int) -> int:
+        """
+        Returns the row of W for subsequences starting at i, which is the index of the first start at or after i
+        """
+        return int(np.searchsorted(self.starts, i, side='left'))
 
-    Parameters:
-    - W (torch.Tensor): The W matrix
-    - V (torch.Tensor): The V matrix
+    def column(self, j: int) -> int:
+        """
+        Returns the column of W for subsequences ending at j, which is the number of ends at or before j. Column 0 has no candidates
+        """
+        return int(np.searchsorted(self.ends, j, side='right'))
 
-    Returns:
-    - pairs (list): The secondary structure of the RNA
-    """
-    pairs = [i for i in range(W.shape[0])]
-
-    N = W.shape[0]-1
-    
-    j = W.shape[0]-1
-    i = 0
-
-    def trace_V(i: int, j: int) -> None: 
-        """
-        Traces backwards trough the V matrix recursively to find the secondary structure
-        """
-        if V[i,j] == find_E1(i, j):
-            pairs[i] = j
-            pairs[j] = i 
-
-    
-        elif V[i,j] == stacking(i, j, V):
-            pairs[i] = j
-            pairs[j] = i 
-            trace_V(i+1, j-1)
-    
-        elif V[i,j] == bulge_loop_3end(i, j, V)[0]: 
-            jp = bulge_loop_3end(i, j, V)[1]
-            pairs[i] = j
-            pairs[j] = i
-            trace_V(i+1, jp)
-    
-        elif V[i,j] == bulge_loop_5end(i, j, V)[0]: 
-            ip = bulge_loop_5end(i, j, V)[1]
-            pairs[i] = j   
-            pairs[j] = i
-            trace_V(ip, j-1)
-    
-        elif V[i,j] == interior_loop(i, j, V)[0]:
-            ij = interior_loop(i, j, V)[1]
-            pairs[i] = j
-            pairs[j] = i
-            trace_V(ij[0], ij[1])
-    
-        elif V[i, j] == find_E3(i, j, W)[0]: 
-            ij = find_E3(i, j, W)[1]
-            pairs[i] = j
-            pairs[j] = i
-            trace_W(i+1, ij[0]), trace_W(ij[1], j-1)
-
-    def trace_W(i: int, j: int) -> None: 
-        """
-        Traces backwards trough the W matrix recursively to find the secondary structure
-        """
-        if j >= i: 
-            return
-        
-        if i < N and W[i,j] == W[i+1, j]: 
-            trace_W(i+1, j)
-
-        elif j > 0 and W[i,j] == W[i, j-1]: 
-            trace_W(i, j-1)
-
-        elif W[i, j] == V[i, j]: 
-            trace_V(i, j)
-
-        elif W[i,j] == find_E4(i, j, W)[0]: 
-            ij = find_E4(i,j,W)[1] 
-            trace_W(i, ij[0]), trace_W(ij[1], j)
-    
-    #Fill out the pairs list with the secondary structure
-    trace_W(i, j)
-
-    return pairs
-
-
-def Mfold(sequence: str, matrix: torch.Tensor, device: str) -> list: 
+    def find_V(self, i: int, j: int, V: dict, M: np.ndarray) -> tuple[float, tuple]:
+        """
+        Finds the minimum energy of the candidate pair i and j, trying the loops in the same order as MfoldEngine
+
+        Parameters:
+        - i (int): The start index of the pair
+        - j (int): The end index of the pair
+        - V (dict): The energies of the candidate pairs that are already found
+        - M (np.ndarray): The table with the minimum energy of structures with at least two substructures
+
+        Returns:
+        - energy (float): The minimum energy of the pair
+        - trace (tuple): ('V', i', j') if the pair closes an internal loop, ('M', row, column) if it closes a bifurcating loop, or None for a hairpin loop
+        """
+        l = j-i
+        code = self.pair_code[i, j]
+        BL = LOOP_TYPES.index("BL")
+        L = l if self.max_loop is None else self.max_loop
+        Kc = min(l-3, L)
+
+        #Hairpin loop
+        energy, trace = self.find_E1(i, j), None
+
+        #Stacking
+        if (i+1, j-1) in V:
+            e = self.stacking_table[code, self.pair_code[i+1, j-1]] + V[i+1, j-1]
+            if e < energy:
+                energy, trace = e, ('V', i+1, j-1)
+
+        #Bulge loop on the 3' end, from the largest bulge to a bulge of size 1
+        partners = self.partners_right.get(i+1, [])
+        for jp in partners[bisect.bisect_left(partners, j-1-Kc):bisect.bisect_right(partners, j-2)]:
+            e = self.loop_energies[j-jp-1, BL] + V[i+1, jp]
+            if jp == j-2:
+                e += self.stacking_table[code, self.pair_code[i+1, jp]]
+            if e < energy:
+                energy, trace = e, ('V', i+1, jp)
+
+        #Bulge loop on the 5' end, from a bulge of size 1 to the largest
+        partners = self.partners_left.get(j-1, [])
+        for ip in partners[bisect.bisect_left(partners, i+2):bisect.bisect_right(partners, i+1+Kc)]:
+            e = self.loop_energies[ip-i-1, BL] + V[ip, j-1]
+            if ip == i+2:
+                e += self.stacking_table[code, self.pair_code[ip, j-1]]
+            if e < energy:
+                energy, trace = e, ('V', ip, j-1)
+
+        #Interior loops with at most L unpaired bases
+        closing_penalty = self.weak_pairs[i, j]
+        for a in range(2, min(l-4, L+1)):
+            partners = self.partners_right.get(i+a, [])
+            for jp in partners[bisect.bisect_left(partners, max(i+a+3, j+a-2-L)):bisect.bisect_right(partners, j-2)]:
+                e = self.interior_energies[(a-1) + (j-jp-1)] + V[i+a, jp]
+                e += self.asymmetric_table[a-1, j-jp-1]
+                e += closing_penalty
+                e += self.weak_pairs[i+a, jp]
+                if e < energy:
+                    energy, trace = e, ('V', i+a, jp)
+
+        #Bifurcating loop
+        r, c = self.row(i+1), self.column(j-1)
+        if M[c, r] < energy:
+            energy, trace = M[c, r], ('M', r, c)
+
+        return energy, trace
+
+    def fold_rna(self) -> tuple[dict, dict, np.ndarray, np.ndarray]:
+        """
+        Finds V for all candidate pairs and the columns of W, in increasing order of the end of the candidates.
+        All pairs that end at j only depend on pairs that end before j, and the column of j depends on the pairs that end at or before j.
+
+        Returns:
+        - V (dict): The energies of the candidate pairs
+        - trace (dict): The loop that gives the energy of each candidate pair
+        - W (np.ndarray): The minimum energy of structures in the subsequences, with a column for each end and a row for each start
+        - M (np.ndarray): The minimum energy of structures with at least two substructures, stored as W
+        """
+        W = np.full((len(self.ends)+1, len(self.starts)+1), np.inf, dtype=np.float32)
+        M = np.full((len(self.ends)+1, len(self.starts)+1), np.inf, dtype=np.float32)
+        V, trace = {}, {}
+
+        for c, j in enumerate(self.ends.tolist(), start=1):
+            W[c], M[c] = W[c-1], M[c-1]
+
+            for i in self.partners_left[j]:
+                V[i, j], trace[i, j] = self.find_V(i, j, V, M)
+
+                if V[i, j] < np.inf:
+                    #Add the pair to the structures in the rows that start at or before i
+                    r = self.row(i)+1
+                    before = W[self.column(i-1), :r] + V[i, j]
+                    W[c, :r] = np.minimum(W[c, :r], np.minimum(V[i, j], before))
+                    M[c, :r] = np.minimum(M[c, :r], before)
+
+        return V, trace, W, M
+
+    def backtrack(self, V: dict, trace: dict, W: np.ndarray, M: np.ndarray) -> list:
+        """
+        Backtracks trough the candidate pairs and W and M to find the final fold
+
+        Parameters:
+        - V (dict): The energies of the candidate pairs
+        - trace (dict): The loop that gives the energy of each candidate pair
+        - W (np.ndarray): The W table
+        - M (np.ndarray): The M table
+
+        Returns:
+        - pairs (list): The secondary structure of the RNA
+        """
+        pairs = [i for i in range(len(self.sequence))]
+        stack = [('W', self.row(0), len(self.ends))]
+
+        while stack:
+            table, i, j = stack.pop()
+
+            if table == 'V':
+                pairs[i], pairs[j] = j, i
+                if trace[i, j] is not None:
+                    stack.append(trace[i, j])
+                continue
+
+            #Find the last pair of the structure in row i and column j of W or M
+            T = W if table == 'W' else M
+            while j > 0 and T[j, i] < np.inf and T[j, i] == T[j-1, i]:
+                j -= 1
+            if j == 0 or not T[j, i] < np.inf:
+                continue
+
+            end = int(self.ends[j-1])
+            for start in self.partners_left[end]:
+                if self.row(start) < i or not V[start, end] < np.inf:
+                    continue
+                rest = self.column(start-1)
+                if table == 'W' and T[j, i] == V[start, end]:
+                    stack.append(('V', start, end))
+                    break
+                if T[j, i] == W[rest, i] + V[start, end]:
+                    stack += [('V', start, end), ('W', i, rest)]
+                    break
+
+        return pairs
+
+    def fold(self, sequence: str, matrix: torch.Tensor) -> list:
+        """
+        Folds a RNA sequence using Mfold over the candidate pairs in the matrix
+
+        Parameters:
+        - sequence (str): The RNA sequence to fold
+        - matrix (torch.Tensor): The matrix with the basepairs that are allowed
+
+        Returns:
+        - fold (list): The secondary structure of the RNA
+        """
+        self.set_sequence(sequence, matrix)
+
+        fold = self.backtrack(*self.fold_rna())
+
+        return [int(x) for x in fold]
+
+
+def Mfold(sequence: str, matrix: torch.Tensor, device: str, max_loop: int = 30, span: int = None) -> list:
     """
     Folds a RNA sequence using Mfold as described by M. Zuker
     Uses the matrix as constraints for which basepairs are allowed
@@ -512,13 +978,28 @@ def Mfold(sequence: str, matrix: torch.Tensor, device: str) -> list:
     Parameters:
     - sequence (str): The RNA sequence to fold
     - matrix (torch.Tensor): The energy matrix used to calculate the energy of the different basepairs
+    - device (str): The device to run the calculations on
+    - max_loop (int): The maximum number of unpaired bases in bulge and interior loops. None allows all loops. Default is 30
+    - span (int): The maximum distance j-i between paired bases, where the tables are stored banded. None allows all basepairs. Default is None
 
     Returns:
-    - fold (torch.Tensor): The secondary structure of the RNA
+    - fold (list): The secondary structure of the RNA
     """
-    declare_global_variable(sequence, matrix, device)
+    return MfoldEngine(device, max_loop, span).fold(sequence, matrix)
 
-    W, V = fold_rna()
-    fold = backtrack(W, V)
+def Mfold_sparse(sequence: str, matrix: torch.Tensor, device: str, max_loop: int = 30, span: int = None) -> list:
+    """
+    Folds a RNA sequence using Mfold over the candidate basepairs that are allowed by the matrix
+    Runs in time that scales with the number of candidates, which is useful when the matrix is sparse
 
-    return fold
\ No newline at end of file
+    Parameters:
+    - sequence (str): The RNA sequence to fold
+    - matrix (torch.Tensor): The matrix with the basepairs that are allowed
+    - device (str): The device to run the calculations on
+    - max_loop (int): The maximum number of unpaired bases in bulge and interior loops. None allows all loops. Default is 30
+    - span (int): The maximum distance j-i between paired bases. None allows all basepairs. Default is None
+
+    Returns:
+    - fold (list): The secondary structure of the RNA
+    """
+    return SparseMfoldEngine(device, max_loop, span).fold(sequence, matrix)
@@ -0,0 +1,361 @@
+import numpy as np
+
+from enum import IntEnum
+
+class WTrace(IntEnum):
+    """
+    The option that gives the minimum energy of W[i, j], in the order they are tried when backtracking
+    """
+    NONE = 0 #No structure is possible
+    SKIP_I = 1 #W[i+1, j]
+    SKIP_J = 2 #W[i, j-1]
+    PAIR = 3 #V[i, j]
+    SPLIT = 4 #W[i, i'] + W[i'+1, j]
+
+class DPTable:
+    """
+    Upper triangular table used for the dynamic programming in Mfold and Smith-Waterman, where cell (i, j) holds the value for the subsequence from i to j.
+    The cells are stored by diagonal, so cell (i, j) is found from i and d = j-i, and the cells of a diagonal are next to each other in memory.
+
+    The table is stored in one of two layouts:
+    - packed: A (N//2+1) x N matrix, where row d holds diagonal d followed by diagonal N-d. Diagonal d starts at [d, 0] if d <= N//2 and at [N-d, d] otherwise.
+      Only the cells with i <= j are kept, which halves the memory of a N x N matrix
+    - banded: A N x (span+1) matrix, where cell (i, j) is stored at [i, j-i]. Only cells with 0 <= j-i <= span are kept, which uses O(N*span) memory
+
+    Cells that are not stored have the fill value.
+    """
+    def __init__(self, data: np.ndarray, span: int = None, fill: float = np.inf) -> None:
+        self.data = data
+        self.span = span
+        self.fill = fill
+        self.N = data.shape[1] if span is None else data.shape[0]
+
+        #Flat index of the first cell of each stored diagonal, and the step between the cells of a diagonal
+        d = np.arange(self.N if span is None else min(span+1, self.N))
+        self.starts = np.where(d <= self.N//2, d*self.N, (self.N-d)*self.N + d) if span is None else d
+        self.step = 1 if span is None else span+1
+
+    @property
+    def dtype(self) -> np.dtype:
+        return self.data.dtype
+
+    @staticmethod
+    def shape(N: int, span: int = None) -> tuple[int, int]:
+        """
+        Returns the shape of the data of a table for a sequence of length N
+        """
+        return (N//2+1, N) if span is None else (N, span+1)
+
+    @classmethod
+    def empty(cls, N: int, dtype: np.dtype, span: int = None, fill: float = np.inf, buffer: np.ndarray = None) -> 'DPTable':
+        """
+        Makes a table filled with the fill value
+
+        Parameters:
+        - N (int): The length of the sequence
+        - dtype (np.dtype): The type of the table
+        - span (int): The maximum j-i that is stored. None stores all cells with i <= j
+        - fill (float): The value of cells that are not filled
+        - buffer (np.ndarray): Flat array of the same type to store the table in. If not given a new array is allocated
+
+        Returns:
+        - DPTable: The table
+        """
+        shape = cls.shape(N, span)
+        data = np.empty(shape, dtype=dtype) if buffer is None else buffer[:shape[0]*shape[1]].reshape(shape)
+        data.fill(fill)
+
+        return cls(data, span, fill)
+
+    @classmethod
+    def from_cells(cls, func: callable, N: int, dtype: np.dtype, span: int = None, fill: float = np.inf) -> 'DPTable':
+        """
+        Makes a table where the value of each stored cell is found from its indices.
+        The function is called once with arrays of all row indices and column indices of the stored cells
+
+        Parameters:
+        - func (callable): Function that takes arrays of i and j and returns the values of the cells
+        - N (int): The length of the sequence
+        - dtype (np.dtype): The type of the table
+        - span (int): The maximum j-i that is stored. None stores all cells with i <= j
+        - fill (float): The value of cells that are not stored
+
+        Returns:
+        - DPTable: The table
+        """
+        rows, cols = cls.shape(N, span)
+        r, c = np.arange(rows)[:, None], np.arange(cols)[None, :]
+
+        if span is None:
+            #Each row holds diagonal r and then diagonal N-r, where the second part of the middle row is not used
+            first = c < N-r
+            d = np.where(first, r, N-r)
+            i = np.where(first, c, c-d)
+            inside = first | (N-r > N//2)
+        else:
+            d, i = c, r
+            inside = i+d < N
+
+        data = np.where(inside, func(i, np.minimum(i+d, N-1)), fill).astype(dtype)
+
+        return cls(np.ascontiguousarray(data), span, fill)
+
+    @classmethod
+    def from_dense(cls, A: np.ndarray, span: int = None, fill: float = np.inf) -> 'DPTable':
+        """
+        Makes a table from a N x N matrix, keeping only the cells that are stored in the layout
+
+        Parameters:
+        - A (np.ndarray): The matrix
+        - span (int): The maximum j-i that is stored. None stores all cells with i <= j
+        - fill (float): The value of cells that are not stored
+
+        Returns:
+        - DPTable: The table
+        """
+        return cls.from_cells(lambda i, j: A[i, j], A.shape[0], A.dtype, span, fill)
+
+    def to_dense(self) -> np.ndarray:
+        """
+        Returns the table as a N x N matrix, with the fill value in the cells that are not stored
+        """
+        i, j = np.arange(self.N)[:, None], np.arange(self.N)[None, :]
+
+        return self[i, j]
+
+    def __getitem__(self, index: tuple) -> np.ndarray:
+        """
+        Returns the value of cell (i, j). i and j can be integers or arrays that broadcast together.
+        Cells that are not stored give the fill value
+        """
+        i, j = index
+        d = np.asarray(j) - np.asarray(i)
+        flat = self.data.reshape(-1)
+
+        if d.ndim == 0:
+            return flat[self.starts[d] + i*self.step] if 0 <= d < len(self.starts) else self.data.dtype.type(self.fill)
+
+        inside = (d >= 0) & (d < len(self.starts))
+        value = flat[self.starts[np.where(inside, d, 0)] + np.asarray(i)*self.step]
+
+        return np.where(inside, value, self.data.dtype.type(self.fill))
+
+    def __setitem__(self, index: tuple, value: np.ndarray) -> None:
+        """
+        Sets the value of cell (i, j), which must be stored in the layout. i and j can be integers or arrays that broadcast together
+        """
+        i, j = index
+        self.data.reshape(-1)[self.starts[np.asarray(j) - np.asarray(i)] + np.asarray(i)*self.step] = value
+
+    def diagonal(self, l: int) -> np.ndarray:
+        """
+        Returns a view of the cells (i, i+l) for all i
+
+        Parameters:
+        - l (int): The difference between the end and start index of the subsequences
+
+        Returns:
+        - np.ndarray: The cells on the diagonal
+        """
+        if self.span is not None:
+            return self.data[:self.N-l, l]
+
+        if l <= self.N//2:
+            return self.data[l, :self.N-l]
+
+        return self.data[self.N-l, l:]
+
+    def set_diagonal(self, l: int, values: np.ndarray) -> None:
+        """
+        Sets the cells (i, i+l) for all i
+
+        Parameters:
+        - l (int): The difference between the end and start index of the subsequences
+        - values (np.ndarray): The values of the cells
+
+        Returns:
+        - None
+        """
+        self.diagonal(l)[:] = values
+
+    def view(self, row: int, col: int, n: int, row_step: int, col_step: int, K: int) -> np.ndarray:
+        """
+        Returns an array with shape (K, n), where the element at [k, c] is cell (row + c + k*row_step, col + c + k*col_step)
+        Moving along c moves along a diagonal of the table, so the entries needed for all cells on a diagonal of the DP tables are read at once.
+        The array is a view without copying, except for packed tables where the diagonals are on both sides of N//2, where the two parts are joined
+        All cells in the array must be stored in the layout
+
+        Parameters:
+        - row (int): The row of the first element
+        - col (int): The column of the first element
+        - n (int): The number of cells on the diagonal
+        - row_step (int): The step in rows for each k
+        - col_step (int): The step in columns for each k
+        - K (int): The number of elements for each cell
+
+        Returns:
+        - np.ndarray: The view
+        """
+        flat = self.data.reshape(-1)
+        size = self.data.itemsize
+        d, d_step = col-row, col_step-row_step
+
+        def strided(k: int, K: int) -> np.ndarray:
+            #Cells k to k+K-1, which must be on the same side of N//2 in the packed layout
+            dk = d + k*d_step
+            if self.span is not None:
+                k_step, c_step = row_step*(self.span+1) + d_step, self.span+1
+            else:
+                k_step, c_step = (d_step*self.N if dk <= self.N//2 else d_step*(1-self.N)) + row_step, 1
+
+            return np.lib.stride_tricks.as_strided(flat[self.starts[dk] + (row + k*row_step)*c_step:], shape=(K, n), strides=(k_step*size, c_step*size), writeable=False)
+
+        if self.span is not None or d_step == 0:
+            return strided(0, K)
+
+        #The k before the split and after the split are on different sides of N//2
+        if d_step > 0:
+            split = (self.N//2 - d)//d_step + 1
+        else:
+            split = -((self.N//2 - d)//(-d_step))
+        split = min(max(split, 0), K)
+
+        if split == 0 or split == K:
+            return strided(0, K)
+
+        return np.concatenate([strided(0, split), strided(split, K-split)])
+
+def exterior_options(F: np.ndarray, V: DPTable, j: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Finds the energies of the substructures closed by a basepair (i', j) in the band of V and of the prefixes before them
+
+    Parameters:
+    - F (np.ndarray): The energies of the prefixes
+    - V (DPTable): The banded V matrix
+    - j (int): The end of the prefix
+
+    Returns:
+    - closing (np.ndarray): V[i', j] for i' in [j-span, j-4]
+    - before (np.ndarray): F[i'-1] for i' in [j-span, j-4], infinity if i' is 0
+    """
+    ip = np.arange(max(0, j-V.span), j-3)
+
+    return V[ip, j], np.where(ip > 0, F[ip-1], np.inf)
+
+def exterior(V: DPTable) -> np.ndarray:
+    """
+    Finds the minimum free energy of the exterior loop for all prefixes of the sequence, which is used when the tables are banded.
+    F[j] is the minimum energy of a structure on the bases 0 to j, made of substructures closed by basepairs (i', j') with j'-i' <= span.
+
+    Parameters:
+    - V (DPTable): The banded V matrix
+
+    Returns:
+    - F (np.ndarray): The energies of the prefixes
+    """
+    F = np.full(V.N, np.inf, dtype=V.dtype)
+
+    for j in range(4, V.N):
+        closing, before = exterior_options(F, V, j)
+        F[j] = min(F[j-1], np.min(np.minimum(closing, before + closing)))
+
+    return F
+
+def exterior_pairs(V: DPTable) -> list:
+    """
+    Traces backwards trough the exterior loop of banded tables to find the basepairs that close the substructures
+
+    Parameters:
+    - V (DPTable): The banded V matrix
+
+    Returns:
+    - list: The basepairs (i, j) closing the substructures in the exterior loop
+    """
+    F = exterior(V)
+    pairs = []
+    j = V.N-1
+
+    while j >= 0 and F[j] < np.inf:
+        if j > 0 and F[j] == F[j-1]:
+            j -= 1
+            continue
+
+        closing, before = exterior_options(F, V, j)
+        k = np.argmin(np.minimum(closing, before + closing))
+        pairs.append((j-len(closing)-3+k, j))
+
+        #Continue with the prefix if it is part of the structure
+        j = j-len(closing)-4+k if before[k] + closing[k] < closing[k] else -1
+
+    return pairs
+
+def reuse_buffer(buffer: np.ndarray, size: int, dtype: np.dtype) -> np.ndarray:
+    """
+    Returns the buffer if it can hold size elements of the type, and otherwise a new buffer
+
+    Parameters:
+    - buffer (np.ndarray): The flat buffer
+    - size (int): The number of elements needed
+    - dtype (np.dtype): The type of the elements
+
+    Returns:
+    - np.ndarray: The buffer
+    """
+    if buffer is None or buffer.size < size or buffer.dtype != dtype:
+        return np.empty(size, dtype=dtype)
+
+    return buffer
+
+def w_trace(w: np.ndarray, skip_i: np.ndarray, skip_j: np.ndarray, pair: np.ndarray, split: np.ndarray) -> np.ndarray:
+    """
+    Finds the trace codes of cells of W from the energies of the options, where the first option that gives the minimum is used
+
+    Parameters:
+    - w (np.ndarray): The energies of the cells
+    - skip_i, skip_j, pair, split (np.ndarray): The energies of the options
+
+    Returns:
+    - np.ndarray: The trace codes
+    """
+    options = [~(w < np.inf), w == skip_i, w == skip_j, w == pair, w == split]
+
+    return np.select(options, [WTrace.NONE, WTrace.SKIP_I, WTrace.SKIP_J, WTrace.PAIR, WTrace.SPLIT], WTrace.NONE).astype(np.int8)
+
+def backtrack_stack(N: int, stack: list, W_trace: DPTable, W_split: DPTable, trace_V: callable) -> list:
+    """
+    Backtracks trough the tables with an explicit stack of the cells that are left to trace, so there is no limit on the depth of the structure.
+    The cells are ('W', i, j) for a structure in the subsequence, or ('V', i, j) for a basepair between i and j
+
+    Parameters:
+    - N (int): The length of the sequence
+    - stack (list): The cells to start from
+    - W_trace (DPTable): The trace codes of W
+    - W_split (DPTable): The i' of the cells of W that are split in two structures
+    - trace_V (callable): Function that returns the cells to trace inside the basepair i, j
+
+    Returns:
+    - pairs (list): The index of the paired base of each base, or the index of the base itself if it is unpaired
+    """
+    pairs = list(range(N))
+
+    while stack:
+        table, i, j = stack.pop()
+
+        if table == 'V':
+            pairs[i], pairs[j] = j, i
+            stack.extend(trace_V(i, j))
+            continue
+
+        #Skip unpaired bases at the ends of the subsequence
+        code = W_trace[i, j]
+        while code == WTrace.SKIP_I or code == WTrace.SKIP_J:
+            i, j = (i+1, j) if code == WTrace.SKIP_I else (i, j-1)
+            code = W_trace[i, j]
+
+        if code == WTrace.PAIR:
+            stack.append(('V', i, j))
+        elif code == WTrace.SPLIT:
+            k = int(W_split[i, j])
+            stack.extend([('W', i, k), ('W', k+1, j)])
+
+    return pairs
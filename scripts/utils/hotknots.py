@@ -1,46 +1,59 @@
-import heapq, sys, subprocess, torch
+import heapq, os, sys, subprocess, threading, torch
+
+import torch.multiprocessing as mp
 
 import numpy as np
 
-from functools import cached_property
+from functools import lru_cache
 from enum import IntEnum
+from concurrent.futures import ThreadPoolExecutor
 
-s_scores = {}
+from utils.dp_tables import DPTable
+from utils.Mfold2 import MfoldEngine as MfoldConstrainEngine, SparseMfoldEngine
 
 class HotSpot: 
     """
     Class to represent a hotspot
+    The bases of the hotspot are also stored as a bitset, where bit i is set if base i is in the hotspot, so overlaps are found with a bitwise and
     """
+    __slots__ = ('pairs', 'energy', 'bases', 'mask', 'key')
+
     def __init__(self, pairs: list, energy: float) -> None:
         self.pairs = pairs
         self.energy = energy
-        
+
+        #The bases are the bases in the pairs and the single unpaired bases in the hotspot
+        strand1 = sorted([x[0] for x in self.pairs])
+        strand2 = sorted([x[1] for x in self.pairs])
+        self.bases = list(range(strand1[0], strand1[-1]+1)) + list(range(strand2[0], strand2[-1]+1))
+        self.mask = ((1 << strand1[-1]+1) - (1 << strand1[0])) | ((1 << strand2[-1]+1) - (1 << strand2[0]))
+        self.key = tuple(map(tuple, self.pairs))
 
     def __repr__(self) -> str:
         return self.__str__()
 
     def __str__(self) -> str:
         return f'HotSpot with {len(self.pairs)} pairs and energy {self.energy}'
-    
-    @cached_property
-    def bases(self): 
-        """
-        Returns the bases of the hotspot. The bases are the bases in the pairs and the single unpaired bases in the hotspot
-        """
-        strand1 = sorted([x[0] for x in self.pairs])
-        strand2 = sorted([x[1] for x in self.pairs])
-        
-        return list(range(strand1[0], strand1[-1]+1)) + list(range(strand2[0], strand2[-1]+1))
 
 
 class Node: 
     """
     Node class for the tree. Each node has a set of hotspots and a list of children. 
+    The bases of the node are stored as a bitset like for the hotspots, and the bases, energy and key are found the first time they are used
     """
-    def __init__(self, hotspots = []) -> None:
+    __slots__ = ('children', 'hotspots', 'StrSeq', 'device', 'mask', '_bases', '_energy', '_key')
+
+    def __init__(self, hotspots: list = None, device: str = 'cpu') -> None:
         self.children = []
-        self.hotspots = hotspots
+        self.hotspots = [] if hotspots is None else hotspots
         self.StrSeq = None
+        self.device = device
+
+        self.mask = 0
+        for hotspot in self.hotspots:
+            self.mask |= hotspot.mask
+
+        self._bases, self._energy, self._key = None, None, None
     
     def __str__(self) -> str:
         return f'{self.hotspots}'
@@ -48,37 +61,39 @@ class Node:
     def __repr__(self) -> str:
         return self.__str__()
     
-    @cached_property
-    def bases(self): 
-        """
-        Returns the bases of the node, which is the union of the bases of the hotspots in the node
-        """
-        if self.hotspots is not None: 
-            if len(self.hotspots) == 1:
-                return self.hotspots[0].bases
-            bases = []
-            for hotspot in self.hotspots: 
-                bases.extend(hotspot.bases)
-            return sorted(bases)
-        else:
-            return []
-    
-    @cached_property
+    @property
+    def bases(self) -> list: 
+        """
+        Returns the bases of the node in order, which is the union of the bases of the hotspots in the node
+        """
+        if self._bases is None:
+            self._bases = [i for i in range(self.mask.bit_length()) if self.mask >> i & 1]
+        return self._bases
+
+    @property
+    def key(self) -> frozenset:
+        """
+        Returns the hotspot set of the node, which is the same for nodes where the hotspots were added in a different order
+        """
+        if self._key is None:
+            self._key = frozenset(hotspot.key for hotspot in self.hotspots)
+        return self._key
+
+    @property
     def energy(self):
         """
         Returns the energy of the node, which is the sum of the energies of the hotspots in the node
         """ 
-        if self.hotspots is not None: 
-            return torch.sum(torch.tensor([hotspot.energy for hotspot in self.hotspots], device=dv))
-        else: 
-            return 0
+        if self._energy is None:
+            self._energy = torch.sum(torch.tensor([hotspot.energy for hotspot in self.hotspots], device=self.device))
+        return self._energy
 
 class Tree:
     """
     Class that represents a tree. The tree has a root node and a list of nodes. The nodes are added to the tree in the order they are created
     """
-    def __init__(self) -> None:
-        self.root = Node()
+    def __init__(self, device: str = 'cpu') -> None:
+        self.root = Node(device=device)
         self.nodes = [self.root]
 
     def __str__(self) -> str:
@@ -94,7 +109,7 @@ class Tree:
         self._print_tree(self.root, 0)
     
     def _print_tree(self, node: Node, level: int):
-        hotspot_string = ", ".join(str(x) for x in node.hotspots) if node.hotspots is not None else "root"
+        hotspot_string = ", ".join(str(x) for x in node.hotspots) if node.hotspots else "root"
         print(("  " * level) + hotspot_string)
         for child in node.children:
             self._print_tree(child, level + 1)
@@ -116,20 +131,26 @@ class Trace(IntEnum):
     DOWN = 2
     DIAG = 3
 
-def run_simfold(sequence: str, contraints: str) -> str:
+SIMFOLD_DIR = '../simfold/'
+
+@lru_cache(maxsize=2**15)
+def run_simfold(sequence: str, contraints: str, executable: str = SIMFOLD_DIR + 'simfold', simfold_dir: str = SIMFOLD_DIR) -> str:
     """
     Runs Simfold with the given sequence and constraints and returns the structure with the lowest energy
     Runs Simfold using subprocess
+    The structures are kept in a process-wide LRU cache keyed by the sequence and constraints, since they do not depend on the matrix. 
+    A segment is therefore only folded once across nodes, engines and sequences
 
     Parameters:
     - sequence (str): The sequence to run Simfold on
     - contraints (str): The constraints to use for the sequence
+    - executable (str): The Simfold executable. Any program that prints the structure as the fourth word of its output can be used
+    - simfold_dir (str): The directory to run Simfold from
 
     Returns:
     - str: The structure with the lowest energy given the constraints
     """
-    simfold_dir = '../simfold/'
-    command = [simfold_dir + 'simfold', '-s', sequence, '-r', contraints]
+    command = [executable, '-s', sequence, '-r', contraints]
 
     try:
         p = subprocess.Popen(command, cwd=simfold_dir, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
@@ -146,71 +167,103 @@ def run_simfold(sequence: str, contraints: str) -> str:
     except Exception as e:
         raise Exception(f'An error occured: {e}')
 
-def smith_waterman(sequence: str, matrix: torch.Tensor, treshold: float = 5.0) -> tuple:
+class SimFoldPool:
+    """
+    Long-lived pool of threads that run Simfold, so the segments of a hotspot set are folded in parallel.
+    Simfold reads the sequence from its arguments, so every fold that is not cached is still its own process, but the threads and the cache are reused for all folds.
+    """
+    def __init__(self, executable: str = SIMFOLD_DIR + 'simfold', simfold_dir: str = SIMFOLD_DIR, workers: int = None) -> None:
+        self.executable = executable
+        self.simfold_dir = simfold_dir
+        self.workers = workers
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        """
+        The threads of the pool. The threads are not copied when the pool is sent to another process or the process is forked, so each process starts its own
+        """
+        if getattr(self, '_pid', None) != os.getpid():
+            self._executor, self._pid = ThreadPoolExecutor(self.workers), os.getpid()
+        return self._executor
+
+    def __getstate__(self) -> dict:
+        return {key: value for key, value in self.__dict__.items() if key not in ['_executor', '_pid']}
+
+    def fold(self, sequence: str, contraints: str) -> str:
+        """
+        Returns the structure with the lowest energy of the sequence given the constraints
+        """
+        return run_simfold(sequence, contraints, self.executable, self.simfold_dir)
+
+    def fold_many(self, jobs: list) -> list:
+        """
+        Folds many sequences in parallel
+
+        Parameters:
+        - jobs (list): Tuples of (sequence, constraints)
+
+        Returns:
+        - list: The structures in the same order as the jobs
+        """
+        return list(self.executor.map(lambda job: self.fold(*job), jobs))
+
+simfold_pool = SimFoldPool()
+
+_mfold_engines = threading.local()
+
+@lru_cache(maxsize=2**15)
+def run_mfold(sequence: str, contraints: str, max_loop: int = 30) -> str:
     """
-    Implementation of Smith-Waterman algorithm to align an RNA sequence with itself.
-    The algorithm is used to find the top k local alignments in the sequence.
+    In-process replacement for run_simfold, that folds the sequence with the constrained Mfold from utils.Mfold2
+    Bases marked with '.' in the constraints are not allowed to pair. Each thread keeps its own Mfold engines, so the tables are reused between folds
+    Short segments are folded with the sparse Mfold, which is faster than the dense tables when the sequence is shorter than about 100 bases
+    The structures are kept in a process-wide LRU cache keyed by the sequence and constraints
 
     Parameters:
-    - sequence (str): The sequence to align
-    - matrix (torch.Tensor): The matrix to use for scoring the alignment
-    - treshold (float): The treshold to use for the alignment
+    - sequence (str): The sequence to fold
+    - contraints (str): The constraints to use for the sequence
+    - max_loop (int): The maximum number of unpaired bases in bulge and interior loops. Default is 30
 
     Returns:
-    - list: A list of the top cells in the matrix
-    - torch.Tensor: The tracing matrix
+    - str: The structure with the lowest energy given the constraints
     """
-    top_cells = []
-    basepairs = {'AU', 'UA', 'CG', 'GC', 'GU', 'UG'}
+    if not sequence:
+        return ''
 
-    N = len(sequence)
+    engine_class = SparseMfoldEngine if len(sequence) <= 100 else MfoldConstrainEngine
 
-    # Initialize the scoring matrix.
-    score_matrix = torch.zeros((N+1, N+1), device=dv)
-    tracing_matrix = torch.zeros((N+1, N+1), device=dv)
+    engines = _mfold_engines.__dict__.setdefault('engines', {})
+    if (engine_class, max_loop) not in engines:
+        engines[engine_class, max_loop] = engine_class(max_loop=max_loop)
 
-    #Calculating the scores for all cells in the matrix
-    for l in range(4, N): 
-        for i in range(N-l+1):
-            j = i + l - 1
+    free = torch.tensor([c == '_' for c in contraints])
+    fold = engines[engine_class, max_loop].fold(sequence.upper(), (free[:, None] & free[None, :]).float())
 
-            if j > N: #Should not go there, but just in case
-                break
+    return ''.join('(' if j > i else ')' if j < i else '.' for i, j in enumerate(fold))
 
-            # It is necesary to substract one to i indices into matrix, since it doesn't have the 0 row and column
-            #Calculate match score
-            diagonal = score_matrix[i+1, j-1] + matrix[i, j-1] if (sequence[i] + sequence[j-1]) in basepairs else -float('inf')
-            #Calculate gaps scores - should ensure that only gaps of size 1 (on one or both strands) are allowed
-            vertical = score_matrix[i+1, j] - gp if (not(tracing_matrix[i+1, j] == Trace.LEFT and tracing_matrix[i+1, j-1] == Trace.DOWN)) and (not tracing_matrix[i+1, j]==Trace.DOWN) else -float('inf')
-            horizontal = score_matrix[i, j-1] - gp if (not (tracing_matrix[i, j-1]==Trace.DOWN and tracing_matrix[i+1, j-1] == Trace.LEFT)) and (not tracing_matrix[i, j-1] == Trace.LEFT) else -float('inf')
+class MfoldPool(SimFoldPool):
+    """
+    Drop-in replacement for SimFoldPool that folds in-process with run_mfold, so HotKnots can run without SimFold installed
+    """
+    def __init__(self, max_loop: int = 30, workers: int = None) -> None:
+        self.max_loop = max_loop
+        self.workers = workers
 
-            #Update the score matrix
-            score_matrix[i, j] = max(0, diagonal, vertical, horizontal)
+    def fold(self, sequence: str, contraints: str) -> str:
+        """
+        Returns the structure with the lowest energy of the sequence given the constraints
+        """
+        return run_mfold(sequence, contraints, self.max_loop)
+
+mfold_pool = MfoldPool()
 
-            #Fill the tracing matrix
-            if score_matrix[i, j] == 0: 
-                tracing_matrix[i, j] = Trace.STOP
-            elif score_matrix[i, j] == diagonal: 
-                tracing_matrix[i, j] = Trace.DIAG
-                #Update queue of top cells
-                if score_matrix[i, j] > treshold: 
-                    top_cells.append((score_matrix[i, j], (i, j)))
-            elif score_matrix[i, j] == vertical: 
-                tracing_matrix[i, j] = Trace.DOWN
-            elif score_matrix[i, j] == horizontal: 
-                tracing_matrix[i, j] = Trace.LEFT
-    
-    # Sort the top cells list in descending order
-    top_cells.sort(key=lambda x: x[0])
-    
-    return top_cells, tracing_matrix
 
-def traceback_smith_waterman(trace_matrix: torch.Tensor, i: int, j: int) -> list:
+def traceback_smith_waterman(trace_matrix: DPTable, i: int, j: int) -> list:
     """
     Traces back the path in the matrix to find the alignment starting from cell (i, j)
 
     Parameters:
-    - trace_matrix (torch.Tensor): The tracing matrix
+    - trace_matrix (DPTable): The tracing matrix
     - i (int): The row index to start from
     - j (int): The column index to start from
 
@@ -230,37 +283,20 @@ def traceback_smith_waterman(trace_matrix: torch.Tensor, i: int, j: int) -> list
 
     return pairs
 
-
-def initialize_tree(sequence: str, matrix: torch.Tensor, k: int = 20) -> Tree:
+def pop_top_cell(top_cells: list) -> tuple:
     """
-    Initializes the tree with the first k hotspots with are found using the Smith-Waterman algorithm
+    Pops the cell with the highest score from the heap of top cells made by smith_waterman
 
     Parameters:
-    - sequence (str): The sequence to initialize the tree with
-    - matrix (torch.Tensor): The matrix to use for scoring the alignment
-    - k (int): The number of hotspots to initialize the tree with
+    - top_cells (list): The heap of top cells
 
     Returns:
-    - Tree: The initialized tree
+    - tuple: The score of the cell and the cell (i, j)
     """
-    #Find the top hotspots using Smith-Waterman
-    pq, trace = smith_waterman(sequence, matrix)
-
-    tree = Tree()
-    bases  = []
-
-    #Backtrack trough top hotspots to find k best hotspots
-    while len(tree) < k and pq:
-        score, (i, j) = pq.pop()
-        #If they overlap with hotspot already in the tree, skip
-        if i in bases and j in bases:
-            continue
-        node = Node([HotSpot(traceback_smith_waterman(trace, i, j), score)])
-        node.StrSeq = SeqStr(sequence, node, matrix)
-        bases.extend(node.bases)
-        tree.add_node(tree.root, node)
-    
-    return tree
+    score, d, i = heapq.heappop(top_cells)
+
+    return np.float32(-score), (-i, -i-d)
+
 
 
 def constrained_structure(bases: list, N: int) -> str: 
@@ -304,183 +340,411 @@ def db_to_pairs(structure: str) -> list:
     pairs.sort()
     return pairs
 
-def identify_hotspots(structure: str, matrix: torch.Tensor, k: int = 20, treshold:float = 2.0) -> list:
+class HotKnotsEngine:
+    """
+    HotKnots algorithm to predict RNA secondary structure with pseudoknots
+    All state of a fold (gap penalty, treshold and the energies of the segments folded by SimFold) is kept on the engine, so several engines can fold in parallel threads.
+    SimFold is run through a SimFoldPool, which is shared by all engines unless another is given.
     """
-    Identifies hotspots in a structure by finding stems in the structure and calculating the energy of the stems.
+    def __init__(self, device: str = 'cpu', gap_penalty: float = 0.5, treshold_prop: float = 0.5, simfold: SimFoldPool = None) -> None:
+        self.gp = gap_penalty
+        self.tp = treshold_prop
+        self.dv = device
+        self.simfold = simfold or simfold_pool
+        self.s_scores = {}
+
+    def smith_waterman(self, sequence: str, matrix: torch.Tensor, treshold: float = 5.0) -> tuple:
+        """
+        Implementation of Smith-Waterman algorithm to align an RNA sequence with itself.
+        The algorithm is used to find the top k local alignments in the sequence.
 
-    Parameters:
-    - structure (str): The structure to identify hotspots in
-    - matrix (torch.Tensor): The matrix to use for scoring the structure
-    - k (int): The number of hotspots to return. Default is 20
-    - treshold (float): The treshold to use for the hotspots. Default is 2.0
+        Parameters:
+        - sequence (str): The sequence to align
+        - matrix (torch.Tensor): The matrix to use for scoring the alignment
+        - treshold (float): The treshold to use for the alignment
 
-    Returns:
-    - list: A list of the top k hotspots
-    """
-    pairs = db_to_pairs(structure)
-    if not pairs:
-        return []
-    
-    stems = []
-    current_hotspot = [pairs[0]]
-
-    for i, pair in enumerate(pairs):
-        if i > 0: 
-            if (pair[0] - pairs[i-1][0] <=2) and (pairs[i-1][1] - pair[1] <= 2): 
-                current_hotspot.append(pair)
-            else:
-                stems.append(current_hotspot)
-                current_hotspot = [pair]
-    stems.append(current_hotspot)
-
-    #Get energy of hotspots and eliminate those under treshold
-    #Return top k hotspots
-    hotspots = []
-    for hotspot in stems:
-        #Get energy
+        Returns:
+        - list: A heap of the top cells in the matrix, which are popped with pop_top_cell
+        - DPTable: The tracing matrix
+        """
+        top_cells = []
+        basepairs = {'AU', 'UA', 'CG', 'GC', 'GU', 'UG'}
+
+        N = len(sequence)
+        matrix = matrix.detach().cpu().numpy()
+
+        #Which bases can pair, found from the index of each base in 'ACGU'. Other bases get index -1, which is the last row and column that cannot pair
+        can_pair = np.zeros((5, 5), dtype=bool)
+        for pair in basepairs:
+            can_pair['ACGU'.index(pair[0]), 'ACGU'.index(pair[1])] = True
+        codes = np.array(['ACGU'.find(base) for base in sequence], dtype=int)
+        can_pair = can_pair[codes[:, None], codes[None, :]]
+
+        # Initialize the scoring matrix. Only cells with i <= j are used, so the matrices are stored packed, with the trace codes as int8
+        score_matrix = DPTable.empty(N+1, np.float32, fill=0)
+        tracing_matrix = DPTable.empty(N+1, np.int8, fill=Trace.STOP)
+
+        #Calculating the scores one diagonal at a time, since the cells (i, i+d) only depend on the two previous diagonals
+        for d in range(3, N-1):
+            n = N-d #The cells (i, i+d) with i in [0, N-d-1]. The last column is not used
+            score_1, trace_1 = score_matrix.diagonal(d-1), tracing_matrix.diagonal(d-1)
+            trace_2 = tracing_matrix.diagonal(d-2)
+
+            # It is necesary to substract one to j indices into matrix, since it doesn't have the 0 row and column
+            #Calculate match score
+            diagonal = np.where(np.diagonal(can_pair, d-1)[:n], score_matrix.diagonal(d-2)[1:n+1] + np.diagonal(matrix, d-1)[:n], -np.inf)
+            #Calculate gaps scores - should ensure that only gaps of size 1 (on one or both strands) are allowed
+            vertical = np.where(~((trace_1[1:n+1] == Trace.LEFT) & (trace_2[1:n+1] == Trace.DOWN)) & (trace_1[1:n+1] != Trace.DOWN), score_1[1:n+1] - self.gp, -np.inf)
+            horizontal = np.where(~((trace_1[:n] == Trace.DOWN) & (trace_2[1:n+1] == Trace.LEFT)) & (trace_1[:n] != Trace.LEFT), score_1[:n] - self.gp, -np.inf)
+
+            #Update the score matrix
+            score = score_matrix.diagonal(d)[:n]
+            score[:] = np.maximum(np.maximum(0, diagonal), np.maximum(vertical, horizontal))
+
+            #Fill the tracing matrix
+            trace = np.select([score == 0, score == diagonal, score == vertical, score == horizontal], [Trace.STOP, Trace.DIAG, Trace.DOWN, Trace.LEFT], Trace.STOP)
+            tracing_matrix.diagonal(d)[:n] = trace
+
+            #Add the cells that end an alignment with a basepair above the treshold to the top cells
+            cells = np.nonzero((trace == Trace.DIAG) & (score > treshold))[0]
+            top_cells.extend(zip((-score[cells]).tolist(), [-d]*len(cells), (-cells).tolist()))
+
+        #Make a heap of the top cells, where the highest score is popped first. Ties are popped from the last cell found
+        heapq.heapify(top_cells)
+
+        return top_cells, tracing_matrix
+
+    def initialize_tree(self, sequence: str, matrix: torch.Tensor, k: int = 20) -> Tree:
+        """
+        Initializes the tree with the first k hotspots with are found using the Smith-Waterman algorithm
+
+        Parameters:
+        - sequence (str): The sequence to initialize the tree with
+        - matrix (torch.Tensor): The matrix to use for scoring the alignment
+        - k (int): The number of hotspots to initialize the tree with
+
+        Returns:
+        - Tree: The initialized tree
+        """
+        #Find the top hotspots using Smith-Waterman
+        pq, trace = self.smith_waterman(sequence, matrix)
+
+        tree = Tree(self.dv)
+        bases = 0 #Bitset of the bases in the tree
+
+        #Backtrack trough top hotspots to find k best hotspots
+        while len(tree) < k and pq:
+            score, (i, j) = pop_top_cell(pq)
+            #If they overlap with hotspot already in the tree, skip
+            if bases >> i & 1 and bases >> j & 1:
+                continue
+            node = Node([HotSpot(traceback_smith_waterman(trace, i, j), score)], self.dv)
+            node.StrSeq = self.SeqStr(sequence, node, matrix)
+            bases |= node.mask
+            tree.add_node(tree.root, node)
+
+        return tree
+
+    def identify_hotspots(self, structure: str, matrix: torch.Tensor, k: int = 20, treshold:float = 2.0) -> list:
+        """
+        Identifies hotspots in a structure by finding stems in the structure and calculating the energy of the stems.
+
+        Parameters:
+        - structure (str): The structure to identify hotspots in
+        - matrix (torch.Tensor): The matrix to use for scoring the structure
+        - k (int): The number of hotspots to return. Default is 20
+        - treshold (float): The treshold to use for the hotspots. Default is 2.0
+
+        Returns:
+        - list: A list of the top k hotspots
+        """
+        pairs = db_to_pairs(structure)
+        if not pairs:
+            return []
+
+        stems = []
+        current_hotspot = [pairs[0]]
+
+        for i, pair in enumerate(pairs):
+            if i > 0: 
+                if (pair[0] - pairs[i-1][0] <=2) and (pairs[i-1][1] - pair[1] <= 2): 
+                    current_hotspot.append(pair)
+                else:
+                    stems.append(current_hotspot)
+                    current_hotspot = [pair]
+        stems.append(current_hotspot)
+
+        #Get energy of hotspots and eliminate those under treshold
+        #Return top k hotspots
+        hotspots = []
+        for hotspot in stems:
+            #Get energy
+            energy = 0
+            for i, pair in enumerate(hotspot): 
+                energy += matrix[pair[0], pair[1]]
+                if i > 0: 
+                    if pair[0] - hotspot[i-1][0] > 1: 
+                        energy -= self.gp
+                    if hotspot[i-1][1] - pair[1] > 1:
+                        energy -= self.gp
+            if energy > treshold:
+                hotspots.append(HotSpot(hotspot, energy))
+
+        hotspots.sort(key=lambda x: x.energy, reverse=True)
+
+        return hotspots
+
+    def energy_from_structure(self, structure: str, matrix: torch.Tensor) -> float:
+        """
+        Calculates the energy of a structure given a matrix with scores for the structure
+
+        Parameters:
+        - structure (str): The structure to calculate the energy of
+        - matrix (torch.Tensor): The matrix to use for scoring the structure
+
+        Returns:
+        - float: The energy of the structure
+        """
         energy = 0
-        for i, pair in enumerate(hotspot): 
+        pairs = db_to_pairs(structure)
+        for i, pair in enumerate(pairs):
             energy += matrix[pair[0], pair[1]]
             if i > 0: 
-                if pair[0] - hotspot[i-1][0] > 1: 
-                    energy -= gp
-                if hotspot[i-1][1] - pair[1] > 1:
-                    energy -= gp
-        if energy > treshold:
-            hotspots.append(HotSpot(hotspot, energy))
-    
-    hotspots.sort(key=lambda x: x.energy, reverse=True)
-            
-    return hotspots
+                if pair[0] - pairs[i-1][0] > 1: 
+                    energy -= self.gp+self.gp*0.25*(pair[0] - pairs[i-1][0] - 2) #Add penalty for every gap inserted, with a higher opening penalty
+                if pairs[i-1][1] - pair[1] > 1:
+                    energy -= self.gp+self.gp*0.25*(pairs[i-1][1] - pair[1] - 2) #Add penalty for every gap inserted, with a higher opening penalty
+        return energy
 
-def energy_from_structure(structure: str, matrix: torch.Tensor) -> float:
-    """
-    Calculates the energy of a structure given a matrix with scores for the structure
+    def SeqStr(self, S: str, H: Node, matrix: torch.Tensor, output_pairs: bool = False): 
+        """
+        Secondary structure of sequence S with hotspot set H
+        s1, s2, ..., sl are the sequences obtained from S when removing the bases that are in hotspots of H
+        Mfold/SimFold is used to obtain the energy of the segmeents 
+        SeqStr is the union of the energies of the l segments and the hotspots in H
 
-    Parameters:
-    - structure (str): The structure to calculate the energy of
-    - matrix (torch.Tensor): The matrix to use for scoring the structure
+        Parameters:
+        - S (str): The sequence to calculate the structure of
+        - H (Node): The node with the hotspots to use for the structure
+        - matrix (torch.Tensor): The matrix to use for scoring the structure
+        - output_pairs (bool): If True, return the pairs of the structure. Default is False
 
-    Returns:
-    - float: The energy of the structure
-    """
-    energy = 0
-    pairs = db_to_pairs(structure)
-    for i, pair in enumerate(pairs):
-        energy += matrix[pair[0], pair[1]]
-        if i > 0: 
-            if pair[0] - pairs[i-1][0] > 1: 
-                energy -= gp+gp*0.25*(pair[0] - pairs[i-1][0] - 2) #Add penalty for every gap inserted, with a higher opening penalty
-            if pairs[i-1][1] - pair[1] > 1:
-                energy -= gp+gp*0.25*(pairs[i-1][1] - pair[1] - 2) #Add penalty for every gap inserted, with a higher opening penalty
-    return energy
-
-def SeqStr(S: str, H: Node, matrix: torch.Tensor, output_pairs: bool = False): 
-    """
-    Secondary structure of sequence S with hotspot set H
-    s1, s2, ..., sl are the sequences obtained from S when removing the bases that are in hotspots of H
-    Mfold/SimFold is used to obtain the energy of the segmeents 
-    SeqStr is the union of the energies of the l segments and the hotspots in H
+        Returns:
+        - float: The energy of the structure if output_pairs is False
+        - list: The pairs of the structure if output_pairs is True
+        """   
 
-    Parameters:
-    - S (str): The sequence to calculate the structure of
-    - H (Node): The node with the hotspots to use for the structure
-    - matrix (torch.Tensor): The matrix to use for scoring the structure
-    - output_pairs (bool): If True, return the pairs of the structure. Default is False
+        if not H.bases: 
+            if output_pairs:
+                return db_to_pairs(self.simfold.fold(S, '_'*len(S)))
+            return self.energy_from_structure(self.simfold.fold(S, '_'*len(S)), matrix)
 
-    Returns:
-    - float: The energy of the structure if output_pairs is False
-    - list: The pairs of the structure if output_pairs is True
-    """   
-    
-    if not H.bases: 
-        if output_pairs:
-            return db_to_pairs(run_simfold(S, '_'*len(S)))
-        return energy_from_structure(run_simfold(S, '_'*len(S)), matrix)
-    
-    s_list = [] if H.bases[0] == 0 else [(0, H.bases[0]-1)]
+        s_list = [] if H.bases[0] == 0 else [(0, H.bases[0]-1)]
 
-    for i in range(1, len(H.bases)):
-        if H.bases[i] - H.bases[i-1] > 1:
-            s_list.append((H.bases[i-1]+1, H.bases[i]-1))
-    
-    if H.bases[-1] != len(S)-1:
-        s_list.append((H.bases[-1]+1, len(S)-1))
-
-    if output_pairs:
-        pairs = []
-        for pair in s_list:
-            pairs.extend(db_to_pairs(run_simfold(S[pair[0]:pair[1]+1], '_'*(pair[1]-pair[0]+1))))
-        for hotspot in H.hotspots:
-            pairs.extend(hotspot.pairs)
-        return pairs
-    
-    for pair in s_list: 
-        if pair in s_scores:
-            continue
-        s_scores[pair] = energy_from_structure(run_simfold(S[pair[0]:pair[1]+1], '_'*(pair[1]-pair[0]+1)), matrix)
-    
-    energies = [s_scores[pair] for pair in s_list]
+        for i in range(1, len(H.bases)):
+            if H.bases[i] - H.bases[i-1] > 1:
+                s_list.append((H.bases[i-1]+1, H.bases[i]-1))
 
-    return H.energy + torch.sum(torch.tensor(energies, device=dv))
+        if H.bases[-1] != len(S)-1:
+            s_list.append((H.bases[-1]+1, len(S)-1))
 
-def grow_tree(tree: Tree, sequence: str, matrix: torch.Tensor, k: int = 20) -> Tree:
-    """
-    Grows the tree by adding children to the nodes in the tree. The children are added based on the hotspots in the nodes
-    Follows the HotKnots algorithm described in the paper "HotKnots: Heuristic prediction of RNA secondary structures including pseudoknots" by Ren, Rastegari, Condon and Hoos
+        if output_pairs:
+            pairs = []
+            for pair, structure in zip(s_list, self.simfold.fold_many([(S[pair[0]:pair[1]+1], '_'*(pair[1]-pair[0]+1)) for pair in s_list])):
+                #The pairs of a segment are found from its start
+                pairs.extend((pair[0]+i, pair[0]+j) for i, j in db_to_pairs(structure))
+            for hotspot in H.hotspots:
+                pairs.extend(hotspot.pairs)
+            return pairs
 
-    Parameters:
-    - tree (Tree): The tree to grow
-    - sequence (str): The sequence to grow the tree with
-    - matrix (torch.Tensor): The matrix to use for scoring the structure
-    - k (int): The number of children to add to each node. Default is 20
+        #Fold the segments that have not been scored yet in parallel
+        s_new = [pair for pair in s_list if pair not in self.s_scores]
+        structures = self.simfold.fold_many([(S[pair[0]:pair[1]+1], '_'*(pair[1]-pair[0]+1)) for pair in s_new])
+        for pair, structure in zip(s_new, structures): 
+            self.s_scores[pair] = self.energy_from_structure(structure, matrix[pair[0]:pair[1]+1, pair[0]:pair[1]+1])
 
-    Returns:
-    - Tree: The grown tree
-    """
-    N = len(sequence)
-    L = [node.hotspots[0] for node in tree.root.children]
+        energies = [self.s_scores[pair] for pair in s_list]
 
-    treshold = SeqStr(sequence, tree.root, matrix)*tp
-    tree.root.StrSeq = treshold
+        return H.energy + torch.sum(torch.tensor(energies, device=self.dv))
 
-    def build_node(node: Node, L): 
-        #Use constraints and SimFold to obtain the structure of the sequence
-        
-        L = L + identify_hotspots(run_simfold(sequence, constrained_structure(node.bases, N)), matrix, k)
+    def expand_node(self, node: Node, L: list, sequence: str, matrix: torch.Tensor, treshold: float, k: int = 20, seen: set = None) -> tuple[list, list]:
+        """
+        Finds the children of a node in the tree. The hotspots of the node are used as constraints for SimFold, and the hotspots of the structure are added to the hotspots of the parent
+        A new hotspot set is a child if its StrSeq is above the treshold
+        If a set of seen hotspot sets is given, hotspot sets that are already in it are skipped without being evaluated, and the new ones are added to it
         
+        Parameters:
+        - node (Node): The node to expand
+        - L (list): The hotspots left from the parent of the node
+        - sequence (str): The sequence to grow the tree with
+        - matrix (torch.Tensor): The matrix to use for scoring the structure
+        - treshold (float): The lowest StrSeq of a child
+        - k (int): The number of children to add to the node. Default is 20
+        - seen (set): The keys of the hotspot sets that have been evaluated. Default is None, where all hotspot sets are evaluated
+
+        Returns:
+        - list: The hotspots left for the children of the node
+        - list: The k best children of the node
+        """
+        #Use constraints and SimFold to obtain the structure of the sequence
+        L = L + self.identify_hotspots(self.simfold.fold(sequence, constrained_structure(node.bases, len(sequence))), matrix, k)
+
         children = []
         for i, hotspot in enumerate(L): 
             #Remove hotspot from list if it overlaps with hotspots in the node
-            if any([x in hotspot.bases for x in node.bases]):
+            if hotspot.mask & node.mask:
                 L.pop(i)
                 continue
-            
+
             #Create new node with hotspotset and calculate its StrSeq
             #If energy above treshold add to children
-            new_node = Node(node.hotspots + [hotspot])
-            new_node.StrSeq = SeqStr(sequence, new_node, matrix)
+            new_node = Node(node.hotspots + [hotspot], self.dv)
+            if seen is not None:
+                if new_node.key in seen:
+                    continue
+                seen.add(new_node.key)
+
+            new_node.StrSeq = self.SeqStr(sequence, new_node, matrix)
             if new_node.StrSeq >= treshold:
                 children.append(new_node)
-        
-        #Find k best children and add them to the tree
+
+        #Find k best children
         children.sort(key=lambda x: x.StrSeq, reverse=True)
-        for child in children[:k]:
-            tree.add_node(node, child)
 
-        #Grow tree based on good hotspots
-        if node.children:
-            for child in node.children: 
-                build_node(child, L)
- 
-    #Build nodes for all children of the curret node
-    for node in tree.root.children: 
-        build_node(node, L)
+        return L, children[:k]
+
+    def grow_tree(self, tree: Tree, sequence: str, matrix: torch.Tensor, k: int = 20, processes: int = 1) -> Tree:
+        """
+        Grows the tree by adding children to the nodes in the tree. The children are added based on the hotspots in the nodes
+        Follows the HotKnots algorithm described in the paper "HotKnots: Heuristic prediction of RNA secondary structures including pseudoknots" by Ren, Rastegari, Condon and Hoos
+        The tree is grown one level at a time, since the nodes on a level are expanded independently of each other. The nodes of a level can then be expanded on a process pool
+        The children are added in the same order as when the tree is grown depth first, so the result does not depend on the number of processes
+
+        Parameters:
+        - tree (Tree): The tree to grow
+        - sequence (str): The sequence to grow the tree with
+        - matrix (torch.Tensor): The matrix to use for scoring the structure
+        - k (int): The number of children to add to each node. Default is 20
+        - processes (int): The number of processes to expand the nodes with. Default is 1, where the nodes are expanded in the main process
+
+        Returns:
+        - Tree: The grown tree
+        """
+        L = [node.hotspots[0] for node in tree.root.children]
+
+        treshold = self.SeqStr(sequence, tree.root, matrix)*self.tp
+        tree.root.StrSeq = treshold
+
+        #Nodes to expand and the hotspots left from their parents
+        level = [(node, L) for node in tree.root.children]
+
+        pool = mp.Pool(processes, initializer=_init_grow_worker, initargs=(self, sequence, matrix, treshold, k)) if processes != 1 else None
+        try:
+            while level:
+                if pool is None:
+                    expanded = [self.expand_node(node, L, sequence, matrix, treshold, k) for node, L in level]
+                else:
+                    expanded = pool.map(_expand_node_job, level)
+
+                next_level = []
+                for (node, _), (L, children) in zip(level, expanded):
+                    for child in children:
+                        tree.add_node(node, child)
+                        next_level.append((child, L))
+                level = next_level
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        #Order the nodes as if they were added depth first, where the children of a node are added when it is expanded
+        nodes = [tree.root] + tree.root.children
+        stack = tree.root.children[::-1]
+        while stack:
+            node = stack.pop()
+            nodes.extend(node.children)
+            stack.extend(node.children[::-1])
+        tree.nodes = nodes
+
+        return tree
+
+    def beam_search(self, tree: Tree, sequence: str, matrix: torch.Tensor, k: int = 20, beam_width: int = 50, budget: int = None) -> Tree:
+        """
+        Grows the tree best first instead of expanding every node as in grow_tree
+        The nodes waiting to be expanded are kept in a global priority queue on StrSeq, where only the beam_width best nodes are kept
+        Hotspot sets that have already been evaluated, with the hotspots added in another order, are pruned
+        
+        Parameters:
+        - tree (Tree): The tree to grow
+        - sequence (str): The sequence to grow the tree with
+        - matrix (torch.Tensor): The matrix to use for scoring the structure
+        - k (int): The number of children to add to each node. Default is 20
+        - beam_width (int): The number of nodes kept in the queue. Default is 50
+        - budget (int): The number of hotspot sets to evaluate, after which no more nodes are expanded. Default is None, where the search runs until the queue is empty
+
+        Returns:
+        - Tree: The grown tree
+        """
+        L = [node.hotspots[0] for node in tree.root.children]
+
+        treshold = self.SeqStr(sequence, tree.root, matrix)*self.tp
+        tree.root.StrSeq = treshold
+
+        seen = {node.key for node in tree.root.children}
+
+        #The queue is ordered on StrSeq, with ties popped in the order the nodes were added
+        queue = [(-float(node.StrSeq), i, node, L) for i, node in enumerate(tree.root.children)]
+        heapq.heapify(queue)
+        count = len(queue)
+
+        while queue and (budget is None or len(seen) < budget):
+            _, _, node, L = heapq.heappop(queue)
+
+            L, children = self.expand_node(node, L, sequence, matrix, treshold, k, seen)
+            for child in children:
+                tree.add_node(node, child)
+                heapq.heappush(queue, (-float(child.StrSeq), count, child, L))
+                count += 1
 
-    return tree
+            #Only keep the best nodes in the beam
+            if len(queue) > beam_width:
+                queue = heapq.nsmallest(beam_width, queue)
 
+        return tree
 
-def hotknots(matrix: torch.Tensor, sequence: str, device: str, k: int = 20, gap_penalty: float = 0.5, treshold_prop: float = 0.5) -> list:
+    def fold(self, matrix: torch.Tensor, sequence: str, k: int = 20, processes: int = 1, beam_width: int = None, budget: int = None) -> list:
+        """
+        Predicts the structure of a sequence with pseudoknots
+        It takes a matrix with scores returned from a neural network and a sequence and returns the pairs of the structure
+
+        Parameters:
+        - matrix (torch.Tensor): The matrix to use for scoring the structure
+        - sequence (str): The sequence to predict the structure of
+        - k (int): The number of children to add to each node. Default is 20
+        - processes (int): The number of processes to grow the tree with. Default is 1
+        - beam_width (int): If given, the tree is grown with beam_search with this beam width instead of with grow_tree. Default is None
+        - budget (int): The number of hotspot sets beam_search evaluates before it stops. Default is None, where there is no limit
+
+        Returns:
+        - list: The pairs of the structure
+        """
+        #Energies of segments are only valid for the current sequence
+        self.s_scores = {}
+
+        tree = self.initialize_tree(sequence, matrix, k)
+        if beam_width is None:
+            self.grow_tree(tree, sequence, matrix, k, processes)
+        else:
+            self.beam_search(tree, sequence, matrix, k, beam_width, budget)
+
+        best = sorted(tree.nodes, key=lambda x: x.StrSeq, reverse=True)[0]
+
+        pairs = self.SeqStr(sequence, best, matrix, output_pairs=True)
+
+        return pairs
+
+
+def hotknots(matrix: torch.Tensor, sequence: str, device: str, k: int = 20, gap_penalty: float = 0.5, treshold_prop: float = 0.5, simfold: SimFoldPool = None, processes: int = 1, beam_width: int = None, budget: int = None) -> list:
     """
     HotKnots algorithm to predict RNA secondary structure with pseudoknots
     It takes a matrix with scores returned from a neural network and a sequence and returns the pairs of the structure
@@ -492,20 +756,36 @@ def hotknots(matrix: torch.Tensor, sequence: str, device: str, k: int = 20, gap_
     - k (int): The number of children to add to each node. Default is 20
     - gap_penalty (float): The penalty for gaps in the structure. Default is 0.5
     - treshold_prop (float): The porportion of the naive structure to use as treshold for adding new hotspots. Default is 0.5
+    - simfold (SimFoldPool): The pool to run SimFold with. Default is the shared pool
+    - processes (int): The number of processes to grow the tree with. Default is 1
+    - beam_width (int): If given, the tree is grown with a best-first beam search with this beam width. Default is None
+    - budget (int): The number of hotspot sets the beam search evaluates before it stops. Default is None
 
     Returns:
     - list: The pairs of the structure
     """
-    global gp, tp, dv
-    gp = gap_penalty
-    tp = treshold_prop
-    dv = device
+    return HotKnotsEngine(device, gap_penalty, treshold_prop, simfold).fold(matrix, sequence, k, processes, beam_width, budget)
+
+_grow_state = None
 
-    tree = initialize_tree(sequence, matrix, k)
-    grow_tree(tree, sequence, matrix, k)
+def _init_grow_worker(engine: HotKnotsEngine, sequence: str, matrix: torch.Tensor, treshold: float, k: int) -> None:
+    """
+    Keeps the engine and the sequence that is folded in a worker process, so they are only sent once for each tree
+    """
+    global _grow_state
+    _grow_state = engine, sequence, matrix, treshold, k
 
-    best = sorted(tree.nodes, key=lambda x: x.StrSeq, reverse=True)[0]
+def _expand_node_job(job: tuple) -> tuple:
+    """
+    Expands a node of the tree in a worker process
 
-    pairs = SeqStr(sequence, best, matrix, output_pairs=True)
-  
-    return pairs
+    Parameters:
+    - job (tuple): The node and the hotspots left from its parent
+
+    Returns:
+    - tuple: The hotspots left for the children of the node and the k best children
+    """
+    engine, sequence, matrix, treshold, k = _grow_state
+    node, L = job
+
+    return engine.expand_node(node, L, sequence, matrix, treshold, k)
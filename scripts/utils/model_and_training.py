@@ -371,4 +371,54 @@ def evaluate(y_pred: torch.Tensor, y_true: torch.Tensor, device: str, epsilon: f
     F1 = 2 * (precision*recall)/(precision+recall+epsilon)
     
     
+    return precision.item(), recall.item(), F1.item()
+
+def evaluate_pairs(y_pred: torch.Tensor, y_true: torch.Tensor, epsilon: float=1e-10, allow_shift = False, include_unpaired = False) -> tuple: 
+    """
+    Function to evaluate the performance of a model based on precision, recall and F1 score, using pair vectors instead of matrices.
+    The pair vectors have the index of the paired base or -1 for unpaired bases, and the scores are the same as for evaluate with the corresponding matrices.
+
+    Parameters:
+    - y_pred (torch.Tensor): The predicted pair vector
+    - y_true (torch.Tensor): The true pair vector
+    - epsilon (float): A small number to avoid division by zero. Default is 1e-10.
+    - allow_shift (bool): If True, the function will allow for a 1 bp shift in the predicted pairs. Default is False.
+    - include_unpaired (bool): If True, the function will include unpaired bases in the evaluation. Default is False.
+
+    Returns:
+    tuple: A tuple containing the precision, recall and F1 score
+    """
+    assert y_pred.shape == y_true.shape
+
+    y_true = y_true.to(y_pred.device)
+    index = torch.arange(y_true.shape[0], device=y_pred.device)
+
+    if include_unpaired: 
+      #Unpaired bases are paired with themselves
+      y_pred = torch.where(y_pred < 0, index, y_pred)
+      y_true = torch.where(y_true < 0, index, y_true)
+
+    pred_P = (y_pred >= 0).sum()
+    true_P = (y_true >= 0).sum()
+
+    found = (y_pred == y_true)
+
+    if allow_shift:
+      #Allow the partner to be shifted by one, or the base to be shifted by one
+      #Unpaired predictions are set to -3 to never match a shifted partner
+      shifted = torch.where(y_pred < 0, -3, y_pred)
+      found = found | (shifted == y_true - 1) | (shifted == y_true + 1)
+      found[1:] = found[1:] | (shifted[:-1] == y_true[1:])
+      found[:-1] = found[:-1] | (shifted[1:] == y_true[:-1])
+
+    FN = true_P - (found & (y_true >= 0)).sum()
+
+    TP = true_P - FN
+    FP = pred_P - TP
+
+    precision = TP / (TP + FP + epsilon)
+    recall = TP / (TP + FN + epsilon)
+
+    F1 = 2 * (precision*recall)/(precision+recall+epsilon)
+    
     return precision.item(), recall.item(), F1.item()
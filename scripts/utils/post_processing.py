@@ -1,14 +1,18 @@
-import torch, math
+import torch, math, time, os, queue
 
 import torch.nn.functional as F
+import torch.multiprocessing as mp
+
+from functools import partial
 
 import numpy as np
 import networkx as nx
 
 from utils import blossom
-from utils.Mfold1 import Mfold as Mfold_param
-from utils.Mfold2 import Mfold as Mfold_constrain
-from utils.hotknots import hotknots
+from utils.Mfold1 import MfoldEngine as MfoldParamEngine
+from utils.Mfold2 import MfoldEngine as MfoldConstrainEngine, SparseMfoldEngine
+from utils.dp_tables import DPTable, backtrack_stack, w_trace
+from utils.hotknots import hotknots, mfold_pool
 
 def pairs(x: str, y:str) -> bool:
     if x == 'A' and y == 'U':
@@ -56,9 +60,76 @@ def prepare_input(matrix: torch.Tensor, sequence: str, device: str) -> torch.Ten
     
     return matrix
 
+### PAIR VECTORS ###
+def pairs_to_matrix(pairs: torch.Tensor, device: str, unpaired: bool = True) -> torch.Tensor:
+    """
+    Converts a pair vector to the matrix representation of the structure with a single scatter.
+    The pair vector has the index of the base each position is paired with and -1 for unpaired bases.
+
+    Parameters:
+    - pairs (torch.Tensor): The pair vector.
+    - device (str): The device to use for the matrix.
+    - unpaired (bool): If True, unpaired bases are encoded as 1 on the diagonal.
+
+    Returns:
+    - torch.Tensor: The structure as a matrix.
+    """
+    n = pairs.shape[0]
+    pairs = pairs.to(device)
+    index = torch.arange(n, device=device)
+
+    matrix = torch.zeros((n, n), device=device)
+    matrix.scatter_(1, torch.where(pairs >= 0, pairs, index).unsqueeze(1), 1)
+
+    if not unpaired:
+        matrix[index, index] = 0
+    
+    return matrix
+
+def matrix_to_pairs(matrix: torch.Tensor) -> torch.Tensor:
+    """
+    Converts the matrix representation of a structure to a pair vector. 
+    The pair vector has the index of the base each position is paired with and -1 for unpaired bases.
+    Bases with 1 on the diagonal or no 1 in the row are unpaired. 
+
+    Parameters:
+    - matrix (torch.Tensor): The structure as a matrix.
+
+    Returns:
+    - torch.Tensor: The pair vector.
+    """
+    index = torch.arange(matrix.shape[0], device=matrix.device)
+    partner = torch.argmax(matrix, dim=1)
+    paired = (matrix[index, partner] > 0) & (partner != index)
+
+    return torch.where(paired, partner, -1)
+
+def matching_to_pairs(matching, n: int, device: str) -> torch.Tensor:
+    """
+    Converts a collection of base pairs (i, j) to a pair vector of length n. Pairs with i == j are unpaired bases.
+
+    Parameters:
+    - matching (iterable): The base pairs.
+    - n (int): The length of the sequence.
+    - device (str): The device to use for the pair vector.
+
+    Returns:
+    - torch.Tensor: The pair vector.
+    """
+    pairs = torch.full((n,), -1, dtype=torch.long, device=device)
+    edges = torch.tensor([(i, j) for i, j in matching if i != j], dtype=torch.long, device=device).reshape(-1, 2)
+
+    pairs[edges[:, 0]] = edges[:, 1]
+    pairs[edges[:, 1]] = edges[:, 0]
+
+    return pairs
+
+
+### POST-PROCESSING ###
 def argmax_postprocessing(matrix: torch.Tensor, sequence: str, device: str) -> torch.Tensor:
     """
-    Postprocessing function that takes a matrix and returns a matrix with 1s in the position of the maximum value in each row.
+    Postprocessing function that takes a matrix and returns the position of the maximum value in each row as a pair vector.
+    Rows with the maximum on the diagonal are unpaired. The result is not necessarily symmetric.
     The functions has sequence as input, but does not use it. It is provided to make the function compatible with other postprocessing functions.
 
     Parameters:
@@ -66,22 +137,16 @@ def argmax_postprocessing(matrix: torch.Tensor, sequence: str, device: str) -> t
     - sequence (str): The sequence that the matrix was generated from.
 
     Returns:
-    - torch.Tensor: The postprocessed matrix.
+    - torch.Tensor: The pair vector with the index of the paired base or -1 for unpaired bases.
     """ 
-    y_out = torch.zeros_like(matrix)
     indices = torch.argmax(matrix, dim=1)
-    y_out.scatter_(1, indices.unsqueeze(1), 1)
-
-    zero_rows = ~torch.any(y_out != 0, dim=1)
 
-    y_out[zero_rows, zero_rows] = 1
-
-    return y_out
+    return torch.where(indices == torch.arange(matrix.shape[0], device=indices.device), -1, indices).to(device)
 
 
 def nx_blossum_postprocessing(matrix: torch.Tensor, sequence: str, device: str) -> torch.Tensor: 
     """
-    Postprocessing function that takes a matrix and returns a matrix.
+    Postprocessing function that takes a matrix and returns a pair vector.
     The function uses NetworkX to find the maximum weight matching in the graph representation of the matrix, with copying of the matrix to allow for self-pairing.
     The functions has sequence as input, but does not use it. It is provided to make the function compatible with other postprocessing functions.
 
@@ -90,7 +155,7 @@ def nx_blossum_postprocessing(matrix: torch.Tensor, sequence: str, device: str)
     - sequence (str): The sequence that the matrix was generated from.
 
     Returns:
-    - torch.Tensor: The postprocessed matrix.
+    - torch.Tensor: The pair vector with the index of the paired base or -1 for unpaired bases.
     """    
     n = matrix.shape[0]
 
@@ -102,23 +167,16 @@ def nx_blossum_postprocessing(matrix: torch.Tensor, sequence: str, device: str)
     A[:n, n:] = matrix*mask
     A[n:, :n] = matrix*mask
 
-    G = nx.convert_matrix.from_numpy_array(A.numpy())
+    G = nx.convert_matrix.from_numpy_array(A.cpu().numpy())
     pairing = nx.max_weight_matching(G)
 
-    y_out = torch.zeros_like(matrix, device=device)
-
-    for (i, j) in pairing:
-        if i>n and j>n:
-            continue
-        y_out[i%n, j%n] = 1
-        y_out[j%n, i%n] = 1
-    
-    return y_out
+    return matching_to_pairs([(i, j) for i, j in pairing if i < n and j < n], n, device)
 
 def blossom_postprocessing(matrix: torch.Tensor, sequence: str, device: str) -> torch.Tensor: 
     """
-    Postprocessing function that takes a matrix and returns a matrix.
-    The function uses the blossom algorithm to find the maximum weight matching in the graph representation of the matrix, with copying of the matrix to allow for self-pairing.
+    Postprocessing function that takes a matrix and returns a pair vector.
+    The function uses the blossom algorithm to find the maximum weight matching in the graph representation of the matrix, with the diagonal as the score of self-pairing (leaving a base unpaired).
+    The matching is found on the N bases directly, but gives the same result as copying the matrix to a 2Nx2N graph where each base can pair with its copy.
     The functions used are modified version of NetworkX functions, and are implemented in the blossom.py file.
     The functions has sequence as input, but does not use it. It is provided to make the function compatible with other postprocessing functions.
 
@@ -127,33 +185,17 @@ def blossom_postprocessing(matrix: torch.Tensor, sequence: str, device: str) ->
     - sequence (str): The sequence that the matrix was generated from.
 
     Returns:
-    - torch.Tensor: The postprocessed matrix.
+    - torch.Tensor: The pair vector with the index of the paired base or -1 for unpaired bases.
     """
-    n = matrix.shape[0]
+    # Same optimum as copying the matrix and linking each base to its copy with the score on the diagonal
+    # Pairs are found in both copies, so the score of leaving a base unpaired is half the diagonal
+    pairing = blossom.max_weight_matching_matrix(matrix, unpaired=torch.diagonal(matrix)/2)
 
-    mask = torch.eye(n, device=device)
-
-    A = torch.zeros((2*n, 2*n), device=device)
-    A[:n, :n] = matrix
-    A[n:, n:] = matrix
-    A[:n, n:] = matrix*mask
-    A[n:, :n] = matrix*mask
-
-    pairing = blossom.max_weight_matching_matrix(A)
-
-    y_out = torch.zeros_like(matrix, device=device)
-
-    for (i, j) in pairing:
-        if i>n and j>n:
-            continue
-        y_out[i%n, j%n] = 1
-        y_out[j%n, i%n] = 1
-    
-    return y_out
+    return matching_to_pairs(pairing, matrix.shape[0], device)
 
 def blossom_weak(matrix: torch.Tensor, sequence: str, device: str, treshold: float = 0.5) -> torch.Tensor: 
     """
-    Postprocessing function that takes a matrix and returns a matrix.
+    Postprocessing function that takes a matrix and returns a pair vector.
     Uses the blossom algorithm to find the maximum weight matching in the graph representation of the matrix.
     Since the blossom algorithm does not allow for self-pairing (i.e. pairing a base with itself), the matrix is first thresholded to remove weak pairings.
     This allows for bases with no strong pairings to be left out of the pairing.
@@ -165,55 +207,160 @@ def blossom_weak(matrix: torch.Tensor, sequence: str, device: str, treshold: flo
     - treshold (float): The treshold to use for the matrix.
 
     Returns:
-    - torch.Tensor: The postprocessed matrix.
+    - torch.Tensor: The pair vector with the index of the paired base or -1 for unpaired bases.
     """
     matrix = matrix.clone()
     matrix[matrix < treshold] = 0
 
     pairs = blossom.max_weight_matching_matrix(matrix)
 
-    y_out = torch.zeros_like(matrix, device=device)
+    return matching_to_pairs(pairs, matrix.shape[0], device)
 
-    for (i, j) in pairs:
-        y_out[i, j] = y_out[j, i] = 1
+def greedy_postprocessing(matrix: torch.Tensor, sequence: str, device: str, treshold: float = 0.5, local_search: bool = False) -> torch.Tensor:
+    """
+    Postprocessing function that takes a matrix and returns a pair vector.
+    Approximate alternative to blossom_weak. The matching is found greedily by picking the strongest pairings first, optionally improved by local swaps.
+    The matching has at least half the weight of the maximum weight matching, but is found in O(E log E) time instead of O(V^3).
+    As in blossom_weak the matrix is first thresholded to remove weak pairings, which allows bases with no strong pairings to be left out of the pairing.
+    The function has sequence as input, but does not use it. It is provided to make the function compatible with other postprocessing functions.
 
-    # Find rows where all elements are zero
-    zero_rows = ~torch.any(y_out != 0, dim=1)
+    Parameters:
+    - matrix (torch.Tensor): The matrix to postprocess.
+    - sequence (str): The sequence that the matrix was generated from.
+    - treshold (float): The treshold to use for the matrix.
+    - local_search (bool): If True, the greedy matching is improved by at most 10 rounds of local swaps of O(N^2) time each.
+
+    Returns:
+    - torch.Tensor: The pair vector with the index of the paired base or -1 for unpaired bases.
+    """
+    matrix = matrix.clone()
+    matrix[matrix < treshold] = 0
 
-    # Set diagonal elements to 1 in rows where all other elements are zero
-    y_out[zero_rows, torch.arange(y_out.shape[0], device=device)[zero_rows]] = 1
+    pairs = blossom.greedy_matching_matrix(matrix, local_search=local_search)
 
-    return y_out
+    return matching_to_pairs(pairs, matrix.shape[0], device)
 
-def Mfold_param_postprocessing(matrix: torch.Tensor, sequence: str, device: str, threshold = 1e-8) -> torch.Tensor:
+def nussinov_postprocessing(matrix: torch.Tensor, sequence: str, device: str, gamma: float = 1.0, span: int = None) -> torch.Tensor:
     """
-    Postprocessing function that takes a matrix and returns a matrix.
+    Postprocessing function that takes a matrix and returns a pair vector.
+    Fast alternative to blossom_weak that only gives nested structures. The structure with the maximum expected accuracy (MEA) is found with a weighted Nussinov algorithm,
+    where a basepair (i, j) scores 2*gamma times its value in the matrix and an unpaired base scores its value on the diagonal, as in CONTRAfold.
+    The DP table is filled one diagonal at a time, with the maximum over all splits of the cells on a diagonal found at once.
+    Only pairs with a value above 0 can be used, so pairs removed by the mask from prepare_input are not allowed.
+    The function has sequence as input, but does not use it. It is provided to make the function compatible with other postprocessing functions.
+
+    Parameters:
+    - matrix (torch.Tensor): The matrix to postprocess.
+    - sequence (str): The sequence that the matrix was generated from.
+    - device (str): The device to use for the matrix.
+    - gamma (float): The weight of the basepairs. Higher values give more basepairs.
+    - span (int): The maximum distance between paired bases. The table is then stored banded, so long sequences use O(N*span) memory and O(N*span^2) time. None allows all basepairs.
+
+    Returns:
+    - torch.Tensor: The pair vector with the index of the paired base or -1 for unpaired bases.
+    """
+    P = matrix.detach().cpu().numpy().astype(np.float64)
+    N = P.shape[0]
+    span = None if span is None or span >= N-1 else span
+
+    #The table holds the negative expected accuracy, so the minimum is found as in Mfold and the trace codes and backtracking are shared
+    W = DPTable.empty(N, np.float64, span)
+    W_trace = DPTable.empty(N, np.int8, span, fill=0)
+    W_split = DPTable.empty(N, np.int32, span, fill=0)
+
+    unpaired = -np.diagonal(P)
+    W.set_diagonal(0, unpaired)
+
+    for d in range(1, N if span is None else span+1):
+        n = N-d
+        i = np.arange(n)
+
+        skip_i = W.diagonal(d-1)[1:] + unpaired[:n]
+        skip_j = W.diagonal(d-1)[:n] + unpaired[d:]
+
+        score = P[i, i+d]
+        inner = W.diagonal(d-2)[1:n+1] if d > 1 else 0
+        pair = np.where(score > 0, inner - 2*gamma*score, np.inf)
+
+        #Split into W[i, k] + W[k+1, j] for k in [i+1, j-2], the splits at the ends are the same as skipping a base
+        if d > 2:
+            splits = W.view(0, 1, n, 0, 1, d-2) + W.view(2, d, n, 1, 0, d-2)
+            k = np.argmin(splits, axis=0)
+            split = splits[k, i]
+        else:
+            k, split = np.zeros(n, dtype=np.int32), np.full(n, np.inf)
+
+        w = np.minimum(np.minimum(skip_i, skip_j), np.minimum(pair, split))
+        W.set_diagonal(d, w)
+        W_trace.set_diagonal(d, w_trace(w, skip_i, skip_j, pair, split))
+        W_split.set_diagonal(d, i+1+k)
+
+    if span is None:
+        stack = [('W', 0, N-1)] if N > 0 else []
+    else:
+        #Split the sequence into segments of at most span+1 bases, best[j+1] is the best score of the bases 0 to j
+        best, start = np.zeros(N+1), np.zeros(N, dtype=np.int64)
+        for j in range(N):
+            ip = np.arange(max(0, j-span), j+1)
+            options = best[ip] + W[ip, j]
+            start[j] = ip[np.argmin(options)]
+            best[j+1] = np.min(options)
+
+        stack, j = [], N-1
+        while j >= 0:
+            stack.append(('W', int(start[j]), j))
+            j = start[j]-1
+
+    pairs = backtrack_stack(N, stack, W_trace, W_split, lambda i, j: [('W', i+1, j-1)] if j-i > 1 else [])
+
+    return matching_to_pairs([(i, j) for i, j in enumerate(pairs) if i <= j], N, device)
+
+def matching_weight(matrix: torch.Tensor, pairs: torch.Tensor) -> float:
+    """
+    Calculates the weight of the base pairs in a pair vector, i.e. the sum of the scores of the pairs in the matrix.
+    Unpaired bases are not included.
+
+    Parameters:
+    - matrix (torch.Tensor): The matrix that was postprocessed.
+    - pairs (torch.Tensor): The pair vector returned from the postprocessing.
+
+    Returns:
+    - float: The weight of the pairs.
+    """
+    pairs = pairs.to(matrix.device)
+    index = torch.arange(matrix.shape[0], device=matrix.device)
+    first = pairs > index
+
+    return matrix[index[first], pairs[first]].sum().item()
+
+def Mfold_param_postprocessing(matrix: torch.Tensor, sequence: str, device: str, threshold = 1e-8, max_loop: int = 30, span: int = None, engine: MfoldParamEngine = None) -> torch.Tensor:
+    """
+    Postprocessing function that takes a matrix and returns a pair vector.
     Uses the Mfold algorithm to find the maximum weight matching in the graph representation of the matrix.
     The Mfold alorthm uses the matrix from the network as parameters for base pairing.
 
     Parameters:
     - matrix (torch.Tensor): The matrix to postprocess.
     - sequence (str): The sequence that the matrix was generated from.
+    - max_loop (int): The maximum number of unpaired bases in internal loops. None allows all internal loops.
+    - span (int): The maximum distance between paired bases. The Mfold tables are then stored banded, so long sequences use O(N*span) memory. None allows all basepairs.
+    - engine (MfoldEngine): An engine to reuse for the fold. If given, max_loop and span are taken from the engine.
 
     Returns:
-    - torch.Tensor: The postprocessed matrix.
+    - torch.Tensor: The pair vector with the index of the paired base or -1 for unpaired bases.
     """
     M = -matrix.clone()
     M[M == 0] = torch.inf
 
-    pairs = Mfold_param(sequence, M, device)
-
-    y_out = torch.zeros_like(matrix, device=device)
+    engine = engine or MfoldParamEngine(device, max_loop, span)
+    pairs = torch.tensor(engine.fold(sequence, M), device=device)
 
-    for i, j in enumerate(pairs):
-        y_out[i, j] = 1
-    
-    return y_out
+    return torch.where(pairs == torch.arange(len(pairs), device=device), -1, pairs)
 
 
-def Mfold_constrain_postprocessing(matrix: torch.Tensor, sequence: str, device: str, treshold: float = 0.5) -> torch.Tensor: 
+def Mfold_constrain_postprocessing(matrix: torch.Tensor, sequence: str, device: str, treshold: float = 0.5, max_loop: int = 30, span: int = None, sparse: bool = False, engine: MfoldConstrainEngine = None) -> torch.Tensor: 
     """
-    Postprocessing function that takes a matrix and returns a matrix.
+    Postprocessing function that takes a matrix and returns a pair vector.
     Uses the Mfold algorithm to find the maximum weight matching in the graph representation of the matrix.
     The Mfold alorthm uses the matrix from the network as constraints for which bases can pair.
 
@@ -222,25 +369,25 @@ def Mfold_constrain_postprocessing(matrix: torch.Tensor, sequence: str, device:
     - sequence (str): The sequence that the matrix was generated from.
     - device (str): The device to use for the matrix.
     - treshold (float): The treshold to use for the matrix. Bases with a value below the treshold are not allowed to pair.
+    - max_loop (int): The maximum number of unpaired bases in bulge and interior loops. None allows all loops.
+    - span (int): The maximum distance between paired bases. The Mfold tables are then stored banded, so long sequences use O(N*span) memory. None allows all basepairs.
+    - sparse (bool): If True, Mfold only runs over the pairs above the treshold, which is faster when there are few of them.
+    - engine (MfoldEngine): An engine to reuse for the fold. If given, max_loop, span and sparse are taken from the engine.
 
     Returns:
-    - torch.Tensor: The postprocessed matrix.
+    - torch.Tensor: The pair vector with the index of the paired base or -1 for unpaired bases.
     """
     matrix = matrix.clone()
     matrix[matrix < treshold] = 0
     
-    pairs = Mfold_constrain(sequence, matrix, device)
-    
-    y_out = torch.zeros_like(matrix, device=device)
-
-    for i, j in enumerate(pairs):
-        y_out[i, j]  = 1
+    engine = engine or (SparseMfoldEngine if sparse else MfoldConstrainEngine)(device, max_loop, span)
+    pairs = torch.tensor(engine.fold(sequence, matrix), device=device)
     
-    return y_out
+    return torch.where(pairs == torch.arange(len(pairs), device=device), -1, pairs)
 
-def hotknots_postprocessing(matrix: torch.Tensor, sequence: str, device: str, k=3, gap_penalty = 0.5, treshold_prop = 0.8) -> torch.Tensor:
+def hotknots_postprocessing(matrix: torch.Tensor, sequence: str, device: str, k=3, gap_penalty = 0.5, treshold_prop = 0.8, in_process: bool = False, beam_width: int = None, budget: int = None) -> torch.Tensor:
     """
-    Postprocessing function that takes a matrix and returns a matrix.
+    Postprocessing function that takes a matrix and returns a pair vector.
     Uses the HotKnots algorithm, which is a heuristic able to find structures with pseudoknot.
     The HotKnots algorithm uses the matrix from the network as parameters for base pairing.
 
@@ -251,19 +398,304 @@ def hotknots_postprocessing(matrix: torch.Tensor, sequence: str, device: str, k=
     - k (int): The maximum number of children for each node.
     - gap_penalty (float): The penalty for gaps in the structure.
     - treshold_prop (float): The porportion of the naive structure to use as treshold for adding new hotspots.
+    - in_process (bool): If True, the segments are folded with the constrained Mfold in-process instead of with SimFold, so SimFold does not have to be installed.
+    - beam_width (int): If given, the HotKnots tree is searched best first, keeping only this many nodes to expand.
+    - budget (int): The number of hotspot sets to evaluate in the beam search before it stops.
 
     Returns:
-    - torh.Tensor: The postprocessed matrix.
+    - torch.Tensor: The pair vector with the index of the paired base or -1 for unpaired bases.
+    """
+    pairs = hotknots(matrix, sequence, device, k=k, gap_penalty=gap_penalty, treshold_prop=treshold_prop, simfold=mfold_pool if in_process else None, beam_width=beam_width, budget=budget)
+
+    return matching_to_pairs(pairs, matrix.shape[0], device)
+
+
+### ADAPTIVE POST-PROCESSING ###
+# Seconds per unit of work, measured on masked predictions of length 100-600
+# Blossom scales with length times number of candidate pairs, greedy with the number of candidate pairs
+POSTPROCESSING_COST = {'blossom': 3.5e-7, 'sparse blossom': 8e-7, 'greedy': 2e-6}
+
+def sparse_candidates(matrix: torch.Tensor, k: int = 8) -> torch.Tensor:
     """
-    pairs = hotknots(matrix, sequence, k=k, gap_penalty=gap_penalty, treshold_prop=treshold_prop)
+    Keeps only the k strongest candidate pairs for each base. A pair is kept if it is among the k strongest for either of the bases.
+    The diagonal (the score of leaving a base unpaired) is kept.
+
+    Parameters:
+    - matrix (torch.Tensor): The matrix to sparsify.
+    - k (int): The number of candidate pairs to keep for each base.
 
-    y_out = torch.zeros_like(matrix, device=device)
+    Returns:
+    - torch.Tensor: The sparse matrix.
+    """
+    n = matrix.shape[0]
+    diagonal = torch.diagonal(matrix).clone()
     
-    for (i, j) in pairs:
-        y_out[i, j] = y_out[j, i] = 1
+    off_diagonal = matrix.clone()
+    off_diagonal.fill_diagonal_(0)
+    values, indices = torch.topk(off_diagonal, min(k, n), dim=1)
+
+    sparse = torch.zeros_like(matrix)
+    sparse.scatter_(1, indices, values)
+    sparse = torch.maximum(sparse, sparse.T)
+    sparse[range(n), range(n)] = diagonal
+
+    return sparse
+
+def sparse_blossom_postprocessing(matrix: torch.Tensor, sequence: str, device: str, k: int = 8) -> torch.Tensor: 
+    """
+    Postprocessing function that takes a matrix and returns a pair vector.
+    Same as blossom_postprocessing, but only the k strongest candidate pairs of each base are used, which makes the graph sparse.
+    With k = 8 the matching found has close to the same weight as the exact matching, in a fraction of the time for long sequences.
+    The function has sequence as input, but does not use it. It is provided to make the function compatible with other postprocessing functions.
+
+    Parameters:
+    - matrix (torch.Tensor): The matrix to postprocess.
+    - sequence (str): The sequence that the matrix was generated from.
+    - device (str): The device to use for the matrix.
+    - k (int): The number of candidate pairs to keep for each base.
+
+    Returns:
+    - torch.Tensor: The pair vector with the index of the paired base or -1 for unpaired bases.
+    """
+    return blossom_postprocessing(sparse_candidates(matrix, k), sequence, device)
+
+def estimate_postprocessing_time(matrix: torch.Tensor, method: str, k: int = 8) -> float:
+    """
+    Estimates the time it takes to post-process a matrix with a given method, from the length and the number of candidate pairs.
+
+    Parameters:
+    - matrix (torch.Tensor): The matrix to postprocess.
+    - method (str): The method to use. One of 'blossom', 'sparse blossom' and 'greedy'.
+    - k (int): The number of candidate pairs for each base used by 'sparse blossom'.
+
+    Returns:
+    - float: The estimated time in seconds.
+    """
+    n = matrix.shape[0]
+    candidates = torch.count_nonzero(torch.triu(matrix, diagonal=1)).item()
+
+    if method == 'blossom':
+        return POSTPROCESSING_COST[method] * n * candidates
+    if method == 'sparse blossom':
+        return POSTPROCESSING_COST[method] * n * min(candidates, k*n)
+    if method == 'greedy':
+        return POSTPROCESSING_COST[method] * candidates
+    
+    raise ValueError(f"Unknown post-processing method '{method}'")
+
+def adaptive_postprocessing(matrix: torch.Tensor, sequence: str, device: str, time_budget: float = None, k: int = 8) -> tuple:
+    """
+    Postprocessing function that chooses the method for each sequence to fit within a time budget.
+    The exact blossom matching is used if it is expected to finish within the budget.
+    Otherwise it falls back to blossom on the k strongest candidate pairs of each base, and then to the greedy matching.
+    All methods use the diagonal as the score of leaving a base unpaired, as in blossom_postprocessing.
+
+    Parameters:
+    - matrix (torch.Tensor): The matrix to postprocess.
+    - sequence (str): The sequence that the matrix was generated from.
+    - device (str): The device to use for the matrix.
+    - time_budget (float): The time budget in seconds. If None, the exact blossom matching is always used.
+    - k (int): The number of candidate pairs for each base used by the sparse blossom matching.
+
+    Returns:
+    - tuple: The pair vector and the name of the method used.
+    """
+    if time_budget is None or estimate_postprocessing_time(matrix, 'blossom') <= time_budget:
+        return blossom_postprocessing(matrix, sequence, device), 'blossom'
+    
+    if estimate_postprocessing_time(matrix, 'sparse blossom', k) <= time_budget:
+        return sparse_blossom_postprocessing(matrix, sequence, device, k), 'sparse blossom'
+    
+    pairing = blossom.greedy_matching_matrix(matrix, unpaired=torch.diagonal(matrix)/2)
+    
+    return matching_to_pairs(pairing, matrix.shape[0], device), 'greedy'
+
+
+### BATCH POST-PROCESSING ###
+def _postprocess_job(job: tuple, func, kwargs: dict) -> tuple:
+    """
+    Runs a single post-processing job in a worker process.
+
+    Parameters:
+    - job (tuple): The index of the job, the matrix and the sequence.
+    - func (function): The postprocessing function to use.
+    - kwargs (dict): Extra keyword arguments for the postprocessing function.
+
+    Returns:
+    - tuple: The index of the job, the pair vector and the time the post-processing took.
+    """
+    index, matrix, sequence = job
+
+    start = time.time()
+    pairs = func(matrix, sequence, 'cpu', **kwargs)
+    
+    return index, pairs, time.time() - start
+
+def _imap_bounded(pool, process_job, jobs, processes: int, ordered: bool):
+    """
+    Runs jobs on a process pool, reading them lazily with at most two jobs per worker waiting or running.
+    Unlike Pool.imap, which reads all the jobs at once, this keeps the number of matrices in shared memory, and the file descriptors they hold open, bounded.
+
+    Parameters:
+    - pool (multiprocessing.Pool): The pool to run the jobs on.
+    - process_job (function): The function to run for each job. Must take a job with its index first and return a tuple with the index first.
+    - jobs (iterable): The jobs with their indices.
+    - processes (int): The number of worker processes in the pool. None is the number of CPUs.
+    - ordered (bool): If True, the results are returned in the same order as the jobs. Otherwise they are returned as they finish.
+
+    Returns:
+    - generator: The results of process_job.
+    """
+    window = 2 * (processes or os.cpu_count())
+    pending = {} #Submitted jobs by their index, in the order they are submitted
+    finished = queue.Queue() #Indices of the submitted jobs in the order they finish, only used if not ordered
+
+    def next_result():
+        #Waits for the oldest job if the results are ordered, otherwise for the first job to finish
+        index = next(iter(pending)) if ordered else finished.get()
+        return pending.pop(index).get()
+
+    for job in jobs:
+        done = None if ordered else (lambda _, index=job[0]: finished.put(index))
+        pending[job[0]] = pool.apply_async(process_job, (job,), callback=done, error_callback=done)
+        if len(pending) >= window:
+            yield next_result()
+    while pending:
+        yield next_result()
+
+def postprocess_many(jobs, func = blossom_weak, processes: int = None, ordered: bool = True, **kwargs):
+    """
+    Post-processes many matrices in parallel on a process pool.
+    The matrices are moved to shared memory, so only a handle is sent to the worker processes.
+    Jobs are read lazily and at most two jobs per worker are waiting or running, so predictions made by a generator are post-processed while the next ones are made without all of them being kept in memory.
+
+    Parameters:
+    - jobs (iterable): Tuples of (matrix, sequence) to post-process.
+    - func (function): The postprocessing function to use. Must be defined at module level. Default is blossom_weak.
+    - processes (int): The number of worker processes. Default is the number of CPUs. If 1, the jobs are run in the main process.
+    - ordered (bool): If True, the results are returned in the same order as the jobs. Otherwise they are returned as they finish.
+    - kwargs: Extra keyword arguments for the postprocessing function.
+
+    Returns:
+    - generator: Tuples of (index of the job, pair vector, time the post-processing took).
+    """
+    process_job = partial(_postprocess_job, func=func, kwargs=kwargs)
+    shared_jobs = ((index, matrix.detach().cpu().share_memory_(), sequence) for index, (matrix, sequence) in enumerate(jobs))
+
+    if processes == 1:
+        yield from map(process_job, shared_jobs)
+        return
     
-    for i in range(matrix.shape[0]): 
-        if not torch.any(y_out[i, :], device=device):    
-            y_out[i, i] = 1
+    with mp.Pool(processes) as pool:
+        yield from _imap_bounded(pool, process_job, shared_jobs, processes, ordered)
+
+_worker_engine = None
+
+def _init_Mfold_worker(engine_class, max_loop: int, span: int) -> None:
+    """
+    Makes the Mfold engine of a worker process. 
+    The engine is made once per worker, so the energy parameters are only loaded once and the DP tables are reused between jobs.
+
+    Parameters:
+    - engine_class (type): The Mfold engine to use.
+    - max_loop (int): The maximum number of unpaired bases in internal loops.
+    - span (int): The maximum distance between paired bases.
+    """
+    global _worker_engine
+    _worker_engine = engine_class('cpu', max_loop, span)
+
+def _Mfold_job(job: tuple, func, kwargs: dict) -> tuple:
+    """
+    Runs a single Mfold post-processing job with the engine of the worker process.
+
+    Parameters:
+    - job (tuple): The index of the job, the matrix and the sequence.
+    - func (function): The Mfold postprocessing function to use.
+    - kwargs (dict): Extra keyword arguments for the postprocessing function.
+
+    Returns:
+    - tuple: The index of the job, the pair vector and the time the post-processing took.
+    """
+    return _postprocess_job(job, func, dict(kwargs, engine=_worker_engine))
+
+def _shared_copy(matrix) -> torch.Tensor:
+    """
+    Copies a matrix to shared memory. Unlike share_memory_, the matrix itself is not moved, so it does not keep a file descriptor open after its job is done.
+
+    Parameters:
+    - matrix (torch.Tensor or np.ndarray): The matrix to copy.
+
+    Returns:
+    - torch.Tensor: The copy in shared memory.
+    """
+    matrix = torch.as_tensor(matrix).detach().cpu()
+    return torch.empty(matrix.shape, dtype=matrix.dtype).share_memory_().copy_(matrix)
+
+def _Mfold_many(jobs, func, engine_class, processes: int, max_loop: int, span: int, **kwargs):
+    """
+    Runs Mfold post-processing for many matrices on a process pool where each worker keeps its own Mfold engine.
+    The jobs are run longest first, since the time of Mfold grows fast with the length, and a long sequence started last would keep the other workers waiting.
+    At most two jobs per worker are in shared memory at a time, so many jobs can be run without running out of file descriptors.
     
-    return y_out
\ No newline at end of file
+    Parameters:
+    - jobs (iterable): Tuples of (matrix, sequence) to post-process. The matrices can be tensors or NumPy arrays.
+    - func (function): The Mfold postprocessing function to use.
+    - engine_class (type): The Mfold engine to use.
+    - processes (int): The number of worker processes. Default is the number of CPUs. If 1, the jobs are run in the main process.
+    - max_loop (int): The maximum number of unpaired bases in internal loops.
+    - span (int): The maximum distance between paired bases.
+    - kwargs: Extra keyword arguments for the postprocessing function.
+
+    Returns:
+    - generator: Tuples of (index of the job, pair vector, time the post-processing took) in the order they finish.
+    """
+    #Only the order is sorted, and each matrix is copied to shared memory when its job is sent, so the matrices of the caller are not moved to shared memory
+    jobs = list(jobs)
+    order = sorted(range(len(jobs)), key=lambda index: len(jobs[index][1]), reverse=True)
+    shared_jobs = ((index, _shared_copy(jobs[index][0]), jobs[index][1]) for index in order)
+
+    if processes == 1:
+        process_job = partial(_postprocess_job, func=func, kwargs=dict(kwargs, engine=engine_class('cpu', max_loop, span)))
+        yield from map(process_job, shared_jobs)
+        return
+
+    process_job = partial(_Mfold_job, func=func, kwargs=kwargs)
+
+    with mp.Pool(processes, initializer=_init_Mfold_worker, initargs=(engine_class, max_loop, span)) as pool:
+        yield from _imap_bounded(pool, process_job, shared_jobs, processes, ordered=False)
+
+def Mfold_param_postprocessing_many(jobs, processes: int = None, threshold = 1e-8, max_loop: int = 30, span: int = None):
+    """
+    Runs Mfold_param_postprocessing for many matrices in parallel.
+    Each worker process keeps one Mfold engine for all its jobs, and the jobs are run longest first.
+
+    Parameters:
+    - jobs (iterable): Tuples of (matrix, sequence) to post-process. The matrices can be tensors or NumPy arrays.
+    - processes (int): The number of worker processes. Default is the number of CPUs. If 1, the jobs are run in the main process.
+    - threshold (float): Passed on to Mfold_param_postprocessing.
+    - max_loop (int): The maximum number of unpaired bases in internal loops. None allows all internal loops.
+    - span (int): The maximum distance between paired bases. None allows all basepairs.
+
+    Returns:
+    - generator: Tuples of (index of the job, pair vector, time the post-processing took) in the order they finish.
+    """
+    return _Mfold_many(jobs, Mfold_param_postprocessing, MfoldParamEngine, processes, max_loop, span, threshold=threshold)
+
+def Mfold_constrain_postprocessing_many(jobs, processes: int = None, treshold: float = 0.5, max_loop: int = 30, span: int = None, sparse: bool = False):
+    """
+    Runs Mfold_constrain_postprocessing for many matrices in parallel.
+    Each worker process keeps one Mfold engine for all its jobs, so the energy parameters are loaded once per worker, and the jobs are run longest first.
+
+    Parameters:
+    - jobs (iterable): Tuples of (matrix, sequence) to post-process. The matrices can be tensors or NumPy arrays.
+    - processes (int): The number of worker processes. Default is the number of CPUs. If 1, the jobs are run in the main process.
+    - treshold (float): Bases with a value below the treshold are not allowed to pair.
+    - max_loop (int): The maximum number of unpaired bases in bulge and interior loops. None allows all loops.
+    - span (int): The maximum distance between paired bases. None allows all basepairs.
+    - sparse (bool): If True, Mfold only runs over the pairs above the treshold.
+
+    Returns:
+    - generator: Tuples of (index of the job, pair vector, time the post-processing took) in the order they finish.
+    """
+    engine_class = SparseMfoldEngine if sparse else MfoldConstrainEngine
+    return _Mfold_many(jobs, Mfold_constrain_postprocessing, engine_class, processes, max_loop, span, treshold=treshold)
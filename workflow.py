@@ -185,7 +185,8 @@ def evaluate_postprocessing_under600(files):
     inputs = [os.path.join('RNA_Unet.pth')] + files
     outputs = [os.path.join('results', 'average_scores_postprocess_under600.csv'), 
                os.path.join('figures', 'evaluation_postprocess_under600.png'),
-               os.path.join('results', 'evaluation_postprocess_under600.csv')]
+               os.path.join('results', 'evaluation_postprocess_under600.csv'),
+               os.path.join('results', 'greedy_vs_blossom_under600.csv')]
     options = {"memory":"16gb", "walltime":"24:00:00", "account":"RNA_Unet","cores":15} 
     spec = """echo "Job ID: $SLURM_JOB_ID\n"
     python3 scripts/evaluate_postprocessing_under600.py"""